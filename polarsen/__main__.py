@@ -23,11 +23,12 @@ if _mode != "api":
 
 if _mode in ("cli", "local"):
     logs.debug("Running in CLI mode")
-    from .cli import chat_group, ai_group, db_group
+    from .cli import chat_group, ai_group, db_group, bench_group
 
     cli.add_command_group(ai_group)
     cli.add_command_group(chat_group)
     cli.add_command_group(db_group)
+    cli.add_command_group(bench_group)
 
 
 if _mode in ("api", "local"):
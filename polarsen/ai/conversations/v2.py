@@ -19,7 +19,7 @@ from rich.progress import track
 from polarsen.common.utils import setup_session_model, AISource
 from polarsen.common.models import mistral, grok, gemini, self_hosted, openai
 from polarsen.common.models.utils import parse_json_response
-from polarsen.db import GroupMethod, Requests, MessageGroupChat, MessageGroup, get_unique_identifier, UsageToken
+from polarsen.db import GroupMethod, Requests, MessageGroupChat, MessageGroup, get_unique_identifier, UsageToken, DbChat
 from polarsen.logs import logs
 
 __all__ = ("get_messages_by_dates", "apply_conversation_segmentation", "MessageLite", "ParamsV2", "SEGMENTATION_MODEL")
@@ -49,12 +49,16 @@ _MESSAGES_BY_DATE = """
                            cm.message      as m,
                            cm.reply_to_id  as r_id,
                            (sent_at at time zone 'UTC')::text as s
-                    from general.chat_messages cm
+                    from (select distinct unnest($1::date[]) as day) days
+                             -- Half-open range of each day, to use the (chat_id, sent_at) index
+                             join general.chat_messages cm
+                                  on cm.chat_id = $2
+                                      and cm.sent_at >= days.day::timestamptz
+                                      and cm.sent_at < (days.day + 1)::timestamptz
                              left join general.chat_users cu on cu.id = cm.chat_user_id
                     where cm.message <> ''
-                      and cm.sent_at::date = any ($1)
-                      and cm.id in (select id from general.message_replies_view)
-                      and cm.chat_id = $2
+                      -- Messages attached to a reply thread (see `general.message_replies_view`)
+                      and cm.thread_root_id is not null
                     order by cm.sent_at asc
                     """
 
@@ -321,6 +325,7 @@ async def apply_conversation_segmentation(
             raise ValueError(f"Unknown model name {model_name!r}")
 
     thinking_text: str | None = None
+    request: Requests | None = None
     try:
         result, thinking_text = parse_json_response(resp, model=_ConversationSegResultType)
     finally:
@@ -328,9 +333,10 @@ async def apply_conversation_segmentation(
             _meta: dict = {**(meta or {}), "elapsed": time.time() - start, "thinking": _thinking}
             if thinking_text is not None:
                 _meta["thinking_text"] = thinking_text
-            await Requests.load(
+            request = Requests.load(
                 "completion", user_id=user_id, token=token, payload=payload, meta=_meta, run_id=run_id
-            ).save(conn)
+            )
+            await request.save(conn)
 
     results = result if isinstance(result, list) else [result]
 
@@ -344,6 +350,17 @@ async def apply_conversation_segmentation(
             else:
                 raise ValueError(f"ID {_id} not found in original messages")
     not_classified_ids = _ids - res_ids
+    if conn and request is not None and (_invalid_ids or not_classified_ids):
+        # Only the row of this request is updated, not the whole run
+        await Requests.update_meta(
+            conn,
+            request.id,
+            request.created_at,
+            {
+                "invalid_ids": list(_invalid_ids) if _invalid_ids else None,
+                "missing_ids": list(not_classified_ids) if not_classified_ids else None,
+            },
+        )
     return results, not_classified_ids, token, _invalid_ids
 
 
@@ -362,18 +379,29 @@ async def _get_processed_days(conn: asyncpg.Connection, chat_id: int) -> set[dt.
     Not all messages of the day needs to be processed, just one message.
     """
     query = """
-            select distinct (mg.meta ->> 'day') ::date as day
-            from ai.message_group_chats mgc
-                inner join general.chat_messages cm
-            on mgc.msg_id = cm.id
-                left join ai.message_groups mg on mg.id = mgc.group_id
-            where cm.chat_id = $1
+            select distinct day
+            from ai.message_groups
+            where chat_id = $1
+              and day is not null
             order by day
             """
     rows = await conn.fetch(query, chat_id)
     return set(x["day"] for x in rows)
 
 
+async def _get_days(conn: asyncpg.Connection, chat_id: int, from_date: dt.date | None = None) -> list[dt.date]:
+    """Returns the days with messages in the chat, since `from_date` (included) if set."""
+    query = """
+            SELECT distinct cm.sent_at::date as d
+            from general.chat_messages cm
+            where cm.chat_id = $1
+              and ($2::date is null or cm.sent_at >= $2::date::timestamptz)
+            order by d
+            """
+    rows = await conn.fetch(query, chat_id, from_date)
+    return [x["d"] for x in rows]
+
+
 async def run_group_messages(
     conn: asyncpg.Connection,
     session: AsyncSession,
@@ -402,26 +430,17 @@ async def run_group_messages(
 
     _method_id = await GROUPING_V2.upsert(conn)
 
+    # Days that received new messages since they were segmented (see `TelegramGroup.save_messages`)
+    pending_days = await DbChat.get_pending_days(conn, chat_id)
     if not _days:
         from_date = params.get("from_date")
         if not force:
-            processed_days = await _get_processed_days(conn, chat_id)
+            processed_days = await _get_processed_days(conn, chat_id) - pending_days
         else:
             processed_days = set()
-        days = await conn.fetch(
-            """
-            SELECT distinct cm.sent_at::date as d
-            from general.chat_messages cm
-            where cm.chat_id = $1
-              and $2::date is null
-               or cm.sent_at::date >= $2
-            order by d
-            """,
-            chat_id,
-            from_date,
-        )
+        days = await _get_days(conn, chat_id, from_date=from_date)
         nb_days = len(days)
-        _days = (x["d"] for x in days if x["d"] not in processed_days)
+        _days = (x for x in days if x not in processed_days)
     else:
         nb_days = len(_days)
     logs.info(f"Found {nb_days} days to process")
@@ -430,6 +449,9 @@ async def run_group_messages(
     run_id = uuid.uuid4()
     for day in track(_days, disable=not show_progress, show_speed=True, description="Days..."):
         _day: dt.date = day
+        if _day in pending_days:
+            # The day is segmented again with its new messages, replacing the previous groups
+            await MessageGroup.delete_days(conn, chat_id=chat_id, days=[_day])
         messages, _nb_messages = await get_messages_by_dates(conn, dates=[_day], chat_id=chat_id, force=force)
         nb_messages += _nb_messages
         start = time.time()
@@ -445,25 +467,13 @@ async def run_group_messages(
             model_name=model_name,
             raise_invalid_ids=False,
             run_id=run_id,
+            meta={"day": _day.isoformat(), "chat_id": chat_id, "model_name": model_name},
             disable_thinking=_disable_thinking,
             user_id=user_id,
         )
         if invalid_ids:
             logs.warning(f"Invalid ids found: {invalid_ids}")
 
-        request_meta = {
-            "run_id": run_id,
-            "meta": {
-                "day": _day.isoformat(),
-                "chat_id": chat_id,
-                "model_name": model_name,
-                "invalid_ids": list(invalid_ids) if invalid_ids else None,
-                "missing_ids": list(missing_ids) if missing_ids else None,
-            },
-        }
-        await Requests.update(conn, request_meta)
-
-        group_meta = {"day": _day.isoformat()}
         for discussion in track(discussions, disable=not show_progress, show_speed=True, description="Discussions..."):
             _group = MessageGroup(
                 chat_id=chat_id,
@@ -471,8 +481,8 @@ async def run_group_messages(
                 summary=discussion["summary"],
                 title=discussion["title"],
                 internal_code=get_unique_identifier(discussion["ids"], _day.isoformat() + str(run_id)),
-                meta=group_meta,
                 run_id=run_id,
+                day=_day,
             )
             _group_id = await _group.upsert(conn)
             _group_messages = (
@@ -482,6 +492,9 @@ async def run_group_messages(
             if len(discussion["ids"]) < NB_MIN_MESSAGES:
                 logs.warning(f"Discussion {discussion['title']} has less than {NB_MIN_MESSAGES} messages")
 
+        if _day in pending_days:
+            await DbChat.clear_pending_days(conn, chat_id=chat_id, days=[_day])
+
         nb_discussions += len(discussions)
         nb_input_tokens += token["input"]
         nb_output_tokens += token["output"]
@@ -25,6 +25,7 @@ DEFAULT_EMBEDDING_MODEL = "mistral-embed"
 
 class EmbeddingGroup(TypedDict):
     id: int
+    chat_id: int
     title: str
     summary: str
     messages: list[str]
@@ -44,26 +45,27 @@ async def get_groups(
 ) -> list[EmbeddingGroup]:
     query = """
             SELECT g.id,
+                   g.chat_id,
                    g.summary,
                    g.title,
                    msg.messages,
-                   (g.meta ->> 'day')::DATE AS day,
-                   c.created_by             AS user_id
+                   g.day,
+                   c.created_by AS user_id
             FROM ai.message_groups g
                      LEFT JOIN general.chats c ON c.id = g.chat_id
                      LEFT JOIN LATERAL (
                 SELECT ARRAY_AGG(cm.message ORDER BY cm.sent_at) AS messages
                 FROM ai.message_group_chats m
-                         LEFT JOIN general.chat_messages cm ON cm.id = m.msg_id
+                         LEFT JOIN general.chat_messages cm ON cm.id = m.msg_id AND cm.chat_id = m.chat_id
                 WHERE m.group_id = g.id
                   AND cm.message <> ''
                 ) msg ON TRUE
                      LEFT JOIN ai.mistral_group_embeddings e ON e.group_id = g.id
             WHERE ($1 IS TRUE OR e.embedding IS NULL)
-              AND ($2::DATE[] IS NULL OR (g.meta ->> 'day')::DATE = ANY ($2))
-              AND ($3::DATE IS NULL OR (g.meta ->> 'day')::DATE >= $3)
+              AND ($2::DATE[] IS NULL OR g.day = ANY ($2))
+              AND ($3::DATE IS NULL OR g.day >= $3)
               AND g.chat_id = $4
-            ORDER BY g.meta ->> 'day'
+            ORDER BY g.day
             """
     data = await conn.fetch(
         query,
@@ -98,7 +100,7 @@ async def gen_groups_embeddings(
                     f"Number of embeddings {len(embeddings)} does not match number of groups {len(all_inputs)}"
                 )
             embeddings = [
-                MistralGroupEmbeddings(group_id=group["id"], embedding=embedding)
+                MistralGroupEmbeddings(group_id=group["id"], chat_id=group["chat_id"], embedding=embedding)
                 for group, embedding in zip(groups, embeddings)
             ]
             await MistralGroupEmbeddings.bulk_save(conn, embeddings=embeddings)
@@ -124,6 +126,7 @@ async def gen_group_embeddings(
         embeddings, tokens = await mistral.fetch_embeddings(session, inputs=inputs)
         await MistralGroupEmbeddings(
             group_id=group["id"],
+            chat_id=group["chat_id"],
             embedding=embeddings[0],
         ).save(conn)
     else:
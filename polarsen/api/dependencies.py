@@ -1,20 +1,11 @@
-import json
 from contextlib import asynccontextmanager
 
 import asyncpg
 import niquests
+from polarsen.pg import init_connection
 from polarsen.s3_utils import get_s3_client as _get_s3_client
 
-__all__ = ("connect_pg", "get_conn", "get_client", "init_connection", "get_s3_client")
-
-
-async def init_connection(conn: asyncpg.Connection):
-    """
-    Initialize the PostgreSQL connection with custom type codecs.
-    """
-    await conn.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
-    await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
-    await conn.set_type_codec("vector", encoder=json.dumps, decoder=json.loads, schema="public")
+__all__ = ("connect_pg", "get_conn", "get_pool", "get_client", "init_connection", "get_s3_client")
 
 
 PG_POOL: asyncpg.Pool | None = None
@@ -51,6 +42,15 @@ async def get_conn():
         yield conn
 
 
+async def get_pool() -> asyncpg.Pool:
+    """
+    Get the PostgreSQL connection pool, for endpoints that only need a connection for part of the request.
+    """
+    if PG_POOL is None:
+        raise RuntimeError("Database connection pool is not initialized. Use connect_pg context manager first.")
+    return PG_POOL
+
+
 async def get_client():
     async with niquests.AsyncSession() as session:
         yield session
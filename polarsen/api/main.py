@@ -1,4 +1,6 @@
+import datetime as dt
 import os
+import re
 from contextlib import asynccontextmanager
 from typing import Any
 import asyncpg
@@ -10,14 +12,25 @@ from starlette import status
 
 from polarsen.common.chat import ChatSession, set_auth_headers
 from polarsen.logs import logs
+from polarsen.compression import UPLOAD_MIME_TYPES, zstd_compress_stream
 from polarsen.s3_utils import s3_file_upload, s3_delete_object
 from polarsen.utils import compute_md5
 from polarsen import env
 from .data import User as UserDB, Question as QuestionDB
-from polarsen.db import ChatUpload as ChatUploadDB
-from .dependencies import connect_pg, get_conn, get_client, get_s3_client
-from .models import NewUser, User, AIModel, AskQuestion, EmbeddingResult, Status, ChatUpload, ChatType
-from .utils import APIException, get_user, ErrorCode
+from polarsen.db import ChatUpload as ChatUploadDB, VectorSearchParams
+from .dependencies import connect_pg, get_conn, get_pool, get_client, get_s3_client
+from .models import (
+    NewUser,
+    User,
+    AIModel,
+    AskQuestion,
+    EmbeddingResult,
+    Status,
+    ChatUpload,
+    ChatType,
+    ChatUploadCheck,
+)
+from .utils import APIException, get_user, ErrorCode, get_uploads_metrics
 
 
 VERSION = "0.1.0"
@@ -110,11 +123,22 @@ async def _ask_question(
     question: str,
     user_id: int,
     model: str,
+    ef_search: int | None = Query(
+        None, ge=1, le=1000, description="HNSW candidate list size of the context search, trades latency for recall"
+    ),
+    probes: int | None = Query(None, ge=1, description="IVFFlat lists scanned by the context search"),
     conn=Depends(get_conn),
     session=Depends(get_client),
 ) -> AskQuestion:
     """Ask a question regarding a chat."""
-    chat_sessions = ChatSession.get_session(model_name=model, api_key=api_key, rag_api_key=env.MISTRAL_API_KEY or "")
+    search_params: VectorSearchParams = {}
+    if ef_search is not None:
+        search_params["ef_search"] = ef_search
+    if probes is not None:
+        search_params["probes"] = probes
+    chat_sessions = ChatSession.get_session(
+        model_name=model, api_key=api_key, rag_api_key=env.MISTRAL_API_KEY or "", search_params=search_params
+    )
     chat_username = await UserDB.get_telegram_chat_username(conn, chat_id, user_id)
     with set_auth_headers(session, api_key):
         resp, debug = await chat_sessions.ask_rag(
@@ -140,6 +164,28 @@ async def _ask_question(
     return AskQuestion(response=resp, results=results, question_id=question_id)
 
 
+_MD5_RE = re.compile(r"[0-9a-f]{32}")
+
+
+def _already_uploaded_error(filename: str, user_id: int) -> APIException:
+    return APIException(
+        status_code=status.HTTP_409_CONFLICT,
+        reason=f"File {filename!r} already uploaded by user {user_id!r}",
+        error_code=ErrorCode.already_exists,
+    )
+
+
+@app.get("/chats/uploads/check", tags=[CHAT_TAG])
+async def _check_upload(
+    user_id: int,
+    md5: str = Query(..., description="Hex encoded MD5 of the file"),
+    conn=Depends(get_conn),
+) -> ChatUploadCheck:
+    """Check if a file has already been uploaded by the user, before uploading it."""
+    file_id = await ChatUploadDB.get_id_by_md5(conn, user_id=user_id, md5=md5.lower())
+    return ChatUploadCheck(exists=file_id is not None, file_id=file_id)
+
+
 @app.post("/chats/upload", tags=[CHAT_TAG])
 async def _upload_chat(
     request: Request,
@@ -147,11 +193,14 @@ async def _upload_chat(
     filename: str,
     mime_type: str,
     chat_type: ChatType,
-    conn=Depends(get_conn),
+    pool=Depends(get_pool),
     s3=Depends(get_s3_client),
     session=Depends(get_client),
 ) -> ChatUpload:
-    """Upload a chat file."""
+    """
+    Upload a chat file, either as JSON or compressed with zip or zstd.
+    JSON files are stored compressed with zstd.
+    """
     # TODO: Fix that later and use Content-Length
     _content_length = request.headers.get("X-Content-Length")
     if _content_length is None:
@@ -161,66 +210,103 @@ async def _upload_chat(
             error_code=ErrorCode.invalid_headers,
         )
     content_length = int(_content_length)
-    get_hash, update_hash = compute_md5()
-
-    file_path = f"{user_id}/{filename}"
-
-    _chat_type = await conn.fetchrow(
-        """
-                                       SELECT id, name
-                                       FROM general.chat_types
-                                       WHERE internal_code = $1
-                                       """,
-        chat_type,
-    )
-    if _chat_type is None:
+    if mime_type not in UPLOAD_MIME_TYPES:
         raise APIException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            reason=f"Invalid chat type {chat_type!r}",
-            error_code=ErrorCode.invalid_token,
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            reason=f"Unsupported file type {mime_type!r}, expected one of {', '.join(UPLOAD_MIME_TYPES)}",
+            error_code=ErrorCode.invalid_file,
         )
-    chat_type_id = _chat_type["id"]
+    # Optional MD5 of the file sent by the client, to reject duplicates before receiving the file
+    content_md5 = request.headers.get("X-Content-MD5")
+    if content_md5 is not None:
+        content_md5 = content_md5.lower()
+        if not _MD5_RE.fullmatch(content_md5):
+            raise APIException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                reason="Invalid X-Content-MD5 header, expected an hex encoded MD5",
+                error_code=ErrorCode.invalid_headers,
+            )
     bucket = env.CHAT_UPLOADS_S3_BUCKET
     if not bucket:
         raise ValueError("CHAT_UPLOADS_S3_BUCKET must be set")
-    async with conn.transaction():
-        await s3_file_upload(
-            s3,
-            session,
-            data=request.stream(),
-            bucket=bucket,
-            key=file_path,
-            on_chunk_received=update_hash,
-            content_length=content_length,
-            # content_length=int(content_length) if content_length is not None else None
+
+    # Connections are only held for the checks and to save the upload, not while the file is received,
+    # so slow uploads do not starve the pool. Objects uploaded but never saved are removed
+    # by `chat clean-orphan-uploads`.
+    async with pool.acquire() as conn:
+        _chat_type = await conn.fetchrow(
+            """
+            SELECT id, name
+            FROM general.chat_types
+            WHERE internal_code = $1
+            """,
+            chat_type,
         )
-        try:
-            file_hash = get_hash()
-            chat_upload = ChatUploadDB(
-                user_id=user_id,
-                filename=filename,
-                md5=file_hash,
-                mime_type=mime_type,
-                file_path=file_path,
-                file_size=content_length,
-                chat_type_id=chat_type_id,
+        if _chat_type is None:
+            raise APIException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                reason=f"Invalid chat type {chat_type!r}",
+                error_code=ErrorCode.invalid_token,
+            )
+        if content_md5 is not None and await ChatUploadDB.get_id_by_md5(conn, user_id=user_id, md5=content_md5):
+            raise _already_uploaded_error(filename, user_id)
+    chat_type_id = _chat_type["id"]
+
+    get_hash, update_hash = compute_md5()
+
+    file_path = f"{user_id}/{filename}"
+
+    async def _received_data():
+        # The hash is the one of the file as uploaded, to detect duplicates
+        async for chunk in request.stream():
+            update_hash(chunk)
+            yield chunk
+
+    data = _received_data()
+    compression = UPLOAD_MIME_TYPES[mime_type]
+    if compression is None:
+        data, compression = zstd_compress_stream(data), "zstd"
+        file_path += ".zst"
+
+    await s3_file_upload(
+        s3,
+        session,
+        data=data,
+        bucket=bucket,
+        key=file_path,
+        # Upper bound of the stored size, used to upload small files at once
+        content_length=content_length,
+    )
+    try:
+        file_hash = get_hash()
+        if content_md5 is not None and file_hash != content_md5:
+            raise APIException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                reason=f"MD5 of the received file ({file_hash}) does not match X-Content-MD5",
+                error_code=ErrorCode.invalid_file,
             )
+        chat_upload = ChatUploadDB(
+            user_id=user_id,
+            filename=filename,
+            md5=file_hash,
+            mime_type=mime_type,
+            file_path=file_path,
+            file_size=content_length,
+            chat_type_id=chat_type_id,
+            compression=compression,
+        )
+        async with pool.acquire() as conn:
             try:
                 file_id = await chat_upload.save(conn)
             except asyncpg.UniqueViolationError:
-                raise APIException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    reason=f"File {filename!r} already uploaded by user {user_id!r}",
-                    error_code=ErrorCode.already_exists,
-                )
-        except Exception as e:
-            # TODO: Remove the uploaded file from S3 if database operation fails
-            try:
-                await s3_delete_object(s3=s3, client=session, bucket=bucket, key=file_path)
-            except Exception as e2:
-                logs.warning(f"Failed to delete S3 object {file_path!r}")
-                raise e2 from e
-            raise e
+                raise _already_uploaded_error(filename, user_id)
+    except Exception as e:
+        try:
+            await s3_delete_object(s3=s3, client=session, bucket=bucket, key=file_path)
+        except Exception as e2:
+            logs.warning(f"Failed to delete S3 object {file_path!r}")
+            raise e2 from e
+        raise e
     logs.info(f"Uploaded file {filename!r} for user {user_id} to {file_path!r}")
 
     return ChatUpload(
@@ -233,6 +319,16 @@ async def _upload_chat(
     )
 
 
+@app.get("/chats/uploads/metrics", tags=[CHAT_TAG])
+async def _get_uploads_metrics(
+    from_date: dt.datetime | None = Query(None, description="Only the uploads processed since this date"),
+    limit: int = Query(1000, ge=1, le=10_000),
+    conn=Depends(get_conn),
+) -> list[ChatUpload]:
+    """List the processed uploads with their ingest metrics, to track the ingest throughput over time."""
+    return await get_uploads_metrics(conn, from_date=from_date, limit=limit)
+
+
 @app.patch("/questions/{question_id}", tags=[CHAT_TAG])
 async def _update_question(question_id: int, feedback: str, conn=Depends(get_conn)) -> Status:
     """Update a question with feedback."""
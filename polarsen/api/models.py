@@ -8,7 +8,19 @@ from pydantic import BaseModel
 from polarsen.common.utils import AISource
 from .data import UserMeta
 
-__all__ = ("NewUser", "Chat", "User", "EmbeddingResult", "AskQuestion", "AIModel", "Status", "ChatType", "ChatUpload")
+__all__ = (
+    "NewUser",
+    "Chat",
+    "User",
+    "EmbeddingResult",
+    "AskQuestion",
+    "AIModel",
+    "Status",
+    "ChatType",
+    "ChatUpload",
+    "ChatUploadMetrics",
+    "ChatUploadCheck",
+)
 
 
 class NewUser(BaseModel):
@@ -59,6 +71,25 @@ class Status(BaseModel):
     message: str | None
 
 
+class ChatUploadCheck(BaseModel):
+    exists: bool
+    file_id: int | None = None
+
+
+class ChatUploadMetrics(BaseModel):
+    """Ingest metrics of an upload, see `polarsen.db.UploadMetrics`"""
+
+    bytes_downloaded: int | None = None
+    download_ms: int | None = None
+    parse_ms: int | None = None
+    messages_parsed: int | None = None
+    messages_skipped: int | None = None
+    messages_already_saved: int | None = None
+    rows_inserted: int | None = None
+    db_ms: int | None = None
+    process_peak_rss_kb: int | None = None
+
+
 class ChatUpload(BaseModel):
     file_id: int
     filename: str
@@ -66,6 +97,8 @@ class ChatUpload(BaseModel):
     created_at: dt.datetime
     chat_type: str
     processed_at: dt.datetime | None
+    status: str | None = None
+    metrics: ChatUploadMetrics | None = None
 
 
 ChatType = Literal["telegram"]
@@ -1,3 +1,4 @@
+import datetime as dt
 import textwrap
 from enum import Enum
 from typing import Any
@@ -13,6 +14,7 @@ __all__ = (
     "ErrorCode",
     "get_user",
     "get_user_chats",
+    "get_uploads_metrics",
     "check_32_bit",
 )
 
@@ -109,7 +111,9 @@ async def get_user_uploads(conn: asyncpg.Connection, user_id: int) -> list[ChatU
                cu.file_path,
                cu.created_at,
                ct.name as chat_type,
-               cu.processed_at
+               cu.processed_at,
+               cu.meta ->> 'status' as status,
+               cu.meta -> 'metrics' as metrics
         FROM general.chat_uploads cu
         left join general.chat_types ct on cu.chat_type_id = ct.id
         WHERE user_id = $1
@@ -120,6 +124,33 @@ async def get_user_uploads(conn: asyncpg.Connection, user_id: int) -> list[ChatU
     return [_UploadTypeAdapter.validate_python(upload) for upload in uploads]
 
 
+async def get_uploads_metrics(
+    conn: asyncpg.Connection, from_date: dt.datetime | None = None, limit: int = 1000
+) -> list[ChatUpload]:
+    """Get the processed uploads with their ingest metrics, most recently processed first."""
+    uploads = await conn.fetch(
+        """
+        SELECT cu.id as file_id,
+               cu.filename,
+               cu.file_path,
+               cu.created_at,
+               ct.name as chat_type,
+               cu.processed_at,
+               cu.meta ->> 'status' as status,
+               cu.meta -> 'metrics' as metrics
+        FROM general.chat_uploads cu
+        left join general.chat_types ct on cu.chat_type_id = ct.id
+        WHERE cu.processed_at IS NOT NULL
+          AND ($1::timestamptz IS NULL OR cu.processed_at >= $1)
+        ORDER BY cu.processed_at desc
+        LIMIT $2
+        """,
+        from_date,
+        limit,
+    )
+    return [_UploadTypeAdapter.validate_python(upload) for upload in uploads]
+
+
 _GET_USER_QUERY = """
                   select id,
                          first_name,
@@ -156,6 +156,16 @@ async def handle_message(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(user.t("unknown_command"))
 
 
+# Chat exports, as JSON or compressed with zip or zstd
+_CHAT_EXPORT_FILTER = (
+    filters.Document.MimeType("application/json")
+    | filters.Document.MimeType("application/zip")
+    | filters.Document.MimeType("application/x-zip-compressed")
+    | filters.Document.MimeType("application/zstd")
+    | filters.Document.FileExtension("zst")
+)
+
+
 @handle_errors
 async def handle_file_upload(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_user:
@@ -186,7 +196,13 @@ async def handle_file_upload(update: Update, _: ContextTypes.DEFAULT_TYPE) -> No
             )
             return
         url = file._get_encoded_url()
-        await upload_chat(url, filename=document.file_name, mime_type=document.mime_type, user_id=user.id)
+        # Telegram clients do not always know zstd files
+        mime_type = "application/zstd" if document.file_name.endswith(".zst") else document.mime_type
+        chat_upload = await upload_chat(url, filename=document.file_name, mime_type=mime_type, user_id=user.id)
+        if chat_upload is None:
+            user.state = UserState.NORMAL
+            await update.message.reply_text(user.t("chat_already_uploaded"))
+            return
 
         # Handle chat upload logic here
         # For now, just acknowledge the upload
@@ -470,7 +486,7 @@ async def run_bot(token: str, shutdown_event: asyncio.Event) -> None:
         CommandHandler(["add_chat"], upload_chat_handler),
         CallbackQueryHandler(handle_callback_queries),
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message),
-        MessageHandler(filters.Document.MimeType("application/json"), handle_file_upload),  # Handle document uploads
+        MessageHandler(_CHAT_EXPORT_FILTER, handle_file_upload),  # Handle document uploads
     ]
     for handler in handlers:
         if isinstance(handler, CommandHandler):
@@ -1,4 +1,4 @@
-import typing
+import hashlib
 from dataclasses import dataclass, field
 from enum import Enum
 from typing import TypedDict
@@ -181,34 +181,21 @@ async def give_feedback(question_id: int, feedback: str) -> models.Status:
     return _StatusTypeAdapter.validate_python(_check_response(resp))
 
 
-async def download_telegram_file(
-    session: niquests.AsyncSession,
-    url: str,
-    chunk_size: int = -1,
-) -> tuple[typing.AsyncIterable[bytes], int | None]:
-    resp = await session.get(url, stream=True)
-    content_length = resp.headers.get("Content-Length")
+async def download_telegram_file(session: niquests.AsyncSession, url: str) -> bytes:
+    """Download a file sent to the bot, bots can only download files of up to 20MB so it is kept in memory."""
+    resp = await session.get(url)
     resp.raise_for_status()
-
-    # Parse content_length to int if available
-    parsed_content_length = int(content_length) if content_length is not None else None
-
-    async def chunk_generator():
-        total_length = 0
-        content = await resp.iter_content(chunk_size=chunk_size)
-        async for chunk in content:
-            total_length += len(chunk)
-            yield chunk
-
-    return chunk_generator(), parsed_content_length
+    return resp.content
 
 
 _ChatUploadValidator = TypeAdapter(models.ChatUpload)
+_ChatUploadCheckValidator = TypeAdapter(models.ChatUploadCheck)
 
 
-async def upload_chat(url: str, user_id: int, filename: str, mime_type: str) -> models.ChatUpload:
+async def upload_chat(url: str, user_id: int, filename: str, mime_type: str) -> models.ChatUpload | None:
     """
     Upload a chat file to the server.
+    Returns None without uploading it if the user has already uploaded the same file.
     """
     params = {
         "user_id": str(user_id),
@@ -217,8 +204,12 @@ async def upload_chat(url: str, user_id: int, filename: str, mime_type: str) ->
         "chat_type": "telegram",
     }
     async with AsyncSession() as session:
-        data, total_content_length = await download_telegram_file(session, url)
-        headers = {"X-Content-Length": str(total_content_length)} if total_content_length is not None else None
+        data = await download_telegram_file(session, url)
+        md5 = hashlib.md5(data).hexdigest()
+        resp = await session.get(f"{API_URI}/chats/uploads/check", params={"user_id": str(user_id), "md5": md5})
+        if _ChatUploadCheckValidator.validate_python(_check_response(resp))["exists"]:
+            return None
+        headers = {"X-Content-Length": str(len(data)), "X-Content-MD5": md5}
 
         resp = await session.post(f"{API_URI}/chats/upload", data=data, headers=headers, params=params)
 
@@ -27,6 +27,25 @@ class ChatUpload(TypedDict):
     created_at: str
     chat_type: str
     processed_at: Optional[str]
+    status: NotRequired[Optional[str]]
+    metrics: NotRequired[Optional[ChatUploadMetrics]]
+
+
+class ChatUploadCheck(TypedDict):
+    exists: bool
+    file_id: NotRequired[Optional[int]]
+
+
+class ChatUploadMetrics(TypedDict):
+    bytes_downloaded: NotRequired[Optional[int]]
+    download_ms: NotRequired[Optional[int]]
+    parse_ms: NotRequired[Optional[int]]
+    messages_parsed: NotRequired[Optional[int]]
+    messages_skipped: NotRequired[Optional[int]]
+    messages_already_saved: NotRequired[Optional[int]]
+    rows_inserted: NotRequired[Optional[int]]
+    db_ms: NotRequired[Optional[int]]
+    process_peak_rss_kb: NotRequired[Optional[int]]
 
 
 class EmbeddingResult(TypedDict):
@@ -2,6 +2,7 @@ from collections.abc import Mapping
 
 import asyncpg
 
+from .bench import bench_group
 from .db import db_group
 from .embeddings import ai_group
 from .run import chat_group
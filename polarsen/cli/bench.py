@@ -0,0 +1,684 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import datetime as dt
+import gc
+import itertools
+import json
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator
+
+import asyncpg
+import niquests
+from piou import CommandGroup, Option, Derived
+from rich.console import Console
+from rich.table import Table
+from tracktolib.pg import insert_returning
+
+from polarsen import env
+from polarsen.db.ai import MISTRAL_EMBED_VECTOR_SIZE, MistralGroupEmbeddings, VectorIndexMethod, VectorSearchParams
+from polarsen.db.chat import (
+    TelegramGroup,
+    TelegramMessage,
+    IngestMode,
+    INGEST_BATCH_SIZE,
+    DBChatMessage,
+    DEFAULT_INGEST_MODE,
+    fmt_text,
+)
+from polarsen.pg import get_conn, init_connection, encode_vector, decode_vector, encode_jsonb, decode_jsonb
+from polarsen.s3_utils import get_s3_client, s3_file_upload, s3_delete_object
+from polarsen.utils import get_pg_url, get_stream_chunk, iter_bytes
+
+__all__ = ("bench_group",)
+
+bench_group = CommandGroup("bench", help="Benchmark commands")
+
+_INGEST_MODES: tuple[IngestMode, ...] = ("insert", "copy")
+
+
+def _gen_messages(nb_messages: int, nb_users: int = 100, reply_ratio: float = 0.2) -> list[TelegramMessage]:
+    """Generate `nb_messages` synthetic messages, `reply_ratio` of them replying to a previous message."""
+    rng = random.Random(nb_messages)
+    start = dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+    messages = []
+    for i in range(1, nb_messages + 1):
+        user_id = rng.randint(1, nb_users)
+        messages.append(
+            TelegramMessage(
+                chat_id=i,
+                message_id=i,
+                message_type="message",
+                message_date=start + dt.timedelta(seconds=i * 30),
+                from_user_id=f"user{user_id}",  # type: ignore[arg-type]
+                from_user=f"User {user_id}",
+                text=f"Message {i} " + "lorem ipsum " * rng.randint(1, 20),
+                reply_to_message_id=rng.randint(1, i - 1) if i > 1 and rng.random() < reply_ratio else None,
+            )
+        )
+    return messages
+
+
+@contextlib.asynccontextmanager
+async def _rolled_back_user(conn: asyncpg.Connection) -> AsyncIterator[int]:
+    """Start a transaction with a new benchmark user and yield its ID. Everything is rolled back on exit."""
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        yield await insert_returning(conn, "general.users", {"internal_code": f"bench-{uuid.uuid4()}"}, returning="id")
+    finally:
+        await tr.rollback()
+
+
+async def _time_write(
+    conn: asyncpg.Connection, messages: list[TelegramMessage], mode: IngestMode, batch_size: int
+) -> float:
+    """Save `messages` in a new chat with the given `mode` and return the duration. Everything is rolled back."""
+    async with _rolled_back_user(conn) as user_id:
+        group = TelegramGroup(name="Benchmark", group_type="private_group", group_id=random.randint(1, 2**62))
+        chat_id = await group.save_chat(conn, created_by=user_id)
+        start = time.perf_counter()
+        for batch in itertools.batched(messages, batch_size):
+            await group.save_messages(conn, chat_id=chat_id, messages=list(batch), mode=mode)
+        return time.perf_counter() - start
+
+
+@bench_group.command("ingest-write", help="Compare the insert and COPY write paths of chat messages")
+async def _bench_ingest_write(
+    sizes: str = Option("10000,100000,1000000", "--sizes", help="Comma separated number of messages"),
+    batch_size: int = Option(INGEST_BATCH_SIZE, "--batch-size", help="Number of messages saved at once"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Time the write of synthetic chats with each ingest mode.
+    Nothing is persisted: each run is rolled back.
+    """
+    table = Table("Messages", "Mode", "Duration (s)", "Rows/s")
+    async with get_conn(pg_url) as conn:
+        for size in (int(x) for x in sizes.split(",")):
+            messages = _gen_messages(size)
+            for mode in _INGEST_MODES:
+                duration = await _time_write(conn, messages, mode=mode, batch_size=batch_size)
+                table.add_row(f"{size:,}", mode, f"{duration:.2f}", f"{size / duration:,.0f}")
+    Console().print(table)
+
+
+@dataclasses.dataclass
+class _LegacyTextEntity:
+    type: str
+    text: str
+    user_id: int | None = None
+    document_id: str | None = None
+
+
+@dataclasses.dataclass
+class _LegacyTelegramMessage:
+    """The message model used before `TelegramMessage` was made compact, kept as a benchmark reference."""
+
+    chat_id: int
+    message_id: int
+    message_type: str
+    message_date: dt.datetime
+    from_user_id: int
+    from_user: str
+    text: str
+    text_entities: list[_LegacyTextEntity] = dataclasses.field(default_factory=list)
+    reply_to_message_id: int | None = None
+
+    @classmethod
+    def load(cls, chat_id: int, msg: dict):
+        if msg.get("action") is not None:
+            return
+        return cls(
+            chat_id=chat_id,
+            message_id=msg["id"],
+            message_type=msg["type"],
+            message_date=dt.datetime.fromisoformat(msg["date"]),
+            from_user_id=msg["from_id"],
+            from_user=msg["from"],
+            text=fmt_text(msg["text"]),
+            text_entities=[_LegacyTextEntity(**te) for te in msg["text_entities"]],
+            reply_to_message_id=msg.get("reply_to_message_id"),
+        )
+
+    def to_db_row(self, chat_id: int, chat_user_id: int, reply_to_chat_id: int | None, db_id: int) -> tuple:
+        _message = DBChatMessage(
+            chat_id=chat_id,
+            internal_code=str(self.message_id),
+            sent_at=self.message_date,
+            message=self.text,
+            chat_user_id=chat_user_id,
+            reply_to_id=reply_to_chat_id,
+        )
+        _message._id = db_id
+        return _message.row
+
+
+def _measure_model(raw_messages: list[dict], load: Callable[[int, dict], object]) -> tuple[float, float, float]:
+    """
+    Load `raw_messages` with `load` then convert them to DB rows.
+    Returns the memory used by the loaded messages (bytes per message), the load and the conversion rates (msg/s).
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    messages = [m for msg in raw_messages if (m := load(msg["id"], msg)) is not None]
+    load_duration = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for i, m in enumerate(messages):
+        m.to_db_row(chat_id=1, chat_user_id=1, reply_to_chat_id=None, db_id=i)  # type: ignore[attr-defined]
+    convert_duration = time.perf_counter() - start
+    nb_messages = len(raw_messages)
+    return memory / nb_messages, nb_messages / load_duration, nb_messages / convert_duration
+
+
+@bench_group.command("message-model", help="Compare the memory and throughput of the ingest message models")
+async def _bench_message_model(
+    size: int = Option(1_000_000, "--size", help="Number of messages"),
+):
+    """
+    Load synthetic export messages with the previous (dataclass with text entities)
+    and the current (slotted, without text entities) message models, then convert them to DB rows.
+    Memory is measured with tracemalloc, which slows down loading.
+    """
+    raw_messages = list(_iter_export_messages(size))
+    table = Table("Model", "Bytes/message", "Load (msg/s)", "To DB rows (msg/s)")
+    models = [("previous", _LegacyTelegramMessage.load), ("current", TelegramMessage.load)]
+    for name, load in models:
+        memory, load_rate, convert_rate = _measure_model(raw_messages, load)
+        table.add_row(name, f"{memory:,.0f}", f"{load_rate:,.0f}", f"{convert_rate:,.0f}")
+    Console().print(table)
+
+
+_WORDS = (
+    "le la les un une des et ou mais donc pour avec sans sur dans chez demain hier ce soir matin "
+    "rendez-vous projet réunion train vacances photo lien merci bravo super ok oui non peut-être "
+    "the a and meeting tomorrow tonight link thanks great sure maybe 🙂 👍 😂 🎉"
+).split()
+_ENTITY_TYPES = ("bold", "italic", "code", "link", "hashtag", "mention_name")
+_ACTIONS = ("join_group_by_link", "invite_members", "remove_members", "pin_message", "edit_group_title")
+
+
+def _iter_export_messages(
+    nb_messages: int,
+    nb_users: int = 500,
+    reply_ratio: float = 0.2,
+    entity_ratio: float = 0.1,
+    action_ratio: float = 0.01,
+    seed: int = 0,
+) -> Iterator[dict]:
+    """
+    Generate `nb_messages` messages shaped like the ones of a Telegram `result.json` export:
+    - messages are sent by `nb_users` users (weighted, as a few users usually send most messages)
+    - `reply_ratio` of them reply to one of the recent messages, which builds reply chains
+    - `entity_ratio` of them have formatted text (a list of strings and entities)
+    - `action_ratio` of them are service messages (joins, pins, ...)
+    """
+    rng = random.Random(seed)
+    users = [(f"user{1_000_000 + i}", f"User {i}") for i in range(nb_users)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(nb_users)))
+    date = dt.datetime(2020, 1, 1, 8)
+    recent_ids: collections.deque[int] = collections.deque(maxlen=50)
+    for message_id in range(1, nb_messages + 1):
+        from_id, from_name = rng.choices(users, cum_weights=cum_weights)[0]
+        date += dt.timedelta(seconds=rng.randint(1, 900))
+        msg: dict = {
+            "id": message_id,
+            "date": date.isoformat(),
+            "date_unixtime": str(int(date.replace(tzinfo=dt.UTC).timestamp())),
+        }
+        if rng.random() < action_ratio:
+            msg |= {
+                "type": "service",
+                "actor": from_name,
+                "actor_id": from_id,
+                "action": rng.choice(_ACTIONS),
+                "text": "",
+                "text_entities": [],
+            }
+            yield msg
+            continue
+        words = rng.choices(_WORDS, k=rng.randint(1, 40))
+        if rng.random() < entity_ratio:
+            i = rng.randrange(len(words))
+            entity: dict = {"type": rng.choice(_ENTITY_TYPES), "text": words[i]}
+            if entity["type"] == "mention_name":
+                _user_id, entity["text"] = rng.choice(users)
+                entity["user_id"] = int(_user_id.removeprefix("user"))
+            before, after = " ".join(words[:i]) + " ", " " + " ".join(words[i + 1 :])
+            text: str | list = [before, entity, after]
+            text_entities = [{"type": "plain", "text": before}, entity, {"type": "plain", "text": after}]
+        else:
+            text = " ".join(words)
+            text_entities = [{"type": "plain", "text": text}]
+        msg |= {"type": "message", "from": from_name, "from_id": from_id, "text": text, "text_entities": text_entities}
+        if recent_ids and rng.random() < reply_ratio:
+            msg["reply_to_message_id"] = rng.choice(recent_ids)
+        recent_ids.append(message_id)
+        yield msg
+
+
+def _write_export(path: Path, nb_messages: int, seed: int = 0, **params) -> None:
+    """Write a synthetic Telegram export of `nb_messages` messages to `path`, one message at a time."""
+    rng = random.Random(seed)
+    header = {"name": f"Benchmark {nb_messages}", "type": "private_supergroup", "id": rng.randint(1, 2**40)}
+    with path.open("w", encoding="utf-8") as f:
+        f.write(json.dumps(header, ensure_ascii=False)[:-1] + ', "messages": [\n')
+        for i, msg in enumerate(_iter_export_messages(nb_messages, seed=seed, **params)):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(msg, ensure_ascii=False))
+        f.write("\n]}\n")
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident memory of the process (Linux reports it in KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@bench_group.command("gen-export", help="Generate a synthetic Telegram export")
+async def _bench_gen_export(
+    output: Path = Option(..., "--output", "-o", help="Path of the export to write"),
+    size: int = Option(100_000, "--size", help="Number of messages"),
+    nb_users: int = Option(500, "--users", help="Number of users"),
+    reply_ratio: float = Option(0.2, "--reply-ratio", help="Ratio of replies"),
+    action_ratio: float = Option(0.01, "--action-ratio", help="Ratio of service messages"),
+    seed: int = Option(0, "--seed", help="Random seed, the same seed generates the same export"),
+):
+    """
+    Generate a reproducible Telegram `result.json` export with reply chains, formatted text
+    and service messages, that can be ingested with `chat ingest-file`.
+    """
+    start = time.perf_counter()
+    _write_export(output, size, seed=seed, nb_users=nb_users, reply_ratio=reply_ratio, action_ratio=action_ratio)
+    Console().print(
+        f"Wrote {size:,} messages to {output} ({output.stat().st_size / 2**20:,.1f} MiB) "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+
+@bench_group.command("ingest", help="Benchmark the ingestion of Telegram exports")
+async def _bench_ingest(
+    sizes: str = Option("10000,100000,1000000", "--sizes", help="Comma separated number of messages"),
+    file: Path | None = Option(None, "--file", help="Existing export to ingest instead of synthetic ones"),
+    mode: IngestMode = Option(DEFAULT_INGEST_MODE, "--mode", help="How messages are written to the database"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Ingest synthetic exports (or `--file`) with `TelegramGroup.load` then `save`,
+    and report the parse and database durations, the throughput and the peak RSS.
+    Sizes are run in increasing order, as the peak RSS is the one of the whole process.
+    Nothing is persisted: each run is rolled back.
+    """
+    table = Table("Messages", "Parse (s)", "DB (s)", "Rows/s", "Peak RSS (MiB)")
+    async with get_conn(pg_url) as conn:
+        with tempfile.TemporaryDirectory(prefix="polarsen-bench-") as tmp_dir:
+            if file is not None:
+                exports = [file]
+            else:
+                exports = []
+                for size in sorted(int(x) for x in sizes.split(",")):
+                    exports.append(Path(tmp_dir) / f"export-{size}.json")
+                    _write_export(exports[-1], size)
+            for export in exports:
+                start = time.perf_counter()
+                group = TelegramGroup.load(json.loads(export.read_bytes()))
+                parse_duration = time.perf_counter() - start
+                async with _rolled_back_user(conn) as user_id:
+                    start = time.perf_counter()
+                    await group.save(conn, created_by=user_id, mode=mode)
+                    db_duration = time.perf_counter() - start
+                nb_rows = len(group.messages)
+                table.add_row(
+                    f"{nb_rows:,}",
+                    f"{parse_duration:.2f}",
+                    f"{db_duration:.2f}",
+                    f"{nb_rows / (parse_duration + db_duration):,.0f}",
+                    f"{_peak_rss_mb():,.0f}",
+                )
+                del group
+    Console().print(table)
+
+
+async def _legacy_get_stream_chunk(data_stream: AsyncIterator[bytes], min_part_size: int) -> AsyncIterator[bytes]:
+    """`get_stream_chunk` before it stopped concatenating bytes, kept as a benchmark reference."""
+    buffer: bytes = b""
+    async for chunk in data_stream:
+        buffer += chunk
+        while len(buffer) >= min_part_size * 2:
+            yield buffer[:min_part_size]
+            buffer = buffer[min_part_size:]
+    if buffer:
+        yield buffer
+
+
+async def _iter_zeros(size: int, chunk_size: int) -> AsyncIterator[bytes]:
+    """Yield `size` bytes as a stream of `chunk_size` chunks, a new object for each chunk like a network stream."""
+    for offset in range(0, size, chunk_size):
+        yield bytes(min(chunk_size, size - offset))
+
+
+@bench_group.command("chunker", help="Benchmark the assembly of S3 multipart upload parts")
+async def _bench_chunker(
+    size: int = Option(1024, "--size", help="Size of the stream in MiB"),
+    chunk_size: int = Option(64, "--chunk-size", help="Size of the received chunks in KiB"),
+    part_size: int = Option(5, "--part-size", help="Minimum size of the parts in MiB"),
+):
+    """
+    Stream `--size` MiB in `--chunk-size` KiB chunks through the previous (bytes concatenation)
+    and the current (memoryview) part assemblers of `s3_file_upload`, without uploading anything.
+    """
+    nb_bytes, min_part_size = size * 2**20, part_size * 2**20
+    table = Table("Assembler", "Parts", "Duration (s)", "Throughput (MiB/s)")
+    for name, chunker in [("previous", _legacy_get_stream_chunk), ("current", get_stream_chunk)]:
+        nb_parts = 0
+        start = time.perf_counter()
+        async for _ in chunker(_iter_zeros(nb_bytes, chunk_size * 1024), min_part_size=min_part_size):
+            nb_parts += 1
+        duration = time.perf_counter() - start
+        table.add_row(name, f"{nb_parts:,}", f"{duration:.2f}", f"{size / duration:,.0f}")
+    Console().print(table)
+
+
+async def _max_loop_lag(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Return the longest delay (in ms) the event loop took to wake up a `interval` sleep, until `stop` is set."""
+    max_lag = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - start - interval)
+    return max_lag * 1000
+
+
+@bench_group.command("s3-upload", help="Load test concurrent chat uploads to S3")
+async def _bench_s3_upload(
+    concurrency: str = Option("1,4,16,64", "--concurrency", help="Comma separated number of concurrent uploads"),
+    uploads: int = Option(64, "--uploads", help="Number of uploads per run"),
+    size: int = Option(6, "--size", help="Size of each upload in MiB"),
+    bucket: str | None = Option(env.CHAT_UPLOADS_S3_BUCKET, "--bucket", help="Bucket to upload to"),
+):
+    """
+    Upload `--uploads` files of `--size` MiB with `s3_file_upload` (as `POST /chats/upload` does),
+    with an increasing number of concurrent uploads, and report the throughput and the longest
+    event loop stall. Uploaded objects are deleted after each run.
+    """
+    if not bucket:
+        raise ValueError("--bucket or CHAT_UPLOADS_S3_BUCKET must be set")
+    data = random.Random(0).randbytes(size * 2**20)
+    table = Table("Concurrency", "Uploads/s", "MiB/s", "Max loop lag (ms)")
+    levels = [int(x) for x in concurrency.split(",")]
+    with get_s3_client() as s3:
+        # Each upload sends several parts at the same time
+        async with niquests.AsyncSession(pool_maxsize=max(levels) * env.S3_UPLOAD_CONCURRENCY) as session:
+            for nb_concurrent in levels:
+                run_id = uuid.uuid4()
+                keys = [f"bench/{run_id}/{i}" for i in range(uploads)]
+                semaphore = asyncio.Semaphore(nb_concurrent)
+
+                async def _upload(key: str):
+                    async with semaphore:
+                        await s3_file_upload(
+                            s3, session, bucket=bucket, key=key, data=iter_bytes(data), content_length=len(data)
+                        )
+
+                stop = asyncio.Event()
+                lag_task = asyncio.create_task(_max_loop_lag(stop))
+                start = time.perf_counter()
+                async with asyncio.TaskGroup() as tg:
+                    for key in keys:
+                        tg.create_task(_upload(key))
+                duration = time.perf_counter() - start
+                stop.set()
+                max_lag = await lag_task
+                table.add_row(
+                    str(nb_concurrent),
+                    f"{uploads / duration:,.1f}",
+                    f"{uploads * size / duration:,.0f}",
+                    f"{max_lag:.1f}",
+                )
+                for key in keys:
+                    await s3_delete_object(s3, session, bucket=bucket, key=key)
+    Console().print(table)
+
+
+_ANN_METHODS: tuple[VectorIndexMethod, ...] = ("hnsw", "ivfflat")
+
+
+async def _gen_group_embeddings(
+    conn: asyncpg.Connection, user_id: int, nb_groups: int, nb_chats: int, nb_clusters: int, noise: float
+) -> list[int]:
+    """
+    Save `nb_groups` message groups with random embeddings spread over `nb_chats` new chats and return the chat IDs.
+    Embeddings are drawn around `nb_clusters` random centroids (kept in `bench_centroids`), shared by all the chats,
+    as uniformly random vectors have no neighbourhood structure and are a worst case for ANN indexes.
+    """
+    run_id = uuid.uuid4()
+    method_id = await insert_returning(
+        conn, "ai.message_group_methods", {"name": "Benchmark", "internal_code": f"bench-{run_id}"}, returning="id"
+    )
+    chat_ids = [
+        x["id"]
+        for x in await conn.fetch(
+            """
+            insert into general.chats (internal_code, name, created_by)
+            select $1 || '-' || c, 'Benchmark ' || c, $2
+            from generate_series(1, $3) c
+            returning id
+            """,
+            f"bench-{run_id}",
+            user_id,
+            nb_chats,
+        )
+    ]
+    await conn.execute(
+        """
+        insert into ai.message_groups (group_method_id, internal_code, chat_id)
+        select $1, i::text, ($2::bigint[])[1 + i % cardinality($2::bigint[])]
+        from generate_series(1, $3) i
+        """,
+        method_id,
+        chat_ids,
+        nb_groups,
+    )
+    await conn.execute(
+        """
+        create temp table bench_centroids on commit drop as
+        select c as id, array_agg(random() * 2 - 1 order by d) as v
+        from generate_series(0, $1 - 1) c,
+             generate_series(1, $2) d
+        group by c
+        """,
+        nb_clusters,
+        MISTRAL_EMBED_VECTOR_SIZE,
+    )
+    await conn.execute(
+        """
+        insert into ai.mistral_group_embeddings (group_id, chat_id, embedding)
+        select g.id, g.chat_id, (select array_agg(x + (random() * 2 - 1) * $2 order by o)
+                      from unnest(c.v) with ordinality u(x, o))::vector
+        from ai.message_groups g
+                 join bench_centroids c on c.id = abs(hashint8(g.id)) % $3
+        where g.group_method_id = $1
+        """,
+        method_id,
+        noise,
+        nb_clusters,
+    )
+    return chat_ids
+
+
+async def _gen_query_embeddings(conn: asyncpg.Connection, nb_queries: int, noise: float) -> list[list[float]]:
+    """Draw `nb_queries` embeddings around random centroids of `bench_centroids`."""
+    return await conn.fetchval(
+        """
+        select array_agg((select array_agg(x + (random() * 2 - 1) * $2 order by o)
+                          from unnest(c.v) with ordinality u(x, o))::vector::text)
+        from generate_series(1, $1) q
+                 join bench_centroids c on c.id = (q * 7919) % (select count(*) from bench_centroids)
+        """,
+        nb_queries,
+        noise,
+    )
+
+
+async def _time_searches(
+    conn: asyncpg.Connection,
+    queries: list[tuple[list[float], int]],
+    k: int,
+    params: VectorSearchParams | None = None,
+) -> tuple[list[set[int]], list[float]]:
+    """Run the nearest groups search for each `(embedding, chat_id)` query, return the group IDs and durations (ms)."""
+    results, durations = [], []
+    for embedding, chat_id in queries:
+        start = time.perf_counter()
+        rows = await MistralGroupEmbeddings.search_nearest(conn, embedding, chat_id, limit=k, params=params)
+        durations.append((time.perf_counter() - start) * 1000)
+        results.append({x["group_id"] for x in rows})
+    return results, durations
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percentile), len(values) - 1)]
+
+
+@bench_group.command("ann", help="Benchmark the recall and latency of the group embeddings ANN indexes")
+async def _bench_ann(
+    sizes: str = Option("100000,1000000", "--sizes", help="Comma separated number of groups"),
+    methods: str = Option("hnsw,ivfflat", "--methods", help="Comma separated index methods"),
+    ef_search: str = Option("20,40,100,200", "--ef-search", help="Comma separated HNSW ef_search values"),
+    probes: str = Option("1,10,40", "--probes", help="Comma separated IVFFlat probes values"),
+    k: int = Option(10, "--k", help="Number of neighbours searched"),
+    nb_queries: int = Option(200, "--queries", help="Number of searches per setting"),
+    nb_chats: int = Option(10, "--chats", help="Number of chats the groups are spread over"),
+    nb_clusters: int = Option(1000, "--clusters", help="Number of clusters the embeddings are drawn around"),
+    noise: float = Option(0.3, "--noise", help="Spread of the embeddings around their cluster"),
+    maintenance_work_mem: str = Option("2GB", "--maintenance-work-mem", help="Memory available to index builds"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Generate synthetic group embeddings, build each ANN index and compare the searches of the RAG
+    (filtered on a chat) to an exact search: recall@k and p50/p95 latency for each ef_search/probes value.
+    Nothing is persisted, but the existing indexes of `ai.mistral_group_embeddings` are dropped
+    (and the table locked) until the run is rolled back: use a development database.
+    """
+    _methods = [x for x in methods.split(",") if x in _ANN_METHODS]
+    table = Table("Groups", "Index", "Build (s)", "Setting", f"Recall@{k}", "p50 (ms)", "p95 (ms)")
+    async with get_conn(pg_url) as conn:
+        for size in (int(x) for x in sizes.split(",")):
+            async with _rolled_back_user(conn) as user_id:
+                await conn.execute("select set_config('maintenance_work_mem', $1, true)", maintenance_work_mem)
+                await conn.execute("DROP INDEX IF EXISTS ai.mistral_group_embeddings_hnsw_idx")
+                await conn.execute("DROP INDEX IF EXISTS ai.mistral_group_embeddings_ivfflat_idx")
+                chat_ids = await _gen_group_embeddings(conn, user_id, size, nb_chats, nb_clusters, noise)
+                await conn.execute("ANALYZE ai.mistral_group_embeddings")
+                embeddings = await _gen_query_embeddings(conn, nb_queries, noise)
+                rng = random.Random(size)
+                queries = [(json.loads(x), rng.choice(chat_ids)) for x in embeddings]
+
+                exact, durations = await _time_searches(conn, queries, k)
+                table.add_row(
+                    f"{size:,}",
+                    "none",
+                    "",
+                    "exact",
+                    "1.00",
+                    f"{_percentile(durations, 0.5):.1f}",
+                    f"{_percentile(durations, 0.95):.1f}",
+                )
+                for method in _methods:
+                    start = time.perf_counter()
+                    await MistralGroupEmbeddings.create_index(conn, method)
+                    await conn.execute("ANALYZE ai.mistral_group_embeddings")
+                    build_duration = time.perf_counter() - start
+                    settings: list[VectorSearchParams] = (
+                        [{"ef_search": int(x)} for x in ef_search.split(",")]
+                        if method == "hnsw"
+                        else [{"probes": int(x)} for x in probes.split(",")]
+                    )
+                    for params in settings:
+                        results, durations = await _time_searches(conn, queries, k, params)
+                        recall = sum(len(x & y) / max(len(y), 1) for x, y in zip(results, exact)) / len(exact)
+                        table.add_row(
+                            f"{size:,}",
+                            method,
+                            f"{build_duration:.1f}",
+                            ", ".join(f"{key}={value}" for key, value in params.items()),
+                            f"{recall:.2f}",
+                            f"{_percentile(durations, 0.5):.1f}",
+                            f"{_percentile(durations, 0.95):.1f}",
+                        )
+                    await conn.execute(f"DROP INDEX ai.mistral_group_embeddings_{method}_idx")
+    Console().print(table)
+
+
+async def _legacy_init_connection(conn: asyncpg.Connection):
+    """The text codecs used before `init_connection` switched to binary formats, kept as a benchmark reference."""
+    await conn.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+    await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+    await conn.set_type_codec("vector", encoder=json.dumps, decoder=json.loads, schema="public")
+
+
+_CODECS: list[tuple[str, Callable, tuple[Callable, Callable], tuple[Callable, Callable]]] = [
+    ("previous (text)", _legacy_init_connection, (json.dumps, json.loads), (json.dumps, json.loads)),
+    ("current (binary)", init_connection, (encode_vector, decode_vector), (encode_jsonb, decode_jsonb)),
+]
+
+
+@bench_group.command("codecs", help="Compare the round trip throughput of the vector and JSON codecs")
+async def _bench_codecs(
+    nb_rows: int = Option(20_000, "--rows", help="Number of rows written and read back"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Write `--rows` (embedding, meta) rows to a temporary table then read them back, with the previous (JSON text)
+    and the current (binary) codecs of `init_connection`. The encoding and decoding alone is timed as well,
+    without the database.
+    """
+    rng = random.Random(0)
+    embeddings = [[rng.uniform(-1, 1) for _ in range(MISTRAL_EMBED_VECTOR_SIZE)] for _ in range(nb_rows)]
+    metas = [
+        {
+            "day": f"2024-01-{1 + i % 28:02d}",
+            "status": "done",
+            "embeddings_done_at": dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc).isoformat(),
+            "msg_ids": list(range(i, i + 20)),
+            "metrics": {"tokens": rng.randint(100, 10_000), "duration_ms": rng.random() * 1000},
+        }
+        for i in range(nb_rows)
+    ]
+    table = Table("Codecs", "Encode + decode (rows/s)", "Write (rows/s)", "Read (rows/s)")
+    for name, init_fn, (encode_vector_fn, decode_vector_fn), (encode_json_fn, decode_json_fn) in _CODECS:
+        start = time.perf_counter()
+        for embedding, meta in zip(embeddings, metas):
+            decode_vector_fn(encode_vector_fn(embedding))
+            decode_json_fn(encode_json_fn(meta))
+        codec_duration = time.perf_counter() - start
+
+        async with get_conn(pg_url, no_init=True) as conn:
+            await init_fn(conn)
+            await conn.execute("CREATE TEMP TABLE bench_codecs (embedding vector(1024), meta jsonb)")
+            start = time.perf_counter()
+            await conn.executemany("INSERT INTO bench_codecs VALUES ($1, $2)", list(zip(embeddings, metas)))
+            write_duration = time.perf_counter() - start
+            start = time.perf_counter()
+            rows = await conn.fetch("SELECT embedding, meta FROM bench_codecs")
+            read_duration = time.perf_counter() - start
+        if len(rows) != nb_rows:
+            raise ValueError(f"Expected {nb_rows} rows, got {len(rows)}")
+        table.add_row(
+            name,
+            f"{nb_rows / codec_duration:,.0f}",
+            f"{nb_rows / write_duration:,.0f}",
+            f"{nb_rows / read_duration:,.0f}",
+        )
+    Console().print(table)
@@ -1,15 +1,21 @@
 import os
+import re
 import time
-from piou import CommandGroup, Password, Option
+
+import asyncpg
+from piou import CommandGroup, Password, Option, Derived
 from tracktolib.pg import insert_many
 from tracktolib.utils import exec_cmd
 
+from polarsen.db import MistralGroupEmbeddings, VectorIndexMethod, Requests
 from polarsen.env import SQL_DIR
 from polarsen.logs import logs
 from polarsen.pg import get_conn
-from polarsen.utils import PgHost, PgPort, PgUser, PgPassword, PgDatabase
+from polarsen.utils import PgHost, PgPort, PgUser, PgPassword, PgDatabase, get_pg_url
 from .utils import set_pg_env
 
+__all__ = ("db_group", "run_sql_files", "partition_messages", "partition_requests")
+
 db_group = CommandGroup("db", help="Database commands")
 
 CHAT_TYPES = [
@@ -17,6 +23,27 @@ CHAT_TYPES = [
 ]
 
 
+# Transaction blocks of the SQL files, removed when they are run in the transaction of a migration
+_TRANSACTION_STATEMENTS = re.compile(r"^\s*(BEGIN|COMMIT);\s*$", re.MULTILINE | re.IGNORECASE)
+
+
+async def run_sql_files(conn: asyncpg.Connection, *, in_transaction: bool = False):
+    """
+    Create (or update) the extensions, tables, constraints and indexes, executing the SQL files in order.
+    With `in_transaction`, the files are run in the current transaction instead of committing their own blocks.
+    """
+    for file in sorted(SQL_DIR.glob("*.sql")):
+        logs.debug(f"Executing {file}...")
+        sql = file.read_text()
+        if in_transaction:
+            sql = _TRANSACTION_STATEMENTS.sub("", sql)
+        file_start = time.time()
+        await conn.execute(sql)
+        file_duration = time.time() - file_start
+        if file_duration > 2:
+            logs.warning(f"File {file.name} took longer than expected ({file_duration:.2f}s > 2s)")
+
+
 @db_group.command("setup", help="Generate embeddings for messages in discussions")
 async def _setup_db(
     pg_host: str = PgHost,
@@ -44,17 +71,187 @@ async def _setup_db(
     # Create extensions and tables
 
     async with get_conn(f"{_pg_url_no_db}/{pg_database}", no_init=True) as conn:
-        for file in sorted(SQL_DIR.glob("*.sql")):
-            logs.debug(f"Executing {file}...")
-            sql = file.read_text()
-            file_start = time.time()
-            await conn.execute(sql)
-            file_duration = time.time() - file_start
-            if file_duration > 2:
-                logs.warning(f"File {file.name} took longer than expected ({file_duration:.2f}s > 2s)")
+        await run_sql_files(conn)
+        if await Requests.is_partitioned(conn):
+            await Requests.create_partitions(conn)
 
         if not no_data:
             await insert_many(conn, "general.chat_types", CHAT_TYPES, on_conflict="ON CONFLICT DO NOTHING")
 
     duration = time.time() - start
     logs.info(f"Database setup completed, took {duration:.2f}s")
+
+
+@db_group.command("vector-index", help="(Re)build the approximate nearest neighbour index of the group embeddings")
+async def _vector_index(
+    method: VectorIndexMethod = Option("hnsw", "--method", help="Index method"),
+    m: int = Option(16, "--m", help="HNSW: maximum number of connections per layer"),
+    ef_construction: int = Option(64, "--ef-construction", help="HNSW: size of the candidate list at build time"),
+    lists: int | None = Option(None, "--lists", help="IVFFlat: number of lists, computed from the rows by default"),
+    maintenance_work_mem: str = Option("1GB", "--maintenance-work-mem", help="Memory available to the build"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Replace the index of `ai.mistral_group_embeddings` used by the RAG search.
+    The index is built concurrently, so embeddings can still be saved meanwhile, and the current index keeps
+    serving the searches until the new one replaces it.
+    HNSW builds are much faster when the graph fits in `--maintenance-work-mem`.
+    """
+    start = time.time()
+    async with get_conn(pg_url) as conn:
+        await conn.execute("select set_config('maintenance_work_mem', $1, false)", maintenance_work_mem)
+        await MistralGroupEmbeddings.create_index(
+            conn, method, m=m, ef_construction=ef_construction, lists=lists, concurrently=True
+        )
+    logs.info(f"{method} index built, took {time.time() - start:.2f}s")
+
+
+async def partition_messages(conn: asyncpg.Connection, nb_partitions: int = 16) -> bool:
+    """
+    Move `general.chat_messages` to a table hash partitioned by `chat_id`, so that vacuum, indexes and caches
+    stay per partition and per-chat queries (ingest, segmentation, search) only touch the partition of the chat.
+    The constraints, foreign keys, indexes and views are recreated by the setup SQL files, in the same transaction
+    so the table is left untouched if anything fails.
+    Returns False if the messages are already partitioned.
+    """
+    relkind = await conn.fetchval("SELECT relkind FROM pg_class WHERE oid = 'general.chat_messages'::regclass")
+    if relkind == "p":
+        return False
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE general.chat_messages IN ACCESS EXCLUSIVE MODE")
+        await conn.execute(
+            """
+            CREATE TABLE general.chat_messages_partitioned
+            (
+                LIKE general.chat_messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY
+            ) PARTITION BY HASH (chat_id)
+            """
+        )
+        for i in range(nb_partitions):
+            await conn.execute(
+                f"""
+                CREATE TABLE general.chat_messages_p{i} PARTITION OF general.chat_messages_partitioned
+                    FOR VALUES WITH (MODULUS {nb_partitions}, REMAINDER {i})
+                """
+            )
+        status = await conn.execute("INSERT INTO general.chat_messages_partitioned SELECT * FROM general.chat_messages")
+        logs.info(f"Copied {status.split()[-1]} messages to {nb_partitions} partitions")
+        old_sequence, sequence = await conn.fetchrow(
+            """
+            SELECT pg_get_serial_sequence('general.chat_messages', 'id'),
+                   pg_get_serial_sequence('general.chat_messages_partitioned', 'id')
+            """
+        )
+        await conn.execute(
+            f"""
+            -- Message IDs are reserved from the sequence before being saved (see `DBChatMessage.reserve_ids`)
+            SELECT setval('{sequence}', last_value, is_called) FROM {old_sequence};
+            -- Also drops the view and the foreign keys depending on the table, recreated below
+            DROP TABLE general.chat_messages CASCADE;
+            ALTER TABLE general.chat_messages_partitioned RENAME TO chat_messages;
+            ALTER SEQUENCE {sequence} RENAME TO chat_messages_id_seq;
+            -- Partitioned tables keys must include the partition key, this one replaces the (id, chat_id)
+            -- unique constraint that the foreign keys reference
+            ALTER TABLE general.chat_messages ADD CONSTRAINT unique_chat_group_idx PRIMARY KEY (id, chat_id);
+            """
+        )
+        await run_sql_files(conn, in_transaction=True)
+    return True
+
+
+async def partition_requests(conn: asyncpg.Connection) -> bool:
+    """
+    Move `ai.requests` to a table partitioned by month on `created_at`, so that the expired requests (and their
+    payloads) are dropped with their partition by `db requests-retention` instead of being deleted row by row.
+    The payloads already saved stay in the `payload` JSONB column until they expire,
+    the new ones are compressed by the application (see `Requests.get_payload`).
+    Returns False if the requests are already partitioned.
+    """
+    if await Requests.is_partitioned(conn):
+        return False
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE ai.requests IN ACCESS EXCLUSIVE MODE")
+        await conn.execute(
+            """
+            CREATE TABLE ai.requests_partitioned
+            (
+                LIKE ai.requests INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY
+            ) PARTITION BY RANGE (created_at);
+            CREATE TABLE ai.requests_default PARTITION OF ai.requests_partitioned DEFAULT;
+            ALTER TABLE ai.requests RENAME TO requests_unpartitioned;
+            ALTER TABLE ai.requests_partitioned RENAME TO requests;
+            """
+        )
+        # Create the partitions before copying, so that the rows are routed to them directly
+        first_day = await conn.fetchval("SELECT min(created_at)::date FROM ai.requests_unpartitioned")
+        partitions = await Requests.create_partitions(conn, from_month=first_day)
+        status = await conn.execute("INSERT INTO ai.requests SELECT * FROM ai.requests_unpartitioned")
+        logs.info(f"Copied {status.split()[-1]} requests to {len(partitions)} partitions")
+        old_sequence, sequence = await conn.fetchrow(
+            """
+            SELECT pg_get_serial_sequence('ai.requests_unpartitioned', 'id'),
+                   pg_get_serial_sequence('ai.requests', 'id')
+            """
+        )
+        await conn.execute(
+            f"""
+            SELECT setval('{sequence}', last_value, is_called) FROM {old_sequence};
+            DROP TABLE ai.requests_unpartitioned;
+            ALTER SEQUENCE {sequence} RENAME TO requests_id_seq;
+            ALTER TABLE ai.requests ADD CONSTRAINT requests_pkey PRIMARY KEY (id, created_at);
+            """
+        )
+        await run_sql_files(conn, in_transaction=True)
+    return True
+
+
+@db_group.command("partition-messages", help="Migrate the chat messages to a table hash partitioned by chat")
+async def _partition_messages(
+    nb_partitions: int = Option(16, "--partitions", help="Number of hash partitions"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Move `general.chat_messages` to a table hash partitioned by `chat_id` (see `partition_messages`).
+    The table is locked while the messages are copied: stop the workers and the API first.
+    """
+    start = time.time()
+    async with get_conn(pg_url, no_init=True) as conn:
+        if not await partition_messages(conn, nb_partitions):
+            logs.info("Chat messages are already partitioned")
+            return
+    logs.info(f"Chat messages partitioned, took {time.time() - start:.2f}s")
+
+
+@db_group.command("partition-requests", help="Migrate the AI requests to a table partitioned by month")
+async def _partition_requests(
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Move `ai.requests` to a table partitioned by month (see `partition_requests`).
+    The table is locked while the requests are copied: stop the workers and the API first.
+    """
+    start = time.time()
+    async with get_conn(pg_url, no_init=True) as conn:
+        if not await partition_requests(conn):
+            logs.info("Requests are already partitioned")
+            return
+    logs.info(f"Requests partitioned, took {time.time() - start:.2f}s")
+
+
+@db_group.command("requests-retention", help="Create the upcoming partitions of the AI requests and drop the expired")
+async def _requests_retention(
+    months: int = Option(6, "--months", help="Number of months of requests to keep, including the current one"),
+    months_ahead: int = Option(3, "--ahead", help="Number of upcoming months to create a partition for"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Meant to be run periodically (e.g. daily), the requests of the months without partition are saved
+    in the default partition and moved to their partition once created.
+    Expired months are dropped with their partition, without scanning nor vacuuming the table.
+    """
+    async with get_conn(pg_url, no_init=True) as conn:
+        if not await Requests.is_partitioned(conn):
+            raise ValueError("Requests are not partitioned, run `db partition-requests` first")
+        created = await Requests.create_partitions(conn, months_ahead=months_ahead)
+        dropped = await Requests.drop_partitions(conn, keep_months=months)
+    logs.info(f"Created partitions: {created or None}, dropped partitions: {dropped or None}")
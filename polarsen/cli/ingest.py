@@ -1,21 +1,48 @@
-import json
+import asyncio
+import contextlib
+import datetime as dt
+import itertools
 import logging
+import multiprocessing
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing.managers import SyncManager
+from pathlib import Path
+from queue import Empty, Full
+from typing import Final, Iterator, NamedTuple
 
 import asyncpg
 import botocore.client
 import niquests
-from rich.progress import track
+from rich.progress import Progress
 
 from polarsen import env
-from polarsen.db import TelegramGroup, ChatUpload
+from polarsen.db import TelegramGroup, TelegramMessage, ChatUpload, INGEST_BATCH_SIZE, UploadMetrics
 from polarsen.logs import logs
-from polarsen.s3_utils import s3_get_object
+from polarsen.s3_utils import (
+    s3_stream_object_ranges,
+    s3_list_objects,
+    s3_delete_object,
+    s3_list_multipart_uploads,
+    s3_abort_multipart_upload,
+)
+from polarsen.compression import Compression, iter_compressed_file
+from polarsen.utils import abatched
 
 PENDING_CHAT_UPLOADS_QUERY = """
 WITH next_uploads AS (
   SELECT id, user_id
   FROM general.chat_uploads
   WHERE processed_at IS NULL
+    AND CASE meta ->> 'status'
+          WHEN 'error' THEN FALSE
+          -- Claimed by another worker, unless it stopped without releasing it
+          WHEN 'processing' THEN (meta ->> 'processing_started_at')::timestamptz < now() - $2::interval
+          ELSE TRUE
+        END
   ORDER BY created_at
   FOR UPDATE SKIP LOCKED
   LIMIT $1
@@ -24,18 +51,295 @@ SELECT
   cu.id,
   cu.file_path,
   c.internal_code AS chat_source,
-  cu.user_id as uploaded_by
+  cu.user_id as uploaded_by,
+  cu.compression
 FROM next_uploads n
 JOIN general.chat_uploads cu ON cu.id = n.id
 LEFT JOIN general.chat_types c ON c.id = cu.chat_type_id;
 """
 
 
-async def fetch_pending_uploads(conn: asyncpg.Connection, limit: int = 10_000) -> list[asyncpg.Record]:
-    records = await conn.fetch(PENDING_CHAT_UPLOADS_QUERY, limit)
+# Uploads claimed for longer are considered abandoned (worker killed) and picked up again.
+# Claims are refreshed before each upload is written, so this only needs to exceed the time to process one upload.
+PROCESSING_CLAIM_TIMEOUT: Final[dt.timedelta] = dt.timedelta(hours=1)
+
+
+async def fetch_pending_uploads(
+    conn: asyncpg.Connection, limit: int = 10_000, claim_timeout: dt.timedelta = PROCESSING_CLAIM_TIMEOUT
+) -> list[asyncpg.Record]:
+    records = await conn.fetch(PENDING_CHAT_UPLOADS_QUERY, limit, claim_timeout)
     return records
 
 
+# Number of downloaded uploads (spooled to disk) waiting to be parsed
+FETCH_QUEUE_SIZE: Final[int] = 2
+# Number of parsed message batches (of `INGEST_BATCH_SIZE` messages) waiting to be written
+PARSE_QUEUE_SIZE: Final[int] = 4
+
+
+@dataclass
+class _UploadJob:
+    """An upload going through the fetch -> parse -> write pipeline of `process_uploads`."""
+
+    upload: asyncpg.Record
+    # Temporary file the upload has been downloaded to
+    path: Path
+    # Group, then message batches, then None (done) or the exception raised while parsing
+    parsed: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=PARSE_QUEUE_SIZE))
+    # Set by the write stage when the upload failed, to stop parsing it
+    failed: bool = False
+    # Set once the end of `parsed` (None or exception) has been read
+    finished: bool = False
+    # Filled by each stage, saved with the upload once processed
+    metrics: UploadMetrics = field(default_factory=dict)
+
+    async def next_parsed(self):
+        item = await self.parsed.get()
+        if item is None or isinstance(item, Exception):
+            self.finished = True
+        return item
+
+
+async def _fetch_uploads(
+    client: niquests.AsyncSession,
+    s3_client: botocore.client.BaseClient,
+    bucket: str,
+    uploads: list[asyncpg.Record],
+    out_queue: asyncio.Queue[_UploadJob | None],
+    failed_ids: list[int],
+    logger: logging.LoggerAdapter,
+    tmp_dir: Path,
+) -> None:
+    """
+    Download the uploads from S3 to temporary files in `tmp_dir`, streaming them (with concurrent range requests
+    for large files) so memory usage does not depend on the file sizes. Compressed uploads are kept compressed,
+    they are decompressed while being parsed.
+    Uploads that could not be fetched are added to `failed_ids`, to be released by the write stage
+    (which owns the connection) and retried later.
+    """
+    for _upload in uploads:
+        upload_id, file_path = _upload["id"], _upload["file_path"]
+        logger.debug(f"Fetching chat upload {upload_id=} {file_path=}")
+        path = tmp_dir / f"upload-{upload_id}"
+        nb_bytes = 0
+        start = time.perf_counter()
+        try:
+            with path.open("wb") as f:
+                async for chunk in s3_stream_object_ranges(s3=s3_client, client=client, bucket=bucket, key=file_path):
+                    f.write(chunk)
+                    nb_bytes += len(chunk)
+        except Exception as e:
+            logger.error(f"Failed to fetch file {file_path!r} from S3 for chat upload {upload_id}: {e}. Skipping.")
+            path.unlink(missing_ok=True)
+            failed_ids.append(upload_id)
+            continue
+        metrics: UploadMetrics = {
+            "bytes_downloaded": nb_bytes,
+            "download_ms": _elapsed_ms(start),
+        }
+        await out_queue.put(_UploadJob(upload=_upload, path=path, metrics=metrics))
+    await out_queue.put(None)
+
+
+def _elapsed_ms(start: float) -> int:
+    return round((time.perf_counter() - start) * 1000)
+
+
+def _peak_rss_kb() -> int:
+    """Peak resident set size of the current process since it started (kilobytes on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class ParseExecutor(NamedTuple):
+    """Process pool used to parse the uploads, with the manager holding the queues that stream the results back."""
+
+    executor: ProcessPoolExecutor
+    manager: SyncManager
+
+
+@contextlib.contextmanager
+def get_parse_executor(max_workers: int) -> Iterator[ParseExecutor | None]:
+    """Start a pool of `max_workers` processes to parse uploads, uploads are parsed in the event loop if 0."""
+    if max_workers <= 0:
+        yield None
+        return
+    # Spawned rather than forked, to not inherit the event loop and connections of the parent
+    mp_context = multiprocessing.get_context("spawn")
+    with mp_context.Manager() as manager:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            yield ParseExecutor(executor=executor, manager=manager)
+
+
+def _parse_upload_rows(
+    path: Path, chat_source: str, compression: Compression | None, batch_size: int, rows_queue, stop_event
+) -> UploadMetrics:
+    """
+    Parse an upload in a pool process.
+    Sends the group (without messages), then batches of message rows (see `TelegramMessage.to_row`)
+    to `rows_queue`, then None. Stops early once `stop_event` is set.
+    Returns the parsing metrics, the time spent waiting on `rows_queue` is not counted.
+    """
+    metrics: UploadMetrics = {"parse_ms": 0, "messages_parsed": 0}
+
+    def _put(item) -> bool:
+        while not stop_event.is_set():
+            try:
+                rows_queue.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    async def _parse():
+        start = time.perf_counter()
+        match chat_source:
+            case "telegram":
+                group, messages = await TelegramGroup.load_stream(iter_compressed_file(path, compression))
+            case _:
+                raise ValueError(f"Unsupported chat source {chat_source!r}")
+        metrics["parse_ms"] += _elapsed_ms(start)
+        if not _put(group):
+            return
+        batches = abatched(messages, batch_size)
+        while True:
+            start = time.perf_counter()
+            batch = await anext(batches, None)
+            rows = [m.to_row() for m in batch] if batch is not None else None
+            metrics["parse_ms"] += _elapsed_ms(start)
+            if rows is None:
+                break
+            metrics["messages_parsed"] += len(rows)
+            if not _put(rows):
+                return
+        metrics["messages_skipped"] = group.nb_skipped
+
+    try:
+        asyncio.run(_parse())
+    finally:
+        _put(None)
+    metrics["process_peak_rss_kb"] = _peak_rss_kb()
+    return metrics
+
+
+def _drain_queue(queue) -> None:
+    """Discard the items left in `queue`."""
+    with contextlib.suppress(Empty):
+        while True:
+            queue.get_nowait()
+
+
+async def _parse_upload_in_pool(job: _UploadJob, parse_executor: ParseExecutor) -> None:
+    """Parse an upload in the process pool, forwarding the group and message batches to the write stage."""
+    rows_queue = parse_executor.manager.Queue(maxsize=PARSE_QUEUE_SIZE)
+    stop_event = parse_executor.manager.Event()
+    future = asyncio.get_running_loop().run_in_executor(
+        parse_executor.executor,
+        _parse_upload_rows,
+        job.path,
+        job.upload["chat_source"],
+        job.upload["compression"],
+        INGEST_BATCH_SIZE,
+        rows_queue,
+        stop_event,
+    )
+    try:
+        while not job.failed:
+            try:
+                item = await asyncio.to_thread(rows_queue.get, timeout=1)
+            except Empty:
+                if future.done():
+                    break
+                continue
+            if item is None:
+                break
+            if isinstance(item, TelegramGroup):
+                await job.parsed.put(item)
+            else:
+                await job.parsed.put([TelegramMessage.from_row(row) for row in item])
+        if job.failed:
+            # The pool process may be blocked on the full queue, stop it before waiting for it
+            stop_event.set()
+            await asyncio.to_thread(_drain_queue, rows_queue)
+        # Raises the parsing error, if any
+        job.metrics.update(await future)
+    finally:
+        stop_event.set()
+
+
+async def _parse_upload(job: _UploadJob) -> None:
+    """Parse an upload in the event loop, the time spent waiting on the write stage is not counted."""
+    start = time.perf_counter()
+    match job.upload["chat_source"]:
+        case "telegram":
+            group, messages = await TelegramGroup.load_stream(iter_compressed_file(job.path, job.upload["compression"]))
+        case _chat_source:
+            raise ValueError(f"Unsupported chat source {_chat_source!r}")
+    parse_ms, nb_messages = _elapsed_ms(start), 0
+    await job.parsed.put(group)
+    batches = abatched(messages, INGEST_BATCH_SIZE)
+    while not job.failed:
+        start = time.perf_counter()
+        batch = await anext(batches, None)
+        parse_ms += _elapsed_ms(start)
+        if batch is None:
+            break
+        nb_messages += len(batch)
+        await job.parsed.put(batch)
+    job.metrics.update(parse_ms=parse_ms, messages_parsed=nb_messages, messages_skipped=group.nb_skipped)
+
+
+async def _parse_uploads(
+    in_queue: asyncio.Queue[_UploadJob | None],
+    out_queue: asyncio.Queue[_UploadJob | None],
+    parse_executor: ParseExecutor | None = None,
+) -> None:
+    """
+    Parse the downloaded uploads, streaming their messages to the write stage in batches.
+    Parsing is done in the process pool of `parse_executor` if set, otherwise in the event loop.
+    """
+    while (job := await in_queue.get()) is not None:
+        await out_queue.put(job)
+        try:
+            if parse_executor is not None:
+                await _parse_upload_in_pool(job, parse_executor)
+            else:
+                await _parse_upload(job)
+        except Exception as e:
+            await job.parsed.put(e)
+        else:
+            await job.parsed.put(None)
+        finally:
+            job.path.unlink(missing_ok=True)
+    await out_queue.put(None)
+
+
+async def _write_upload(conn: asyncpg.Connection, job: _UploadJob) -> int:
+    """Save a parsed upload in its own transaction and mark it as processed, returns the chat ID."""
+    db_ms, nb_rows = 0, 0
+    async with conn.transaction():
+        group = await job.next_parsed()
+        if isinstance(group, Exception):
+            raise group
+        start = time.perf_counter()
+        chat_id = await group.save_chat(conn, created_by=job.upload["uploaded_by"])
+        db_ms += _elapsed_ms(start)
+        while (batch := await job.next_parsed()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            start = time.perf_counter()
+            nb_rows += await group.save_messages(conn, chat_id=chat_id, messages=batch)
+            db_ms += _elapsed_ms(start)
+        metrics = job.metrics
+        metrics.update(
+            rows_inserted=nb_rows,
+            messages_already_saved=metrics.get("messages_parsed", 0) - nb_rows,
+            db_ms=db_ms,
+            process_peak_rss_kb=max(metrics.get("process_peak_rss_kb", 0), _peak_rss_kb()),
+        )
+        await ChatUpload.mark_processed(conn, chat_id=chat_id, upload_id=job.upload["id"], metrics=metrics)
+    return chat_id
+
+
 async def process_uploads(
     client: niquests.AsyncSession,
     conn: asyncpg.Connection,
@@ -44,43 +348,126 @@ async def process_uploads(
     show_progress: bool = False,
     limit: int = 10_000,
     logger: None | logging.LoggerAdapter = None,
+    parse_executor: ParseExecutor | None = None,
+    claim_timeout: dt.timedelta = PROCESSING_CLAIM_TIMEOUT,
 ) -> list[int]:
     """
     Process pending chat uploads from S3 and ingest them into the database.
-    Will mark uploads as processed once done.
+    Uploads go through a fetch (streamed to a temporary file) -> parse -> write pipeline with bounded
+    queues between the stages, so S3 downloads, parsing and database writes of different uploads overlap.
+    Each upload is saved in its own transaction and marked as processed once done: an upload that
+    fails to parse or save is rolled back and marked as error without affecting the others.
+    When `parse_executor` is set, uploads are parsed in its process pool to keep the event loop responsive.
+    Uploads are claimed while processed, claims older than `claim_timeout` (left by a killed worker) are
+    picked up again.
     Returns the list of chat IDs that were processed.
     """
     _logs = logger or logs
     bucket = env.CHAT_UPLOADS_S3_BUCKET
     if not bucket:
         raise ValueError("CHAT_UPLOADS_S3_BUCKET must be set")
-    pending_uploads = await fetch_pending_uploads(conn, limit=limit)
-    if not pending_uploads:
-        _logs.debug("No pending chat uploads to process.")
-        return []
+    async with conn.transaction():
+        pending_uploads = await fetch_pending_uploads(conn, limit=limit, claim_timeout=claim_timeout)
+        if not pending_uploads:
+            _logs.debug("No pending chat uploads to process.")
+            return []
+        await ChatUpload.set_is_processing(conn, [x["id"] for x in pending_uploads])
     _logs.info(f"Found {len(pending_uploads)} pending chat uploads to process.")
 
+    pending_ids = {x["id"] for x in pending_uploads}
+    # Uploads that could not be fetched, the connection is only used by this (write) stage
+    fetch_failed_ids: list[int] = []
+
+    async def _release_fetch_failed():
+        if fetch_failed_ids:
+            _ids = fetch_failed_ids.copy()
+            fetch_failed_ids.clear()
+            await ChatUpload.reset_processing(conn, _ids)
+            pending_ids.difference_update(_ids)
+
+    fetched: asyncio.Queue[_UploadJob | None] = asyncio.Queue(maxsize=FETCH_QUEUE_SIZE)
+    parsed: asyncio.Queue[_UploadJob | None] = asyncio.Queue()
     chat_ids = []
-    for _upload in track(pending_uploads, disable=not show_progress, show_speed=True, description="Uploads..."):
-        upload_id = _upload["id"]
-        file_path = _upload["file_path"]
-        chat_source = _upload["chat_source"]
-        uploaded_by = _upload["uploaded_by"]
+    try:
+        with (
+            tempfile.TemporaryDirectory(prefix="polarsen-uploads-") as tmp_dir,
+            Progress(disable=not show_progress) as progress,
+        ):
+            task = progress.add_task("Uploads...", total=len(pending_uploads))
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(
+                    _fetch_uploads(
+                        client, s3_client, bucket, pending_uploads, fetched, fetch_failed_ids, _logs, Path(tmp_dir)
+                    )
+                )
+                tg.create_task(_parse_uploads(fetched, parsed, parse_executor))
+                while (job := await parsed.get()) is not None:
+                    upload_id = job.upload["id"]
+                    _logs.debug(f"Processing chat upload {upload_id=} chat_source={job.upload['chat_source']!r}")
+                    await _release_fetch_failed()
+                    # Keep the remaining uploads claimed
+                    await ChatUpload.set_is_processing(conn, list(pending_ids))
+                    try:
+                        chat_id = await _write_upload(conn, job)
+                    except Exception as e:
+                        _logs.error(f"Error processing chat upload {upload_id}: {e}")
+                        job.failed = True
+                        # Unblock the parse stage if it is waiting on this upload
+                        while not job.finished:
+                            await job.next_parsed()
+                        await ChatUpload.set_processing_error(conn, [upload_id], message=str(e))
+                    else:
+                        chat_ids.append(chat_id)
+                    pending_ids.discard(upload_id)
+                    progress.advance(task)
+                await _release_fetch_failed()
+    except BaseException:
+        if pending_ids:
+            _logs.debug(f"Caught an exception, resetting {len(pending_ids)} chat uploads")
+            await ChatUpload.reset_processing(conn, list(pending_ids))
+        raise
+    return chat_ids
 
-        _logs.debug(f"Processing chat upload {upload_id=} {file_path=} {chat_source=}")
 
-        file_data = await s3_get_object(s3=s3_client, client=client, bucket=bucket, key=file_path)
-        if file_data is None:
-            _logs.error(f"Failed to fetch file {file_path!r} from S3 for chat upload {upload_id}. Skipping.")
-            continue
+async def clean_orphan_uploads(
+    client: niquests.AsyncSession,
+    conn: asyncpg.Connection,
+    s3_client: botocore.client.BaseClient,
+    *,
+    older_than: dt.timedelta = dt.timedelta(days=1),
+    dry_run: bool = False,
+    logger: None | logging.LoggerAdapter = None,
+) -> list[str]:
+    """
+    Delete the objects of the chat uploads bucket without a `general.chat_uploads` record, left by uploads
+    that were sent to S3 but never saved (the API stopped in between, or failed to delete them),
+    and abort the multipart uploads that were never completed.
+    Only objects older than `older_than` are considered, so uploads in progress have time to be saved.
+    Returns the keys of the orphan objects.
+    """
+    _logs = logger or logs
+    bucket = env.CHAT_UPLOADS_S3_BUCKET
+    if not bucket:
+        raise ValueError("CHAT_UPLOADS_S3_BUCKET must be set")
+    cutoff = dt.datetime.now(dt.timezone.utc) - older_than
 
-        match chat_source:
-            case "telegram":
-                group = TelegramGroup.load(json.loads(file_data.decode("utf-8")), show_progress=show_progress)
-                chat_id = await group.save(conn=conn, created_by=uploaded_by)
-            case _:
-                raise ValueError(f"Unsupported chat source {chat_source!r}")
+    keys = [obj["Key"] async for obj in s3_list_objects(s3_client, bucket) if obj["LastModified"] < cutoff]
+    orphans = []
+    for batch in itertools.batched(keys, 1000):
+        saved_paths = await ChatUpload.get_saved_paths(conn, list(batch))
+        orphans.extend(key for key in batch if key not in saved_paths)
+    for key in orphans:
+        _logs.info(f"Deleting orphan object {key!r}" + (" (dry run)" if dry_run else ""))
+        if not dry_run:
+            await s3_delete_object(s3_client, client, bucket=bucket, key=key)
 
-        await ChatUpload.mark_processed(conn, chat_id=chat_id, upload_id=upload_id)
-        chat_ids.append(chat_id)
-    return chat_ids
+    async for upload in s3_list_multipart_uploads(s3_client, bucket):
+        if upload["Initiated"] >= cutoff:
+            continue
+        _logs.info(f"Aborting incomplete multipart upload of {upload['Key']!r}" + (" (dry run)" if dry_run else ""))
+        if not dry_run:
+            await s3_abort_multipart_upload(
+                s3_client, client, bucket=bucket, key=upload["Key"], upload_id=upload["UploadId"]
+            )
+    _logs.info(f"Found {len(orphans)} orphan objects out of {len(keys)} objects older than {cutoff}")
+    return orphans
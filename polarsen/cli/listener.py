@@ -12,7 +12,7 @@ from polarsen.ai.embeddings import gen_groups_embeddings, DEFAULT_EMBEDDING_MODE
 from polarsen.common.utils import get_source_from_model, AISource
 from polarsen.db import DbChat, MessageGroup
 from polarsen.logs import logs, WorkerLoggerAdapter
-from .ingest import process_uploads
+from .ingest import process_uploads, ParseExecutor
 
 __all__ = ("process_chat_worker", "process_chat_groups_worker", "process_embeddings_worker", "DEFAULT_EMBEDDING_MODEL")
 
@@ -26,10 +26,13 @@ async def process_chat_worker(
     worker_id: int,
     limit: int = 1,
     sleep_no_data: int = 5,
+    parse_executor: ParseExecutor | None = None,
 ):
     """
     Worker to process chat uploads.
-    This will run indefinitely, processing `limit` uploads at a time.
+    This will run indefinitely, processing `limit` uploads at a time through the upload pipeline
+    (see `process_uploads`), each upload being saved in its own transaction.
+    Uploads are parsed in the process pool of `parse_executor` if set, which can be shared between workers.
     If no uploads are found, it will sleep for `sleep_no_data` seconds.
     """
     worker_log = WorkerLoggerAdapter(logs, {"worker_id": worker_id, "worker_type": "UploadWorker"})
@@ -40,15 +43,15 @@ async def process_chat_worker(
             try:
                 while True:
                     HEALTH_FILE.touch()
-                    async with conn.transaction():
-                        _chat_ids = await process_uploads(
-                            client=session,
-                            conn=conn,
-                            s3_client=s3_client,
-                            show_progress=False,
-                            limit=limit,
-                            logger=worker_log,
-                        )
+                    _chat_ids = await process_uploads(
+                        client=session,
+                        conn=conn,
+                        s3_client=s3_client,
+                        show_progress=False,
+                        limit=limit,
+                        logger=worker_log,
+                        parse_executor=parse_executor,
+                    )
                     if not _chat_ids:
                         await asyncio.sleep(sleep_no_data)
             except KeyboardInterrupt:
@@ -59,7 +62,8 @@ async def _get_chats_not_grouped(
     conn: asyncpg.Connection, source: AISource, limit: int = 1, only_with_keys: bool = True
 ) -> list[asyncpg.Record]:
     """
-    Get chats that are not yet grouped - with status not in ('processing', 'done') - and lock them for processing.
+    Get chats that are not yet grouped - with status not in ('processing', 'done') - or with days to segment again
+    (new messages ingested since they were grouped) and lock them for processing.
     If only_with_keys is True, only return chats where the user has an API key for the given source.
     """
     records = await conn.fetch(
@@ -67,7 +71,9 @@ async def _get_chats_not_grouped(
         SELECT mg.id, mg.created_by, u.api_keys ->> $2 AS api_key, u.id AS user_id
         FROM general.chats mg
                  LEFT JOIN general.users u ON u.id = mg.created_by
-        WHERE (mg.meta ->> 'status' IS NULL OR mg.meta ->> 'status' NOT IN ('processing', 'done'))
+        WHERE (mg.meta ->> 'status' IS NULL
+            OR mg.meta ->> 'status' NOT IN ('processing', 'done')
+            OR (mg.meta ->> 'status' = 'done' AND jsonb_array_length(mg.meta -> 'pending_days') > 0))
           AND CASE WHEN $3 THEN u.api_keys ->> $2 IS NOT NULL ELSE TRUE END
         ORDER BY mg.id
             FOR UPDATE OF mg SKIP LOCKED
@@ -158,14 +164,14 @@ async def _get_groups_not_embedded(conn: asyncpg.Connection, limit: int = 1) ->
     """
     records = await conn.fetch(
         """
-        SELECT mg.id, mg.title, mg.summary, msg.messages, c.created_by AS user_id
+        SELECT mg.id, mg.chat_id, mg.title, mg.summary, msg.messages, c.created_by AS user_id
         FROM ai.message_groups mg
         LEFT JOIN ai.mistral_group_embeddings cge ON cge.group_id = mg.id
         LEFT JOIN general.chats c ON c.id = mg.chat_id
         LEFT JOIN LATERAL (
             SELECT ARRAY_AGG(cm.message ORDER BY cm.sent_at) AS messages
             FROM ai.message_group_chats m
-                     LEFT JOIN general.chat_messages cm ON cm.id = m.msg_id
+                     LEFT JOIN general.chat_messages cm ON cm.id = m.msg_id AND cm.chat_id = m.chat_id
             WHERE m.group_id = mg.id
               AND cm.message <> ''
             ) msg ON TRUE
@@ -1,4 +1,5 @@
 import asyncio
+import datetime as dt
 import json
 import os
 from pathlib import Path
@@ -6,13 +7,15 @@ from typing import Final
 
 import niquests
 from piou import Option, Derived, CommandGroup
+from rich.progress import Progress
 from polarsen.logs import logs
 from polarsen.ai.conversations import v2
-from polarsen.db.chat import CHAT_SOURCE_MAPPING, TelegramGroup
+from polarsen.db.chat import CHAT_SOURCE_MAPPING, TelegramGroup, INGEST_BATCH_SIZE, DEFAULT_INGEST_MODE, IngestMode
 from polarsen.pg import get_conn, get_pool
 from polarsen.s3_utils import get_s3_client
+from polarsen.compression import get_file_compression, iter_compressed_file
 from polarsen.utils import get_pg_url
-from .ingest import process_uploads
+from .ingest import process_uploads, get_parse_executor, clean_orphan_uploads
 from .listener import (
     process_chat_worker,
     process_chat_groups_worker,
@@ -31,16 +34,33 @@ async def ingest_export(
     created_by: int = Option(..., "--user", help="User who uploaded the chat"),
     chat_source: str = Option(..., "--source", help="Chat source name", choices=list(CHAT_SOURCE_MAPPING)),
     show_progress: bool = Option(False, "--progress", help="Show progress bar"),
+    no_stream: bool = Option(False, "--no-stream", help="Load the whole file in memory instead of streaming it"),
+    batch_size: int = Option(INGEST_BATCH_SIZE, "--batch-size", help="Number of messages saved at once (stream mode)"),
+    mode: IngestMode = Option(DEFAULT_INGEST_MODE, "--mode", help="How messages are written to the database"),
+    full: bool = Option(False, "--full", help="Upsert all the messages, not only the ones newer than the saved ones"),
     pg_url=Derived(get_pg_url),
 ):
     """
-    Ingest a chat export file into the database
+    Ingest a chat export file into the database, zstd (.zst) and zip exports are decompressed on the fly
     """
+    compression = get_file_compression(file)
     match chat_source:
         case "telegram":
-            group = TelegramGroup.load(json.loads(file.read_text()), show_progress=show_progress)
-            async with get_conn(pg_url) as conn:
-                await group.save(conn=conn, created_by=created_by)
+            if no_stream:
+                if compression is not None:
+                    raise ValueError("Compressed exports can only be ingested in stream mode")
+                group = TelegramGroup.load(json.loads(file.read_text()), show_progress=show_progress)
+                async with get_conn(pg_url) as conn:
+                    await group.save(conn=conn, created_by=created_by, mode=mode, delta=not full)
+                return
+            with Progress(disable=not show_progress) as progress:
+                task = progress.add_task("Reading file...", total=file.stat().st_size)
+                data = iter_compressed_file(file, compression, on_read=lambda size: progress.advance(task, size))
+                async with get_conn(pg_url) as conn:
+                    async with conn.transaction():
+                        await TelegramGroup.save_stream(
+                            conn, data, created_by=created_by, batch_size=batch_size, mode=mode, delta=not full
+                        )
         case _:
             raise ValueError(f"Unsupported chat source {chat_source!r}")
 
@@ -64,8 +84,33 @@ async def _process_uploads(
                 )
 
 
+@chat_group.command("clean-orphan-uploads")
+async def _clean_orphan_uploads(
+    older_than: int = Option(24, "--older-than", help="Only consider objects older than this number of hours"),
+    dry_run: bool = Option(False, "--dry-run", help="Only log the orphan objects, without deleting them"),
+    pg_url=Derived(get_pg_url),
+):
+    """
+    Delete the uploaded objects that were never saved in the database, and the incomplete multipart uploads
+    """
+    async with get_conn(pg_url) as conn:
+        async with niquests.AsyncSession() as session:
+            with get_s3_client() as s3_client:
+                await clean_orphan_uploads(
+                    client=session,
+                    conn=conn,
+                    s3_client=s3_client,
+                    older_than=dt.timedelta(hours=older_than),
+                    dry_run=dry_run,
+                )
+
+
 DEFAULT_NB_WORKERS: Final[int] = int(os.getenv("NB_WORKERS", 10))
 SLEEP_NO_DATA: Final[int] = int(os.getenv("SLEEP_NO_DATA", 5))  # seconds to sleep when no data is found
+# Uploads claimed at once by an upload worker, pipelined together (download, parsing and writes overlap)
+UPLOADS_PER_WORKER: Final[int] = int(os.getenv("UPLOADS_PER_WORKER", 4))
+# Processes parsing the uploads, shared by the upload workers (0 to parse in the event loop)
+PARSE_WORKERS: Final[int] = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 1))
 
 
 @chat_group.command("listen-uploads")
@@ -73,16 +118,27 @@ async def _listen_uploads(
     pg_url=Derived(get_pg_url),
     nb_workers: int = Option(DEFAULT_NB_WORKERS, "--workers", help="Number of concurrent workers"),
     sleep_no_data: int = Option(SLEEP_NO_DATA, "--sleep-no-data", help="Seconds to sleep when no data is found"),
+    limit: int = Option(UPLOADS_PER_WORKER, "--limit", help="Number of uploads claimed at once by each worker"),
+    parse_workers: int = Option(
+        PARSE_WORKERS, "--parse-workers", help="Number of processes parsing the uploads (0 to parse in the workers)"
+    ),
 ):
     """
     Listen for new chat uploads and process them indefinitely.
     """
     async with get_pool(pg_url) as pool:
-        with get_s3_client() as s3_client:
+        with get_s3_client() as s3_client, get_parse_executor(parse_workers) as parse_executor:
             async with asyncio.TaskGroup() as tg:
                 for worker_id in range(nb_workers):
                     tg.create_task(
-                        process_chat_worker(pool, s3_client, sleep_no_data=sleep_no_data, worker_id=worker_id)
+                        process_chat_worker(
+                            pool,
+                            s3_client,
+                            sleep_no_data=sleep_no_data,
+                            worker_id=worker_id,
+                            limit=limit,
+                            parse_executor=parse_executor,
+                        )
                     )
 
 
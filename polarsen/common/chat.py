@@ -15,7 +15,7 @@ if TYPE_CHECKING:
     from google.genai import types as genai_types
     from openai.types import chat as openai_types
 
-from polarsen.db import UsageToken
+from polarsen.db import UsageToken, VectorSearchParams
 from polarsen.logs import logs
 from .models import mistral, gemini, openai, grok, self_hosted
 from .models.gemini import is_thinking_only_model
@@ -61,6 +61,8 @@ class ChatSession:
     """Key for the RAG model"""
     rag_api_key: str
     api_key: str
+    search_params: VectorSearchParams = field(default_factory=VectorSearchParams)
+    """ANN search parameters of the RAG, to trade recall for latency"""
     _input_token_count: int = field(default=0, init=False)
     _output_token_count: int = field(default=0, init=False)
     _cached_token_count: int = field(default=0, init=False)
@@ -78,13 +80,22 @@ class ChatSession:
         return self._cached_token_count
 
     @classmethod
-    def get_session(cls, model_name: str, rag_api_key: str, api_key: str):
+    def get_session(
+        cls, model_name: str, rag_api_key: str, api_key: str, search_params: VectorSearchParams | None = None
+    ):
+        search_params = search_params or {}
         if mistral.is_mistral_model(model_name):
-            return MistralChatSession(model_name=model_name, api_key=api_key, rag_api_key=rag_api_key)
+            return MistralChatSession(
+                model_name=model_name, api_key=api_key, rag_api_key=rag_api_key, search_params=search_params
+            )
         elif gemini.is_gemini_model(model_name):
-            return GeminiChatSession(model_name=model_name, api_key=api_key, rag_api_key=rag_api_key)
+            return GeminiChatSession(
+                model_name=model_name, api_key=api_key, rag_api_key=rag_api_key, search_params=search_params
+            )
         elif openai.is_openai_model(model_name) or grok.is_grok_model(model_name):
-            return OpenAIChatSession(model_name=model_name, api_key=api_key, rag_api_key=rag_api_key)
+            return OpenAIChatSession(
+                model_name=model_name, api_key=api_key, rag_api_key=rag_api_key, search_params=search_params
+            )
         else:
             raise ValueError(f"Model {model_name!r} is not supported")
 
@@ -97,7 +108,9 @@ class ChatSession:
         limit: int = 5,
     ):
         with set_auth_headers(session, self.rag_api_key):
-            search_results = await search_close_messages(session, conn, question=question, chat_id=chat_id, limit=limit)
+            search_results = await search_close_messages(
+                session, conn, question=question, chat_id=chat_id, limit=limit, search_params=self.search_params
+            )
         return search_results
 
     def set_token(self, token: UsageToken):
@@ -5,19 +5,21 @@ import asyncpg
 import pydantic
 from niquests import AsyncSession
 
+from polarsen.db.ai import NEAREST_GROUPS_QUERY, MistralGroupEmbeddings, VectorSearchParams
 from .models import mistral
 
 _EMBEDDINGS_FNS = {"mistral": mistral.fetch_embeddings}
 
-_SEARCH_EMBEDDINGS_QUERY = """
-                           select group_id,
+_SEARCH_EMBEDDINGS_QUERY = f"""
+                           with nearest as ({NEAREST_GROUPS_QUERY})
+                           select n.group_id,
                                   g.summary,
                                   g.title,
-                                  (embedding <=> $1)       as distance,
-                                  (g.meta ->> 'day')::date as day,
+                                  n.distance,
+                                  g.day,
                                   _messages.messages
-                           from ai.mistral_group_embeddings
-                                    left join ai.message_group g on g.id = group_id
+                           from nearest n
+                                    join ai.message_groups g on g.id = n.group_id
                                     left join lateral (
                                select jsonb_agg(
                                               jsonb_build_object(
@@ -29,14 +31,12 @@ _SEARCH_EMBEDDINGS_QUERY = """
                                               )
                                       ) as messages
                                from ai.message_group_chats mgc
-                                        left join general.chat_messages cm on cm.id = mgc.msg_id
+                                        left join general.chat_messages cm on cm.id = mgc.msg_id and cm.chat_id = $3
                                         left join general.chat_users cu on cu.id = cm.chat_user_id
                                where mgc.group_id = g.id
 
                                ) _messages on true
-                           where g.chat_id = $3
-                           ORDER BY 1 - (embedding <=> $1) desc
-                           limit $2
+                           order by n.distance
                            """
 
 
@@ -55,7 +55,7 @@ async def _get_group_messages(
         FROM general.chat_messages cm
                  left join general.chat_users cu on cu.id = cm.chat_user_id
         where cm.message <> ''
-          and cm.id in (SELECT msg_id from ai.message_group_chats where group_id = $1)
+          and (cm.id, cm.chat_id) in (SELECT msg_id, chat_id from ai.message_group_chats where group_id = $1)
         order by sent_at
         """,
         group_id,
@@ -91,8 +91,11 @@ async def search_close_messages(
     question: str,
     model_name: str = "mistral",
     limit: int = 3,
+    search_params: VectorSearchParams | None = None,
 ) -> list[CloseEmbedding]:
     embeddings_fn = _EMBEDDINGS_FNS[model_name]
     embedding, nb_tokens = await embeddings_fn(session, question)
-    results = await conn.fetch(_SEARCH_EMBEDDINGS_QUERY, embedding, limit, chat_id)
+    async with conn.transaction():
+        await MistralGroupEmbeddings.set_search_params(conn, search_params)
+        results = await conn.fetch(_SEARCH_EMBEDDINGS_QUERY, embedding, limit, chat_id)
     return [_CloseEmbeddingType.validate_python(dict(x)) for x in results]
@@ -0,0 +1,127 @@
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import AsyncIterator, Callable, Literal
+
+try:
+    import zstandard
+except ImportError as e:
+    raise ImportError("zstandard is required to compress chat uploads") from e
+
+__all__ = (
+    "Compression",
+    "UPLOAD_MIME_TYPES",
+    "get_file_compression",
+    "zstd_compress_stream",
+    "iter_compressed_file",
+)
+
+Compression = Literal["zstd", "zip"]
+
+# Accepted upload mime types and the compression of their content
+UPLOAD_MIME_TYPES: dict[str, Compression | None] = {
+    "application/json": None,
+    "application/zstd": "zstd",
+    "application/zip": "zip",
+    "application/x-zip-compressed": "zip",
+}
+
+# Limits of the uploads content, to reject decompression bombs
+MAX_DECOMPRESSED_SIZE = 4 * 1024 * 1024 * 1024
+MAX_ZIP_MEMBERS = 10_000
+MAX_ZIP_COMPRESSION_RATIO = 100
+
+ZSTD_LEVEL = 3
+
+
+def get_file_compression(path: Path) -> Compression | None:
+    """Guess the compression of a chat export from its extension."""
+    match path.suffix.lower():
+        case ".zst" | ".zstd":
+            return "zstd"
+        case ".zip":
+            return "zip"
+        case _:
+            return None
+
+
+async def zstd_compress_stream(data: AsyncIterator[bytes], level: int = ZSTD_LEVEL) -> AsyncIterator[bytes]:
+    """Compress an async byte stream with zstd, as a single frame."""
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    async for chunk in data:
+        if _compressed := compressor.compress(chunk):
+            yield _compressed
+    yield compressor.flush()
+
+
+def _get_zip_export(archive: zipfile.ZipFile) -> zipfile.ZipInfo:
+    """Find the chat export of a zip archive: `result.json` for Telegram, or the only JSON file."""
+    if (nb_members := len(archive.infolist())) > MAX_ZIP_MEMBERS:
+        raise ValueError(f"Too many files in the zip archive: {nb_members} > {MAX_ZIP_MEMBERS}")
+    members = [x for x in archive.infolist() if not x.is_dir() and x.filename.lower().endswith(".json")]
+    for member in members:
+        if PurePosixPath(member.filename).name == "result.json":
+            return member
+    if len(members) != 1:
+        raise ValueError(f"Expected a single JSON export in the zip archive, found {len(members)}")
+    return members[0]
+
+
+def _check_size(size: int, max_size: int):
+    if size > max_size:
+        raise ValueError(f"Decompressed file exceeds the maximum size of {max_size} bytes")
+
+
+async def iter_compressed_file(
+    path: Path,
+    compression: Compression | None,
+    chunk_size: int = 64 * 1024,
+    on_read: Callable[[int], None] | None = None,
+    max_size: int = MAX_DECOMPRESSED_SIZE,
+) -> AsyncIterator[bytes]:
+    """
+    Yield the decompressed content of the file at `path` as an async byte stream.
+    `on_read` is called with the number of bytes read from the (compressed) file, to track progress.
+    Raises a `ValueError` once more than `max_size` bytes are decompressed.
+    """
+    size = 0
+    with path.open("rb") as f:
+        match compression:
+            case None:
+                while chunk := f.read(chunk_size):
+                    if on_read:
+                        on_read(len(chunk))
+                    yield chunk
+            case "zstd":
+                position = 0
+                # Reading from a stream bounds the output of each chunk, whatever the compression ratio
+                with zstandard.ZstdDecompressor().stream_reader(
+                    f, read_size=chunk_size, read_across_frames=True, closefd=False
+                ) as reader:
+                    while chunk := reader.read(chunk_size):
+                        size += len(chunk)
+                        _check_size(size, max_size)
+                        if on_read:
+                            on_read(max(f.tell() - position, 0))
+                            position = max(f.tell(), position)
+                        yield chunk
+            case "zip":
+                with zipfile.ZipFile(f) as archive:
+                    member = _get_zip_export(archive)
+                    _check_size(member.file_size, max_size)
+                    if member.file_size > MAX_ZIP_COMPRESSION_RATIO * max(member.compress_size, 1):
+                        raise ValueError(
+                            f"Compression ratio of {member.filename!r} exceeds {MAX_ZIP_COMPRESSION_RATIO}"
+                        )
+                    position = member.header_offset
+                    with archive.open(member) as export:
+                        while chunk := export.read(chunk_size):
+                            # The declared size can't be trusted, the decompressed bytes are counted too
+                            size += len(chunk)
+                            _check_size(size, max_size)
+                            # The archive reads from `f`, its position tells how much of the file has been read
+                            if on_read:
+                                on_read(max(f.tell() - position, 0))
+                                position = max(f.tell(), position)
+                            yield chunk
+            case _:
+                raise ValueError(f"Unsupported compression {compression!r}")
@@ -2,13 +2,18 @@ from __future__ import annotations
 
 import datetime as dt
 import hashlib
+import re
 import uuid
 from dataclasses import dataclass
 from typing import Literal, Iterable, TypedDict, NotRequired
 
 import asyncpg
-from tracktolib.pg import insert_many, PGConflictQuery, insert_returning, insert_one, update_one
+import orjson
+import zstandard
+from tracktolib.pg import insert_many, PGConflictQuery, insert_returning, insert_one
 
+from polarsen.compression import ZSTD_LEVEL
+from polarsen.logs import logs
 from .utils import TableID
 
 __all__ = (
@@ -18,6 +23,8 @@ __all__ = (
     "MISTRAL_EMBED_VECTOR_SIZE",
     "get_unique_identifier",
     "MistralGroupEmbeddings",
+    "VectorIndexMethod",
+    "VectorSearchParams",
     "Requests",
     "RequestType",
     "UsageToken",
@@ -33,6 +40,31 @@ class UsageToken(TypedDict):
 
 MISTRAL_EMBED_VECTOR_SIZE = 1024
 
+VectorIndexMethod = Literal["hnsw", "ivfflat"]
+
+_EMBEDDINGS_INDEXES: dict[VectorIndexMethod, str] = {
+    "hnsw": "mistral_group_embeddings_hnsw_idx",
+    "ivfflat": "mistral_group_embeddings_ivfflat_idx",
+}
+
+
+class VectorSearchParams(TypedDict, total=False):
+    ef_search: int
+    """Size of the HNSW candidate list (`hnsw.ef_search`, 40 by default), higher is more accurate but slower"""
+    probes: int
+    """Number of IVFFlat lists scanned (`ivfflat.probes`, 1 by default), higher is more accurate but slower"""
+
+
+# Ordered by the distance itself (not a similarity) so the planner can serve it from the ANN index,
+# with the chat filter applied while scanning it (see `hnsw.iterative_scan`)
+NEAREST_GROUPS_QUERY = """
+                       select e.group_id, e.embedding <=> $1 as distance
+                       from ai.mistral_group_embeddings e
+                       where e.chat_id = $3
+                       order by e.embedding <=> $1
+                       limit $2
+                       """
+
 
 @dataclass
 class GroupMethod(TableID):
@@ -86,6 +118,7 @@ class MessageGroup(TableID):
     title: str | None = None
     meta: dict | None = None
     run_id: uuid.UUID | None = None
+    day: dt.date | None = None
 
     @staticmethod
     async def set_is_processing(conn: asyncpg.Connection, group_ids: list[int]) -> None:
@@ -146,6 +179,25 @@ class MessageGroup(TableID):
             group_ids,
         )
 
+    @staticmethod
+    async def delete_days(conn: asyncpg.Connection, chat_id: int, days: list[dt.date]) -> None:
+        """Delete the groups (with their messages and embeddings) of the chat for the given days."""
+        await conn.execute(
+            """
+            WITH _groups AS (SELECT id
+                             FROM ai.message_groups
+                             WHERE chat_id = $1
+                               AND day = ANY ($2)),
+                 _embeddings AS (DELETE FROM ai.mistral_group_embeddings WHERE group_id IN (SELECT id FROM _groups)),
+                 _messages AS (DELETE FROM ai.message_group_chats WHERE group_id IN (SELECT id FROM _groups))
+            DELETE
+            FROM ai.message_groups
+            WHERE id IN (SELECT id FROM _groups)
+            """,
+            chat_id,
+            days,
+        )
+
     async def upsert(self, conn: asyncpg.Connection) -> int:
         _data = super().data
         _id = await insert_returning(
@@ -157,7 +209,7 @@ class MessageGroup(TableID):
         )
         if _id is None:
             _id = await conn.fetchval(
-                "SELECT id FROM ai.message_group WHERE internal_code = $1 and group_method_id = $2",
+                "SELECT id FROM ai.message_groups WHERE internal_code = $1 and group_method_id = $2",
                 self.internal_code,
                 self.group_method_id,
             )
@@ -192,6 +244,7 @@ class MessageGroupChat(TableID):
 @dataclass
 class MistralGroupEmbeddings(TableID):
     group_id: int
+    chat_id: int
     embedding: list[float]
     last_processed_at: dt.datetime | None = None
 
@@ -226,9 +279,106 @@ class MistralGroupEmbeddings(TableID):
                          """,
         )
 
+    @staticmethod
+    async def set_search_params(conn: asyncpg.Connection, params: VectorSearchParams | None = None):
+        """
+        Set the ANN search parameters for the rest of the current transaction.
+        Iterative scans keep reading the index until enough rows match the filters of the query
+        (e.g. the chat), instead of returning less than `limit` rows. They require pgvector 0.8
+        (checked by `db setup`).
+        """
+        params = params or {}
+        await conn.execute(
+            """
+            select set_config('hnsw.iterative_scan', 'relaxed_order', true),
+                   set_config('ivfflat.iterative_scan', 'relaxed_order', true)
+            """
+        )
+        if (ef_search := params.get("ef_search")) is not None:
+            await conn.execute("select set_config('hnsw.ef_search', $1, true)", str(ef_search))
+        if (probes := params.get("probes")) is not None:
+            await conn.execute("select set_config('ivfflat.probes', $1, true)", str(probes))
+
+    @staticmethod
+    async def search_nearest(
+        conn: asyncpg.Connection,
+        embedding: list[float],
+        chat_id: int,
+        limit: int,
+        params: VectorSearchParams | None = None,
+    ) -> list[asyncpg.Record]:
+        """Return the `group_id` and `distance` of the `limit` groups of the chat closest to `embedding`."""
+        async with conn.transaction():
+            await MistralGroupEmbeddings.set_search_params(conn, params)
+            results = await conn.fetch(NEAREST_GROUPS_QUERY, embedding, limit, chat_id)
+        # Iterative scans in relaxed order may return rows slightly out of order
+        return sorted(results, key=lambda x: x["distance"])
+
+    @staticmethod
+    async def create_index(
+        conn: asyncpg.Connection,
+        method: VectorIndexMethod = "hnsw",
+        *,
+        m: int = 16,
+        ef_construction: int = 64,
+        lists: int | None = None,
+        concurrently: bool = False,
+    ):
+        """
+        (Re)create the ANN index of the embeddings with `method`, replacing any existing one.
+        IVFFlat lists are computed from the rows at build time, so the index should be rebuilt once
+        the table grew significantly. `lists` defaults to rows / 1000, or sqrt(rows) above 1M rows.
+        `concurrently` does not lock the table for writes, but cannot run inside a transaction.
+        The new index is built under a temporary name and only replaces the existing one once built,
+        so searches keep using an index meanwhile.
+        """
+        _concurrently = "CONCURRENTLY " if concurrently else ""
+        index_name = _EMBEDDINGS_INDEXES[method]
+        tmp_index_name = f"{index_name}_tmp"
+        # Left (invalid) by an interrupted concurrent build
+        await conn.execute(f"DROP INDEX {_concurrently}IF EXISTS ai.{tmp_index_name}")
+        match method:
+            case "hnsw":
+                options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+            case "ivfflat":
+                if lists is None:
+                    nb_rows = await conn.fetchval("SELECT count(*) FROM ai.mistral_group_embeddings")
+                    lists = nb_rows // 1000 if nb_rows <= 1_000_000 else int(nb_rows**0.5)
+                options = f"lists = {max(int(lists), 1)}"
+            case _:
+                raise ValueError(f"Unsupported index method {method!r}")
+        await conn.execute(
+            f"""
+            CREATE INDEX {_concurrently}{tmp_index_name} ON ai.mistral_group_embeddings
+                USING {method} (embedding vector_cosine_ops) WITH ({options})
+            """
+        )
+        for _index_name in _EMBEDDINGS_INDEXES.values():
+            await conn.execute(f"DROP INDEX {_concurrently}IF EXISTS ai.{_index_name}")
+        await conn.execute(f"ALTER INDEX ai.{tmp_index_name} RENAME TO {index_name}")
+
 
 RequestType = Literal["chat", "embedding", "completion"]
 
+# Monthly partitions of `ai.requests`, named after their month (e.g. `requests_202405`)
+_REQUESTS_PARTITION = re.compile(r"^requests_(\d{4})(\d{2})$")
+
+
+def _add_months(day: dt.date, months: int) -> dt.date:
+    """First day of the month, `months` after the month of `day`."""
+    _month = day.year * 12 + day.month - 1 + months
+    return dt.date(_month // 12, _month % 12 + 1, 1)
+
+
+def _month_bound(day: dt.date) -> dt.datetime:
+    return dt.datetime(day.year, day.month, 1, tzinfo=dt.timezone.utc)
+
+
+def _compress_payload(payload: dict) -> bytes:
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(
+        orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    )
+
 
 @dataclass
 class Requests(TableID):
@@ -264,10 +414,134 @@ class Requests(TableID):
             user_id=user_id,
         )
 
-    async def save(self, conn: asyncpg.Connection):
-        data = self.data
-        await insert_one(conn, "ai.requests", data)
+    @property
+    def data(self) -> dict:
+        _data = super().data
+        # Compressed with zstd before being saved, see `Requests.get_payload`
+        payload = _data.pop("payload")
+        _data["payload_zstd"] = _compress_payload(payload) if payload is not None else None
+        return _data
+
+    async def save(self, conn: asyncpg.Connection) -> int:
+        _data = await insert_returning(conn, "ai.requests", self.data, returning=["id", "created_at"])
+        self._id, self._created_at = _data["id"], _data["created_at"]
+        return _data["id"]
+
+    @staticmethod
+    async def update_meta(conn: asyncpg.Connection, request_id: int, created_at: dt.datetime, meta: dict) -> int:
+        """
+        Merge `meta` into the meta of a single request, returns the number of updated rows.
+        `created_at` is the partition key, so that only the partition of the request is scanned.
+        """
+        status = await conn.execute(
+            "UPDATE ai.requests SET meta = COALESCE(meta, '{}') || $3::jsonb WHERE id = $1 AND created_at = $2",
+            request_id,
+            created_at,
+            meta,
+        )
+        return int(status.split()[-1])
+
+    @staticmethod
+    async def get_payload(conn: asyncpg.Connection, request_id: int, created_at: dt.datetime) -> dict | None:
+        """Returns the payload of a request, the requests saved before it was compressed have it as JSONB."""
+        row = await conn.fetchrow(
+            "SELECT payload, payload_zstd FROM ai.requests WHERE id = $1 AND created_at = $2", request_id, created_at
+        )
+        if row is None:
+            return None
+        if row["payload_zstd"] is not None:
+            return orjson.loads(zstandard.ZstdDecompressor().decompress(row["payload_zstd"]))
+        return row["payload"]
+
+    @staticmethod
+    async def is_partitioned(conn: asyncpg.Connection) -> bool:
+        relkind = await conn.fetchval("SELECT relkind FROM pg_class WHERE oid = 'ai.requests'::regclass")
+        return relkind == "p"
+
+    @staticmethod
+    async def get_partitions(conn: asyncpg.Connection) -> dict[dt.date, str]:
+        """Returns the monthly partitions of the requests by month."""
+        query = """
+                SELECT c.relname
+                FROM pg_inherits i
+                         JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'ai.requests'::regclass
+                """
+        partitions = {}
+        for row in await conn.fetch(query):
+            if _match := _REQUESTS_PARTITION.match(row["relname"]):
+                partitions[dt.date(int(_match[1]), int(_match[2]), 1)] = row["relname"]
+        return partitions
+
+    @staticmethod
+    async def create_partitions(
+        conn: asyncpg.Connection, from_month: dt.date | None = None, months_ahead: int = 3
+    ) -> list[str]:
+        """
+        Create the missing monthly partitions, from the month of `from_month` (the current one by default)
+        to `months_ahead` months after the current one.
+        The rows already saved in the default partition for these months are moved to their partition.
+        """
+        today = dt.datetime.now(dt.timezone.utc).date()
+        month = _add_months(from_month or today, 0)
+        existing = await Requests.get_partitions(conn)
+        created = []
+        while month <= _add_months(today, months_ahead):
+            if month not in existing:
+                name = f"requests_{month:%Y%m}"
+                start, end = _month_bound(month), _month_bound(_add_months(month, 1))
+                async with conn.transaction():
+                    # Attaching a table only locks the parent in SHARE UPDATE EXCLUSIVE mode, but the default
+                    # partition is locked until the transaction ends: no request of the month can be saved to it
+                    # once its rows are moved, and the requests routed to the default partition wait meanwhile
+                    await conn.execute("LOCK TABLE ai.requests_default IN SHARE ROW EXCLUSIVE MODE")
+                    await conn.execute(
+                        f"""
+                        CREATE TABLE ai.{name}
+                        (
+                            LIKE ai.requests
+                                INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING COMPRESSION INCLUDING STORAGE
+                        )
+                        """
+                    )
+                    await conn.execute(
+                        f"""
+                        WITH moved AS (DELETE FROM ai.requests_default
+                                       WHERE created_at >= $1
+                                         AND created_at < $2
+                                       RETURNING *)
+                        INSERT INTO ai.{name} SELECT * FROM moved
+                        """,
+                        start,
+                        end,
+                    )
+                    await conn.execute(
+                        f"""
+                        ALTER TABLE ai.requests ATTACH PARTITION ai.{name}
+                            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+                        """
+                    )
+                created.append(name)
+            month = _add_months(month, 1)
+        return created
 
     @staticmethod
-    async def update(conn: asyncpg.Connection, data: dict):
-        await update_one(conn, "ai.requests", data, keys=["run_id"], merge_keys=["meta"])
+    async def drop_partitions(conn: asyncpg.Connection, keep_months: int) -> list[str]:
+        """
+        Drop the monthly partitions (and their requests) older than the last `keep_months` months,
+        the current month included. The expired requests left in the default partition are deleted.
+        """
+        if keep_months < 1:
+            raise ValueError("At least the current month must be kept")
+        before = _add_months(dt.datetime.now(dt.timezone.utc).date(), 1 - keep_months)
+        dropped = []
+        for month, name in sorted((await Requests.get_partitions(conn)).items()):
+            if _add_months(month, 1) > before:
+                break
+            await conn.execute(f"DROP TABLE ai.{name}")
+            dropped.append(name)
+        # Saved before their month had a partition, and not moved since (the partition was never created)
+        status = await conn.execute("DELETE FROM ai.requests_default WHERE created_at < $1", _month_bound(before))
+        if (nb_deleted := int(status.split()[-1])) > 0:
+            logs.info(f"Deleted {nb_deleted} expired requests from the default partition")
+        return dropped
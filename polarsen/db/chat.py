@@ -1,28 +1,48 @@
+from __future__ import annotations
+
 import datetime as dt
 from dataclasses import dataclass, field, asdict
+from typing import AsyncIterator, Iterable, Literal, TypedDict
 
 import asyncpg
 from rich.progress import track
 from tracktolib.pg import insert_many, PGConflictQuery, insert_returning
 
 from polarsen.logs import logs
-from .utils import TableID
+from polarsen.utils import iter_json_object, abatched
+from .utils import TableID, copy_upsert
 
 __all__ = (
     "DBChatUser",
     "DBChatMessage",
+    "DBChatMessageRow",
     "TelegramTextEntity",
+    "fmt_text",
     "TelegramMessage",
+    "TelegramMessageRow",
     "TelegramGroup",
     "CHAT_SOURCE_MAPPING",
     "DbChat",
     "ChatUpload",
+    "UploadMetrics",
+    "INGEST_BATCH_SIZE",
+    "IngestMode",
+    "DEFAULT_INGEST_MODE",
 )
 
 CHAT_SOURCE_MAPPING = {
     "telegram": 0,
 }
 
+# Number of messages saved at once when ingesting an export in stream mode
+INGEST_BATCH_SIZE = 5_000
+
+# How chat users and messages are written:
+# - insert: multi-row INSERT ... ON CONFLICT
+# - copy: binary COPY into a staging table, then a single merge
+IngestMode = Literal["insert", "copy"]
+DEFAULT_INGEST_MODE: IngestMode = "copy"
+
 
 @dataclass
 class DBChatUser(TableID):
@@ -47,6 +67,19 @@ class DBChatUser(TableID):
             on_conflict=PGConflictQuery(keys=["chat_source_id", "internal_code"]),
         )
 
+    @staticmethod
+    async def copy_save(conn: asyncpg.Connection, users: list["DBChatUser"]) -> dict[str, int]:
+        """Save the users using COPY and return a mapping of internal_code to chat user ID."""
+        _data = await copy_upsert(
+            conn,
+            "general.chat_users",
+            columns=("username", "internal_code", "chat_id", "chat_source_id"),
+            records=((u.username, u.internal_code, u.chat_id, u.chat_source_id) for u in users),
+            conflict_keys=("chat_source_id", "internal_code"),
+            returning=("id", "internal_code"),
+        )
+        return {x["internal_code"]: x["id"] for x in _data}
+
     @staticmethod
     async def get_ids(conn: asyncpg.Connection, internal_codes: list[str]) -> dict[str, int]:
         query = "SELECT id, internal_code FROM general.chat_users WHERE internal_code = ANY($1)"
@@ -144,6 +177,58 @@ class DbChat(TableID):
             chat_ids,
         )
 
+    @staticmethod
+    async def add_pending_days(conn: asyncpg.Connection, chat_id: int, days: list[dt.date]) -> None:
+        """Flag days of the chat that received new messages, so they are segmented again."""
+        await conn.execute(
+            """
+            UPDATE general.chats
+            SET meta = jsonb_set(COALESCE(meta, '{}'), '{pending_days}', (
+                SELECT jsonb_agg(d ORDER BY d)
+                FROM (SELECT jsonb_array_elements_text(COALESCE(meta -> 'pending_days', '[]')) AS d
+                      UNION
+                      SELECT unnest($2::text[])) _days
+            ))
+            WHERE id = $1
+            """,
+            chat_id,
+            [x.isoformat() for x in days],
+        )
+
+    @staticmethod
+    async def get_pending_days(conn: asyncpg.Connection, chat_id: int) -> set[dt.date]:
+        """Return the days of the chat flagged to be segmented again."""
+        _data = await conn.fetch(
+            """
+            SELECT jsonb_array_elements_text(meta -> 'pending_days')::date AS day
+            FROM general.chats
+            WHERE id = $1
+            """,
+            chat_id,
+        )
+        return {x["day"] for x in _data}
+
+    @staticmethod
+    async def clear_pending_days(conn: asyncpg.Connection, chat_id: int, days: list[dt.date]) -> None:
+        """Remove `days` from the days of the chat to segment again."""
+        await conn.execute(
+            """
+            UPDATE general.chats
+            SET meta = jsonb_set(meta, '{pending_days}', (meta -> 'pending_days') - $2::text[])
+            WHERE id = $1
+              AND meta ? 'pending_days'
+            """,
+            chat_id,
+            [x.isoformat() for x in days],
+        )
+
+
+# thread_root_id, depth
+type MessageThread = tuple[int, int]
+
+# id, chat_id, chat_user_id, sent_at, internal_code, message, reply_to_id, thread_root_id, depth
+type DBChatMessageRow = tuple[int, int, int, dt.datetime, str, str, int | None, int, int]
+
 
 @dataclass
 class DBChatMessage(TableID):
@@ -153,10 +238,16 @@ class DBChatMessage(TableID):
     internal_code: str
     message: str
     reply_to_id: int | None = None
+    thread_root_id: int | None = None
+    """First message of the reply thread, the message itself if it is not a reply"""
+    depth: int = 0
+    """Depth of the message in the reply thread"""
 
     @property
     def data(self):
         _data = super().data
+        if _data["thread_root_id"] is None:
+            _data["thread_root_id"] = _data.get("id")
         return _data
 
     @staticmethod
@@ -165,17 +256,98 @@ class DBChatMessage(TableID):
             conn,
             "general.chat_messages",
             [m.data for m in messages],
-            on_conflict=PGConflictQuery(keys=["chat_user_id", "internal_code"]),
+            on_conflict=PGConflictQuery(keys=["chat_id", "chat_user_id", "internal_code"], ignore_keys=["id"]),
+        )
+
+    @property
+    def row(self) -> DBChatMessageRow:
+        return (
+            self.id,
+            self.chat_id,
+            self.chat_user_id,
+            self.sent_at,
+            self.internal_code,
+            self.message,
+            self.reply_to_id,
+            self.thread_root_id if self.thread_root_id is not None else self.id,
+            self.depth,
         )
 
     @staticmethod
-    async def get_ids(conn: asyncpg.Connection, internal_codes: list[str]) -> dict[str, int]:
-        query = "SELECT id, internal_code FROM general.chat_messages WHERE internal_code = ANY($1)"
-        _data = await conn.fetch(query, internal_codes)
-        return {x["internal_code"]: x["id"] for x in _data}
+    async def copy_save(conn: asyncpg.Connection, messages: list["DBChatMessage"]) -> None:
+        """Save the messages, with their already reserved IDs, using COPY."""
+        await DBChatMessage.copy_save_rows(conn, (m.row for m in messages))
+
+    @staticmethod
+    async def copy_save_rows(conn: asyncpg.Connection, rows: Iterable[DBChatMessageRow]) -> None:
+        """Save message rows (see `DBChatMessageRow`), with their already reserved IDs, using COPY."""
+        await copy_upsert(
+            conn,
+            "general.chat_messages",
+            columns=(
+                "id",
+                "chat_id",
+                "chat_user_id",
+                "sent_at",
+                "internal_code",
+                "message",
+                "reply_to_id",
+                "thread_root_id",
+                "depth",
+            ),
+            records=rows,
+            conflict_keys=("chat_id", "chat_user_id", "internal_code"),
+            ignore_keys=("id",),
+        )
 
+    @staticmethod
+    async def reserve_ids(conn: asyncpg.Connection, nb: int) -> list[int]:
+        """Reserve `nb` message IDs from the identity sequence of the table, in a single query."""
+        query = """
+                SELECT nextval(pg_get_serial_sequence('general.chat_messages', 'id'))
+                FROM generate_series(1, $1)
+                """
+        return [x[0] for x in await conn.fetch(query, nb)]
 
-@dataclass
+    @staticmethod
+    async def get_watermark(conn: asyncpg.Connection, chat_id: int) -> tuple[int | None, dt.datetime | None]:
+        """Return the highest message internal_code (as an integer) and sent_at already saved for the chat."""
+        query = """
+                SELECT MAX(internal_code::BIGINT) AS internal_code, MAX(sent_at) AS sent_at
+                FROM general.chat_messages
+                WHERE chat_id = $1
+                """
+        _data = await conn.fetchrow(query, chat_id)
+        return _data["internal_code"], _data["sent_at"]
+
+    @staticmethod
+    async def get_ids(conn: asyncpg.Connection, chat_id: int, internal_codes: list[str]) -> dict[str, int]:
+        """Given a list of internal_codes of a chat, return a mapping of internal_code to message ID."""
+        # A plain `chat_id = $1` (rather than an optional filter) so that partitions are pruned with generic plans
+        query = """
+                SELECT id, internal_code
+                FROM general.chat_messages
+                WHERE chat_id = $1
+                  AND internal_code = ANY ($2)
+                """
+        _data = await conn.fetch(query, chat_id, internal_codes)
+        return {x["internal_code"]: x["id"] for x in _data}
+
+    @staticmethod
+    async def get_threads(conn: asyncpg.Connection, chat_id: int, ids: list[int]) -> dict[int, MessageThread]:
+        """Return the thread root and depth of the messages of a chat, among `ids`, that are replies."""
+        query = """
+                SELECT id, thread_root_id, depth
+                FROM general.chat_messages
+                WHERE chat_id = $1
+                  AND id = ANY ($2)
+                  AND depth > 0
+                """
+        _data = await conn.fetch(query, chat_id, ids)
+        return {x["id"]: (x["thread_root_id"], x["depth"]) for x in _data}
+
+
+@dataclass(slots=True)
 class TelegramTextEntity:
     type: str
     text: str
@@ -183,14 +355,14 @@ class TelegramTextEntity:
     document_id: str | None = None
 
 
-def _fmt_text(text: str | dict | list[str | dict]) -> str:
+def fmt_text(text: str | dict | list[str | dict]) -> str:
     """
-    Format text with entities
+    Format the text of a Telegram message, joining the text of its entities
     """
     if isinstance(text, str):
         return text
     if isinstance(text, list):
-        return " ".join([_fmt_text(t) for t in text])
+        return " ".join([fmt_text(t) for t in text])
 
     if not isinstance(text, dict):
         raise ValueError(f"Invalid text format: {text}")
@@ -201,8 +373,17 @@ def _fmt_text(text: str | dict | list[str | dict]) -> str:
     return _text
 
 
-@dataclass
+# chat_id, message_id, message_type, message_date, from_user_id, from_user, text, reply_to_message_id
+type TelegramMessageRow = tuple[int, int, str, dt.datetime, int, str, str, int | None]
+
+
+@dataclass(slots=True)
 class TelegramMessage:
+    """
+    A message of a Telegram export.
+    Slotted, with text entities (never saved) only loaded on demand, to keep large exports small in memory.
+    """
+
     chat_id: int
     message_id: int
     message_type: str
@@ -210,7 +391,7 @@ class TelegramMessage:
     from_user_id: int
     from_user: str
     text: str
-    text_entities: list[TelegramTextEntity] = field(default_factory=list)
+    text_entities: tuple[TelegramTextEntity, ...] = ()
     reply_to_message_id: int | None = None
 
     @property
@@ -218,12 +399,12 @@ class TelegramMessage:
         return asdict(self)
 
     @classmethod
-    def load(cls, chat_id: int, msg: dict):
+    def load(cls, chat_id: int, msg: dict, with_entities: bool = False):
         if msg.get("action") is not None:
             return
 
         try:
-            _text = _fmt_text(msg["text"])
+            _text = fmt_text(msg["text"])
             if _text is None:
                 return
 
@@ -235,7 +416,7 @@ class TelegramMessage:
                 from_user_id=msg["from_id"],
                 from_user=msg["from"],
                 text=_text,
-                text_entities=[TelegramTextEntity(**te) for te in msg["text_entities"]],
+                text_entities=tuple(TelegramTextEntity(**te) for te in msg["text_entities"]) if with_entities else (),
                 reply_to_message_id=msg.get("reply_to_message_id"),
             )
         except (KeyError, TypeError) as e:
@@ -244,8 +425,43 @@ class TelegramMessage:
             pprint.pprint(msg)
             raise e
 
-    def to_db_message(self, chat_id: int, chat_user_id: int, reply_to_chat_id: int | None = None) -> DBChatMessage:
-        return DBChatMessage(
+    def to_row(self) -> TelegramMessageRow:
+        """Compact representation of the message, cheap to pickle (text entities are not kept)."""
+        return (
+            self.chat_id,
+            self.message_id,
+            self.message_type,
+            self.message_date,
+            self.from_user_id,
+            self.from_user,
+            self.text,
+            self.reply_to_message_id,
+        )
+
+    @classmethod
+    def from_row(cls, row: TelegramMessageRow) -> TelegramMessage:
+        chat_id, message_id, message_type, message_date, from_user_id, from_user, text, reply_to_message_id = row
+        return cls(
+            chat_id=chat_id,
+            message_id=message_id,
+            message_type=message_type,
+            message_date=message_date,
+            from_user_id=from_user_id,
+            from_user=from_user,
+            text=text,
+            reply_to_message_id=reply_to_message_id,
+        )
+
+    def to_db_message(
+        self,
+        chat_id: int,
+        chat_user_id: int,
+        reply_to_chat_id: int | None = None,
+        db_id: int | None = None,
+        thread: MessageThread | None = None,
+    ) -> DBChatMessage:
+        """Convert to a chat message, `thread` is the thread root and depth of a reply (top-level by default)."""
+        _message = DBChatMessage(
             chat_id=chat_id,
             internal_code=str(self.message_id),
             sent_at=self.message_date,
@@ -253,6 +469,32 @@ class TelegramMessage:
             chat_user_id=chat_user_id,
             reply_to_id=reply_to_chat_id,
         )
+        if thread is not None:
+            _message.thread_root_id, _message.depth = thread
+        _message._id = db_id
+        return _message
+
+    def to_db_row(
+        self,
+        chat_id: int,
+        chat_user_id: int,
+        reply_to_chat_id: int | None,
+        db_id: int,
+        thread: MessageThread | None = None,
+    ) -> DBChatMessageRow:
+        """Same as `to_db_message`, as a row ready to be copied (see `DBChatMessage.copy_save_rows`)."""
+        thread_root_id, depth = thread if thread is not None else (db_id, 0)
+        return (
+            db_id,
+            chat_id,
+            chat_user_id,
+            self.message_date,
+            str(self.message_id),
+            self.text,
+            reply_to_chat_id,
+            thread_root_id,
+            depth,
+        )
 
     def to_db_user(self, chat_id: int) -> DBChatUser:
         return DBChatUser(
@@ -269,6 +511,14 @@ class TelegramGroup:
     group_type: str
     group_id: int
     messages: list[TelegramMessage] = field(default_factory=list)
+    _chat_user_ids: dict[str, int] = field(default_factory=dict, init=False, repr=False)
+    """Cache of the saved chat users (internal_code -> ID)"""
+    _watermark_read: bool = field(default=False, init=False, repr=False)
+    """Whether the watermark was read, on the first batch in delta mode"""
+    _watermark: int | None = field(default=None, init=False, repr=False)
+    """Highest message ID already saved for the chat, older messages are skipped in delta mode"""
+    nb_skipped: int = field(default=0, init=False, repr=False)
+    """Number of messages of the export that are not supported (service messages, ...) and were not loaded"""
 
     @classmethod
     def load(cls, group: dict, *, show_progress: bool = False):
@@ -284,67 +534,237 @@ class TelegramGroup:
         if nb_skipped > 0:
             logs.warning(f"Skipped {nb_skipped} messages")
 
+        _group = cls._load_header(group, messages=messages)
+        _group.nb_skipped = nb_skipped
+        return _group
+
+    @classmethod
+    def _load_header(cls, group: dict, messages: list[TelegramMessage] | None = None):
         try:
-            return cls(name=group["name"], group_type=group["type"], group_id=group["id"], messages=messages)
+            return cls(name=group["name"], group_type=group["type"], group_id=group["id"], messages=messages or [])
         except KeyError as e:
             import pprint
 
             pprint.pprint(group)
             raise e
 
+    @classmethod
+    async def load_stream(cls, data: AsyncIterator[bytes]) -> tuple[TelegramGroup, AsyncIterator[TelegramMessage]]:
+        """
+        Incrementally load a group from the byte stream of a Telegram export.
+        Returns the group (without messages) and an iterator yielding its messages one by one,
+        so the export is never fully loaded in memory.
+        The group fields must come before the messages in the export, as in Telegram exports.
+        """
+        items = iter_json_object(data, stream_keys={"messages"})
+        header = {}
+        first_msg: dict | None = None
+        async for key, value in items:
+            if key == "messages":
+                first_msg = value
+                break
+            header[key] = value
+        group = cls._load_header(header)
+
+        async def _iter_messages() -> AsyncIterator[TelegramMessage]:
+            if first_msg is None:
+                return
+            _msg = TelegramMessage.load(chat_id=first_msg["id"], msg=first_msg)
+            if _msg is not None:
+                yield _msg
+            else:
+                group.nb_skipped += 1
+            async for _key, msg in items:
+                if _key != "messages":
+                    continue
+                _msg = TelegramMessage.load(chat_id=msg["id"], msg=msg)
+                if _msg is not None:
+                    yield _msg
+                else:
+                    group.nb_skipped += 1
+            if group.nb_skipped > 0:
+                logs.warning(f"Skipped {group.nb_skipped} messages")
+
+        return group, _iter_messages()
+
     def to_db_chat(self, created_by: int) -> DbChat:
         return DbChat(internal_code=str(self.group_id), name=self.name, created_by=created_by)
 
-    async def save(self, conn: asyncpg.Connection, created_by: int) -> int:
+    async def save_chat(self, conn: asyncpg.Connection, created_by: int) -> int:
         """
-        Save the group, its users and messages to the database.
-        Return the chat ID.
+        Save the group chat to the database and return its ID.
+        The chat is locked until the end of the transaction: concurrent saves of the chat (e.g. uploads
+        of the same chat processed by different workers) wait for this one, so the message IDs reserved
+        by a save (see `save_messages`) are never referenced by another before being written.
         """
-        # Chat
         db_chat = self.to_db_chat(created_by=created_by)
         await DbChat.bulk_save(conn, [db_chat])
-        chat_ids = await DbChat.get_ids(conn, [db_chat.internal_code])
-        chat_id = chat_ids[str(self.group_id)]
+        return await conn.fetchval(
+            "SELECT id FROM general.chats WHERE internal_code = $1 FOR UPDATE", db_chat.internal_code
+        )
+
+    async def save_messages(
+        self,
+        conn: asyncpg.Connection,
+        chat_id: int,
+        messages: list[TelegramMessage],
+        mode: IngestMode = DEFAULT_INGEST_MODE,
+        delta: bool = True,
+    ) -> int:
+        """
+        Save a batch of messages and their users to the database, returns the number of messages saved.
+        Message IDs are reserved up front from the table sequence, so replies are resolved in memory
+        (whatever the depth of the thread) and all messages are written at once, without reading IDs back.
+        Only the IDs of the messages of the batch and of the parents of its replies are looked up,
+        so memory does not grow with the chat (previous batches are read back from the table).
+        Replies to a message that is neither saved yet nor part of the batch are saved without parent.
+        The thread root and depth of the replies are resolved the same way (see `DBChatMessage.thread_root_id`).
+
+        In `delta` mode, messages older than the highest message already saved for the chat (the watermark,
+        read on the first batch) are skipped, and the days receiving new messages are flagged
+        for segmentation (see `DbChat.add_pending_days`). Otherwise, all the messages are upserted.
+        """
+        if delta and not self._watermark_read:
+            self._watermark_read = True
+            self._watermark, _sent_at = await DBChatMessage.get_watermark(conn, chat_id)
+            if self._watermark is not None:
+                logs.info(f"Chat {chat_id} already saved up to message {self._watermark} ({_sent_at})")
+        watermark = self._watermark
+        if watermark is not None:
+            _nb_messages = len(messages)
+            messages = [m for m in messages if m.message_id > watermark]
+            if len(messages) < _nb_messages:
+                logs.debug(f"Skipped {_nb_messages - len(messages)} messages already saved")
+            if not messages:
+                return 0
         # Chat users
-        chat_users = {m.from_user_id: m.to_db_user(chat_id=chat_id) for m in self.messages if m is not None}
-        if not chat_users:
-            logs.warning("No chat users to save, skipping")
-            return chat_id
-        logs.info(f"Saving {len(chat_users)} chat users")
-        await DBChatUser.bulk_save(conn, list(chat_users.values()))
-        db_users = await DBChatUser.get_ids(conn, [x.internal_code for x in chat_users.values()])
-        chat_user_ids = {m.internal_code: db_users[m.internal_code] for m in chat_users.values()}
-        # Chat messages
-        messages, response_messages = [], []
-        for m in self.messages:
-            if m is None:
-                continue
-            if m.reply_to_message_id is None:
-                messages.append(m.to_db_message(chat_user_id=chat_user_ids[str(m.from_user_id)], chat_id=chat_id))
+        chat_users = {
+            m.from_user_id: m.to_db_user(chat_id=chat_id)
+            for m in messages
+            if str(m.from_user_id) not in self._chat_user_ids
+        }
+        if chat_users:
+            logs.debug(f"Saving {len(chat_users)} chat users")
+            _users = list(chat_users.values())
+            if mode == "copy":
+                self._chat_user_ids |= await DBChatUser.copy_save(conn, _users)
             else:
-                response_messages.append(m)
-        logs.info(f"Saving {len(messages)} chat messages")
-        await DBChatMessage.bulk_save(conn, messages)
-
-        _msg_internal_codes = {m.internal_code for m in messages} | {str(m.chat_id) for m in response_messages}
-        message_ids = await DBChatMessage.get_ids(conn, list(_msg_internal_codes))
-
-        reply_messages = [
-            m.to_db_message(
-                chat_user_id=chat_user_ids[str(m.from_user_id)],
-                chat_id=chat_id,
-                reply_to_chat_id=message_ids[str(m.reply_to_message_id)],
+                await DBChatUser.bulk_save(conn, _users)
+                self._chat_user_ids |= await DBChatUser.get_ids(conn, [x.internal_code for x in _users])
+        chat_user_ids = self._chat_user_ids
+        # Message IDs: already saved messages keep theirs, new ones get a reserved ID
+        batch_codes = {str(m.message_id) for m in messages}
+        parent_codes = {str(m.reply_to_message_id) for m in messages if m.reply_to_message_id is not None}
+        parent_codes -= batch_codes
+        # In delta mode, the messages of the batch are newer than the saved ones
+        _codes = parent_codes if delta else parent_codes | batch_codes
+        message_ids = await DBChatMessage.get_ids(conn, chat_id, list(_codes)) if _codes else {}
+        _parent_ids = [message_ids[x] for x in parent_codes if x in message_ids]
+        threads = await DBChatMessage.get_threads(conn, chat_id, _parent_ids) if _parent_ids else {}
+        _new_codes = list(dict.fromkeys(str(m.message_id) for m in messages if str(m.message_id) not in message_ids))
+        if _new_codes:
+            message_ids.update(zip(_new_codes, await DBChatMessage.reserve_ids(conn, len(_new_codes))))
+        # Chat messages, converted straight to rows in copy mode
+        _to_db = TelegramMessage.to_db_row if mode == "copy" else TelegramMessage.to_db_message
+        _messages, nb_orphans = [], 0
+        for m in messages:
+            reply_to_id, thread, db_id = None, None, message_ids[str(m.message_id)]
+            if m.reply_to_message_id is not None:
+                reply_to_id = message_ids.get(str(m.reply_to_message_id))
+                nb_orphans += reply_to_id is None
+            if reply_to_id is not None:
+                # Replies come after their parent in exports, whose thread is known by now
+                thread_root_id, depth = threads.get(reply_to_id, (reply_to_id, 0))
+                thread = threads[db_id] = (thread_root_id, depth + 1)
+            _messages.append(
+                _to_db(
+                    m,
+                    chat_id=chat_id,
+                    chat_user_id=chat_user_ids[str(m.from_user_id)],
+                    reply_to_chat_id=reply_to_id,
+                    db_id=db_id,
+                    thread=thread,
+                )
             )
-            for m in response_messages
-            if message_ids.get(str(m.reply_to_message_id)) is not None
-        ]
-        if reply_messages:
-            logs.info(f"Saving {len(reply_messages)} reply chat messages")
-            await DBChatMessage.bulk_save(conn, reply_messages)
+        if nb_orphans:
+            logs.warning(f"{nb_orphans} replies to unknown messages will be saved without their parent")
+        logs.debug(f"Saving {len(_messages)} chat messages")
+        if mode == "copy":
+            await DBChatMessage.copy_save_rows(conn, _messages)
+        else:
+            await DBChatMessage.bulk_save(conn, _messages)
+        if watermark is not None:
+            await DbChat.add_pending_days(conn, chat_id, sorted({m.message_date.date() for m in messages}))
+        return len(_messages)
+
+    async def save(
+        self, conn: asyncpg.Connection, created_by: int, mode: IngestMode = DEFAULT_INGEST_MODE, delta: bool = True
+    ) -> int:
+        """
+        Save the group, its users and messages to the database.
+        In `delta` mode, only the messages newer than the ones already saved for the chat are saved.
+        Return the chat ID.
+        """
+        async with conn.transaction():
+            chat_id = await self.save_chat(conn, created_by=created_by)
+            if not self.messages:
+                logs.warning("No chat users to save, skipping")
+                return chat_id
+            logs.info(f"Saving {len(self.messages)} chat messages")
+            await self.save_messages(conn, chat_id=chat_id, messages=self.messages, mode=mode, delta=delta)
+        return chat_id
 
+    @classmethod
+    async def save_stream(
+        cls,
+        conn: asyncpg.Connection,
+        data: AsyncIterator[bytes],
+        created_by: int,
+        *,
+        batch_size: int = INGEST_BATCH_SIZE,
+        mode: IngestMode = DEFAULT_INGEST_MODE,
+        delta: bool = True,
+    ) -> int:
+        """
+        Incrementally load a Telegram export from a byte stream and save it to the database
+        in batches of `batch_size` messages, keeping memory usage independent of the export size.
+        In `delta` mode, only the messages newer than the ones already saved for the chat are saved.
+        Return the chat ID.
+        """
+        group, messages = await cls.load_stream(data)
+        nb_messages = 0
+        # The chat stays locked while its messages are saved (see `save_chat`)
+        async with conn.transaction():
+            chat_id = await group.save_chat(conn, created_by=created_by)
+            async for batch in abatched(messages, batch_size):
+                await group.save_messages(conn, chat_id=chat_id, messages=batch, mode=mode, delta=delta)
+                nb_messages += len(batch)
+                logs.debug(f"Saved {nb_messages} chat messages")
+        if not nb_messages:
+            logs.warning("No chat messages to save")
+        else:
+            logs.info(f"Saved {nb_messages} chat messages")
         return chat_id
 
 
+class UploadMetrics(TypedDict, total=False):
+    """Metrics of the processing of an upload, stored in the `metrics` key of `general.chat_uploads.meta`."""
+
+    bytes_downloaded: int
+    download_ms: int
+    parse_ms: int
+    # Messages loaded from the export / not supported (service messages, ...)
+    messages_parsed: int
+    messages_skipped: int
+    # Messages already saved by a previous upload of the chat (see `TelegramGroup.save_messages`)
+    messages_already_saved: int
+    rows_inserted: int
+    db_ms: int
+    # Peak resident memory of the processes that handled the upload, since they started: it is not reset
+    # between uploads, so it is an upper bound of the memory used by the upload
+    process_peak_rss_kb: int
+
+
 @dataclass
 class ChatUpload(TableID):
     user_id: int
@@ -355,6 +775,8 @@ class ChatUpload(TableID):
     file_path: str
     chat_type_id: int
     processed_at: dt.datetime | None = None
+    compression: Literal["zstd", "zip"] | None = None
+    """Compression of the object stored in S3 (see `polarsen.compression`)"""
 
     @property
     def data(self) -> dict:
@@ -366,6 +788,7 @@ class ChatUpload(TableID):
             "file_size": self.file_size,
             "file_path": self.file_path,
             "chat_type_id": self.chat_type_id,
+            "compression": self.compression,
         }
 
     async def save(self, conn: asyncpg.Connection) -> int:
@@ -377,14 +800,83 @@ class ChatUpload(TableID):
         return _data["id"]
 
     @staticmethod
-    async def mark_processed(conn: asyncpg.Connection, chat_id: int, upload_id: int) -> None:
+    async def get_id_by_md5(conn: asyncpg.Connection, user_id: int, md5: str) -> int | None:
+        """Get the ID of the file with the given MD5 already uploaded by the user, if any."""
+        return await conn.fetchval(
+            "SELECT id FROM general.chat_uploads WHERE user_id = $1 AND md5 = $2",
+            user_id,
+            md5,
+        )
+
+    @staticmethod
+    async def get_saved_paths(conn: asyncpg.Connection, file_paths: list[str]) -> set[str]:
+        """Get the file paths, among `file_paths`, of the saved uploads."""
+        records = await conn.fetch(
+            "SELECT DISTINCT file_path FROM general.chat_uploads WHERE file_path = ANY($1)",
+            file_paths,
+        )
+        return {r["file_path"] for r in records}
+
+    @staticmethod
+    async def mark_processed(
+        conn: asyncpg.Connection, chat_id: int, upload_id: int, metrics: UploadMetrics | None = None
+    ) -> None:
         await conn.execute(
             """
-            UPDATE general.chat_uploads 
+            UPDATE general.chat_uploads
             SET processed_at = NOW(),
-                chat_id = $2
+                chat_id = $2,
+                meta = COALESCE(meta, '{}') || jsonb_strip_nulls(jsonb_build_object(
+                        'status', 'done',
+                        'metrics', $3::jsonb
+                )) - 'error_message'
             WHERE id = $1
                 """,
             upload_id,
             chat_id,
+            metrics,
+        )
+
+    @staticmethod
+    async def set_is_processing(conn: asyncpg.Connection, upload_ids: list[int]) -> None:
+        """Set the uploads as processing in the meta field."""
+        await conn.execute(
+            """
+            UPDATE general.chat_uploads
+            SET meta = COALESCE(meta, '{}') || jsonb_build_object(
+                    'processing_started_at', now(),
+                    'status', 'processing'
+            )
+            WHERE id = ANY($1)
+            """,
+            upload_ids,
+        )
+
+    @staticmethod
+    async def set_processing_error(conn: asyncpg.Connection, upload_ids: list[int], message: str | None = None) -> None:
+        """Set the uploads as error in the meta field, they will not be picked up again."""
+        await conn.execute(
+            """
+            UPDATE general.chat_uploads
+            SET meta = COALESCE(meta, '{}') || jsonb_build_object(
+                    'processing_error_at', now(),
+                    'status', 'error',
+                    'error_message', $2::text
+            )
+            WHERE id = ANY($1)
+            """,
+            upload_ids,
+            message,
+        )
+
+    @staticmethod
+    async def reset_processing(conn: asyncpg.Connection, upload_ids: list[int]) -> None:
+        """Reset the processing status of the uploads in the meta field."""
+        await conn.execute(
+            """
+            UPDATE general.chat_uploads
+            set meta = meta - 'status'
+            where id = any($1)
+            """,
+            upload_ids,
         )
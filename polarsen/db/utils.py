@@ -1,7 +1,10 @@
 from dataclasses import dataclass, field, asdict
 import datetime as dt
+from typing import Iterable, Sequence
 
-__all__ = ("TableID",)
+import asyncpg
+
+__all__ = ("TableID", "copy_upsert")
 
 
 @dataclass
@@ -32,3 +35,52 @@ class TableID:
         if self._created_at is None:
             raise ValueError("Data not been saved yet")
         return self._created_at
+
+
+async def copy_upsert(
+    conn: asyncpg.Connection,
+    table: str,
+    columns: Sequence[str],
+    records: Iterable[Sequence],
+    conflict_keys: Sequence[str],
+    returning: Sequence[str] | None = None,
+    ignore_keys: Sequence[str] = (),
+) -> list[asyncpg.Record]:
+    """
+    Bulk upsert `records` (tuples matching `columns`) into `table`.
+    Records are sent with a binary COPY into a temporary staging table (not WAL-logged),
+    then merged into `table` with a single INSERT ... SELECT.
+    Conflicts on `conflict_keys` are merged like `PGConflictQuery` does (new non-null values win),
+    except for the `ignore_keys` columns which are never updated.
+    When `records` contain the same keys more than once, the last of them is saved.
+    Returns the `returning` columns of all the inserted or updated rows.
+    """
+    staging = "_staging_" + table.replace(".", "_")
+    _columns = ", ".join(columns)
+    _keys = ", ".join(conflict_keys)
+    _updates = ", ".join(
+        f"{c} = COALESCE(EXCLUDED.{c}, t.{c})" for c in columns if c not in conflict_keys and c not in ignore_keys
+    )
+    _on_conflict = f"DO UPDATE SET {_updates}" if _updates else "DO NOTHING"
+    _returning = f"RETURNING {', '.join(returning)}" if returning else ""
+
+    async with conn.transaction():
+        await conn.execute(
+            f"""
+            CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS
+            SELECT {_columns} FROM {table} WITH NO DATA;
+            -- Position of the records, filled in order by COPY
+            ALTER TABLE {staging} ADD COLUMN IF NOT EXISTS _ord BIGINT GENERATED ALWAYS AS IDENTITY;
+            TRUNCATE {staging};
+            """
+        )
+        await conn.copy_records_to_table(staging, records=records, columns=list(columns))
+        return await conn.fetch(
+            f"""
+            INSERT INTO {table} AS t ({_columns})
+            SELECT DISTINCT ON ({_keys}) {_columns} FROM {staging}
+            ORDER BY {_keys}, _ord DESC
+            ON CONFLICT ({_keys}) {_on_conflict}
+            {_returning}
+            """
+        )
@@ -32,3 +32,8 @@ S3_ENDPOINT = os.getenv("S3_ENDPOINT", "http://localhost:9000")
 S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID", "minioadmin")
 S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY", "minioadmin")
 S3_REGION = os.getenv("S3_REGION", "fr-par")
+# Number of parts of a multipart upload sent at the same time
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", 4))
+# Large objects are downloaded with that many concurrent byte-range requests of S3_DOWNLOAD_RANGE_SIZE bytes
+S3_DOWNLOAD_CONCURRENCY = int(os.getenv("S3_DOWNLOAD_CONCURRENCY", 4))
+S3_DOWNLOAD_RANGE_SIZE = int(os.getenv("S3_DOWNLOAD_RANGE_SIZE", 16 * 1024 * 1024))
@@ -1,16 +1,68 @@
-import json
+import struct
 from contextlib import asynccontextmanager
-from typing import AsyncIterator
+from typing import AsyncIterator, Sequence
 
 import asyncpg
+import numpy as np
+import orjson
 
-__all__ = ("get_conn", "get_pool")
+__all__ = (
+    "get_conn",
+    "get_pool",
+    "init_connection",
+    "encode_vector",
+    "decode_vector",
+    "encode_jsonb",
+    "decode_jsonb",
+)
+
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# pgvector binary format: dimensions (uint16), unused (uint16), then the big-endian float4 values
+_VECTOR_HEADER = struct.Struct(">HH")
+_VECTOR_DTYPE = np.dtype(">f4")
+
+# jsonb binary format: version (1), then the JSON text
+_JSONB_VERSION = b"\x01"
+
+
+def encode_vector(value: np.ndarray | Sequence[float]) -> bytes:
+    """Encode an array (or a list) of floats to a pgvector `vector`."""
+    values = np.asarray(value, dtype=_VECTOR_DTYPE)
+    return _VECTOR_HEADER.pack(values.shape[0], 0) + values.tobytes()
+
+
+def decode_vector(data: bytes) -> np.ndarray:
+    """Decode a pgvector `vector` to a float32 array."""
+    dim, _ = _VECTOR_HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype=_VECTOR_DTYPE, count=dim, offset=_VECTOR_HEADER.size).astype(np.float32)
+
+
+def _encode_json(value) -> bytes:
+    return orjson.dumps(value, option=_ORJSON_OPTIONS)
+
+
+def encode_jsonb(value) -> bytes:
+    """Encode a value to the binary `jsonb` format."""
+    return _JSONB_VERSION + orjson.dumps(value, option=_ORJSON_OPTIONS)
+
+
+def decode_jsonb(data: bytes):
+    """Decode a binary `jsonb` value."""
+    if data[:1] != _JSONB_VERSION:
+        raise ValueError(f"Unsupported jsonb format version {data[:1]!r}")
+    return orjson.loads(memoryview(data)[1:])
 
 
 async def init_connection(conn: asyncpg.Connection):
-    await conn.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
-    await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
-    await conn.set_type_codec("vector", encoder=json.dumps, decoder=json.loads, schema="public")
+    """
+    Initialize the PostgreSQL connection with custom type codecs, shared by the CLI, the workers and the API.
+    Values are exchanged in binary format: JSON is (de)serialized with orjson and `vector` maps to numpy arrays
+    (lists of floats are accepted when writing), instead of formatting every float as text.
+    """
+    await conn.set_type_codec("jsonb", encoder=encode_jsonb, decoder=decode_jsonb, schema="pg_catalog", format="binary")
+    await conn.set_type_codec("json", encoder=_encode_json, decoder=orjson.loads, schema="pg_catalog", format="binary")
+    await conn.set_type_codec("vector", encoder=encode_vector, decoder=decode_vector, schema="public", format="binary")
 
 
 @asynccontextmanager
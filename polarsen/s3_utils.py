@@ -1,5 +1,7 @@
+import asyncio
 import contextlib
-from collections import namedtuple
+import itertools
+from collections import namedtuple, deque
 from contextlib import asynccontextmanager
 from typing import AsyncIterator, TypedDict, Callable
 
@@ -13,6 +15,7 @@ try:
 except ImportError as e:
     raise ImportError("botocore is required for S3 operations") from e
 
+from polarsen.ai.conversations.utils import retry_async
 from polarsen.utils import get_stream_chunk
 from polarsen import env
 from polarsen.logs import logs
@@ -23,6 +26,13 @@ __all__ = (
     "S3MultipartUpload",
     "s3_put_object",
     "s3_get_object",
+    "s3_stream_object",
+    "s3_stream_object_ranges",
+    "s3_head_object",
+    "s3_list_objects",
+    "s3_list_multipart_uploads",
+    "s3_abort_multipart_upload",
+    "s3_presign",
     "UploadPart",
     "get_s3_client",
 )
@@ -57,11 +67,30 @@ class UploadPart(TypedDict):
     ETag: str | None
 
 
+async def s3_presign(s3: botocore.client.BaseClient, method: str, *, expires_in: int = 3600, **params) -> str:
+    """
+    Generate a presigned URL for the `method` S3 operation.
+    Runs in a thread as botocore is synchronous: signing, and resolving or refreshing the credentials
+    (which may require an HTTP call), would otherwise block the event loop.
+    """
+    return await asyncio.to_thread(s3.generate_presigned_url, ClientMethod=method, Params=params, ExpiresIn=expires_in)
+
+
 @asynccontextmanager
 async def s3_multipart_upload(
-    s3: botocore.client.BaseClient, client: niquests.AsyncSession, bucket: str, key: str, *, expires_in: int = 3600
+    s3: botocore.client.BaseClient,
+    client: niquests.AsyncSession,
+    bucket: str,
+    key: str,
+    *,
+    expires_in: int = 3600,
+    max_attempts: int = 3,
 ):
-    """Async context manager for S3 multipart upload with automatic cleanup."""
+    """
+    Async context manager for S3 multipart upload with automatic cleanup.
+    Parts can be uploaded concurrently by passing their `part_number`, each part is retried
+    up to `max_attempts` times on network or HTTP errors.
+    """
     upload_id: str | None = None
     _part_number: int = 1
     _parts: list[UploadPart] = []
@@ -70,10 +99,12 @@ async def s3_multipart_upload(
     async def fetch_complete():
         if upload_id is None:
             raise ValueError("Upload ID is not set")
-        complete_url = _generate_presigned_url("complete_multipart_upload", UploadId=upload_id)
+        complete_url = await _generate_presigned_url("complete_multipart_upload", UploadId=upload_id)
         # Create XML payload for completing multipart upload
+        # Parts uploaded concurrently may complete out of order
         parts_xml = "".join(
-            f"<Part><PartNumber>{part['PartNumber']}</PartNumber><ETag>{part['ETag']}</ETag></Part>" for part in _parts
+            f"<Part><PartNumber>{part['PartNumber']}</PartNumber><ETag>{part['ETag']}</ETag></Part>"
+            for part in sorted(_parts, key=lambda x: x["PartNumber"])
         )
         xml_payload = f"<CompleteMultipartUpload>{parts_xml}</CompleteMultipartUpload>"
 
@@ -85,38 +116,44 @@ async def s3_multipart_upload(
         nonlocal _has_been_aborted
         if upload_id is None:
             raise ValueError("Upload ID is not set")
-        abort_url = _generate_presigned_url("abort_multipart_upload", UploadId=upload_id)
+        abort_url = await _generate_presigned_url("abort_multipart_upload", UploadId=upload_id)
         abort_resp = await client.delete(abort_url)
         abort_resp.raise_for_status()
         _has_been_aborted = True
         return abort_resp
 
-    async def upload_part(data: bytes) -> UploadPart:
-        nonlocal _part_number, _parts
-        if upload_id is None:
-            raise ValueError("Upload ID is not set")
-        presigned_url = _generate_presigned_url("upload_part", UploadId=upload_id, PartNumber=_part_number)
+    @retry_async(max_attempts=max_attempts, exceptions=niquests.RequestException)
+    async def _put_part(part_number: int, data: bytes) -> niquests.Response:
+        presigned_url = await _generate_presigned_url("upload_part", UploadId=upload_id, PartNumber=part_number)
         # Upload part using niquests
         upload_resp = await client.put(
             presigned_url,
             data=data,
         )
         upload_resp.raise_for_status()
+        return upload_resp
+
+    async def upload_part(data: bytes, part_number: int | None = None) -> UploadPart:
+        """Upload a part, numbered after the previous one if `part_number` is not set."""
+        nonlocal _part_number, _parts
+        if upload_id is None:
+            raise ValueError("Upload ID is not set")
+        if part_number is None:
+            part_number = _part_number
+        _part_number = max(_part_number, part_number + 1)
+        upload_resp = await _put_part(part_number, data)
 
         # Extract ETag from response headers
         etag = upload_resp.headers.get("ETag")
-        _part: UploadPart = {"PartNumber": _part_number, "ETag": etag}
+        _part: UploadPart = {"PartNumber": part_number, "ETag": etag}
         _parts.append(_part)
-        _part_number += 1
         return _part
 
-    def _generate_presigned_url(method: str, **params):
-        return s3.generate_presigned_url(
-            ClientMethod=method, Params={"Bucket": bucket, "Key": key, **params}, ExpiresIn=expires_in
-        )
+    async def _generate_presigned_url(method: str, **params):
+        return await s3_presign(s3, method, expires_in=expires_in, Bucket=bucket, Key=key, **params)
 
     try:
-        response = s3.create_multipart_upload(Bucket=bucket, Key=key)
+        response = await asyncio.to_thread(s3.create_multipart_upload, Bucket=bucket, Key=key)
         upload_id = response["UploadId"]
         yield S3MultipartUpload(
             fetch_complete=fetch_complete,
@@ -145,43 +182,57 @@ async def s3_file_upload(
     min_part_size: int = 5 * 1024 * 1024,
     on_chunk_received: Callable[[bytes], None] | None = None,
     content_length: int | None = None,
+    max_concurrency: int = env.S3_UPLOAD_CONCURRENCY,
 ) -> None:
     """
     Upload a file to S3 using multipart upload from an async byte stream.
+    Up to `max_concurrency` parts are uploaded at the same time, so at most that many parts
+    (plus the one being received) are held in memory.
     """
     if content_length is not None and content_length < min_part_size:
         logs.debug("Content length is less than min_part_size, using single PUT operation")
         # Consume AsyncIterator
-        _data = b""
+        _chunks = []
         async for chunk in data:
-            _data += chunk
+            _chunks.append(chunk)
             if on_chunk_received:
                 on_chunk_received(chunk)
-        await s3_put_object(s3, client, bucket=bucket, key=key, data=_data)
+        await s3_put_object(s3, client, bucket=bucket, key=key, data=b"".join(_chunks))
         return
 
+    in_flight = asyncio.Semaphore(max_concurrency)
+
+    async def _upload_part(_mpart: S3MultipartUpload, part_number: int, chunk: bytes):
+        try:
+            await _mpart.upload_part(chunk, part_number=part_number)
+        finally:
+            in_flight.release()
+
     async with s3_multipart_upload(s3, client, bucket=bucket, key=key) as mpart:
-        async for chunk in get_stream_chunk(data, min_part_size=min_part_size):
-            if on_chunk_received:
-                on_chunk_received(chunk)
-            if len(chunk) < min_part_size:
-                await mpart.fetch_abort()
-                await s3_put_object(s3, client, bucket=bucket, key=key, data=chunk)
-                break
-            await mpart.upload_part(chunk)
+        try:
+            async with asyncio.TaskGroup() as tg:
+                part_number = 0
+                async for chunk in get_stream_chunk(data, min_part_size=min_part_size):
+                    if on_chunk_received:
+                        on_chunk_received(chunk)
+                    if len(chunk) < min_part_size:
+                        # Only the first chunk can be smaller than a part: the whole stream fits in one PUT
+                        await mpart.fetch_abort()
+                        await s3_put_object(s3, client, bucket=bucket, key=key, data=chunk)
+                        break
+                    part_number += 1
+                    await in_flight.acquire()
+                    tg.create_task(_upload_part(mpart, part_number, chunk))
+        except ExceptionGroup as e:
+            # Surface the error of the first failed part
+            raise e.exceptions[0]
 
 
 async def s3_delete_object(
     s3: botocore.client.BaseClient, client: niquests.AsyncSession, bucket: str, key: str
 ) -> niquests.Response:
     """Delete an object from S3."""
-    url = s3.generate_presigned_url(
-        ClientMethod="delete_object",
-        Params={
-            "Bucket": bucket,
-            "Key": key,
-        },
-    )
+    url = await s3_presign(s3, "delete_object", Bucket=bucket, Key=key)
     resp = await client.delete(url)
     resp.raise_for_status()
     return resp
@@ -191,13 +242,7 @@ async def s3_put_object(
     s3: botocore.client.BaseClient, client: niquests.AsyncSession, bucket: str, key: str, data: bytes
 ) -> niquests.Response:
     """Upload an object to S3."""
-    url = s3.generate_presigned_url(
-        ClientMethod="put_object",
-        Params={
-            "Bucket": bucket,
-            "Key": key,
-        },
-    )
+    url = await s3_presign(s3, "put_object", Bucket=bucket, Key=key)
     resp = await client.put(url, data=data)
     try:
         resp.raise_for_status()
@@ -211,13 +256,124 @@ async def s3_get_object(
     s3: botocore.client.BaseClient, client: niquests.AsyncSession, bucket: str, key: str
 ) -> bytes | None:
     """Download an object from S3."""
-    url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={
-            "Bucket": bucket,
-            "Key": key,
-        },
-    )
+    url = await s3_presign(s3, "get_object", Bucket=bucket, Key=key)
     resp = await client.get(url)
     resp.raise_for_status()
     return resp.content
+
+
+async def s3_stream_object(
+    s3: botocore.client.BaseClient,
+    client: niquests.AsyncSession,
+    bucket: str,
+    key: str,
+    chunk_size: int = 64 * 1024,
+) -> AsyncIterator[bytes]:
+    """
+    Stream an object from S3 as chunks of at most `chunk_size` bytes,
+    so memory usage is bounded by the chunk size rather than the object size.
+    """
+    url = await s3_presign(s3, "get_object", Bucket=bucket, Key=key)
+    resp = await client.get(url, stream=True)
+    try:
+        resp.raise_for_status()
+        async for chunk in await resp.iter_content(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        await resp.close()
+
+
+async def s3_head_object(
+    s3: botocore.client.BaseClient, client: niquests.AsyncSession, bucket: str, key: str
+) -> niquests.Response:
+    """Get the metadata (size, ETag, ...) of an object from S3."""
+    url = await s3_presign(s3, "head_object", Bucket=bucket, Key=key)
+    resp = await client.head(url)
+    resp.raise_for_status()
+    return resp
+
+
+async def s3_stream_object_ranges(
+    s3: botocore.client.BaseClient,
+    client: niquests.AsyncSession,
+    bucket: str,
+    key: str,
+    *,
+    range_size: int = env.S3_DOWNLOAD_RANGE_SIZE,
+    max_concurrency: int = env.S3_DOWNLOAD_CONCURRENCY,
+    max_attempts: int = 3,
+) -> AsyncIterator[bytes]:
+    """
+    Stream an object from S3 with up to `max_concurrency` concurrent byte-range requests of `range_size` bytes,
+    yielded in order, so large objects are not limited by the throughput of a single connection.
+    Memory usage is bounded by `max_concurrency + 1` ranges. Each range is retried up to `max_attempts` times,
+    and the download fails if the object is modified in the meantime.
+    Objects smaller than a range are streamed with a single request (see `s3_stream_object`).
+    """
+    head = await s3_head_object(s3, client, bucket=bucket, key=key)
+    size = int(head.headers["Content-Length"])
+    if max_concurrency <= 1 or size <= range_size:
+        async for chunk in s3_stream_object(s3, client, bucket=bucket, key=key):
+            yield chunk
+        return
+
+    url = await s3_presign(s3, "get_object", Bucket=bucket, Key=key)
+    etag = head.headers.get("ETag")
+
+    @retry_async(max_attempts=max_attempts, exceptions=niquests.RequestException)
+    async def _get_range(start: int) -> bytes:
+        headers = {"Range": f"bytes={start}-{min(start + range_size, size) - 1}"}
+        if etag is not None:
+            headers["If-Match"] = etag
+        resp = await client.get(url, headers=headers)
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            raise ValueError(f"Expected a partial content response for {key!r}, got {resp.status_code}")
+        return resp.content
+
+    offsets = iter(range(0, size, range_size))
+    pending: deque[asyncio.Task[bytes]] = deque()
+
+    def _schedule():
+        for start in itertools.islice(offsets, max_concurrency - len(pending)):
+            pending.append(asyncio.create_task(_get_range(start)))
+
+    try:
+        _schedule()
+        while pending:
+            data = await pending.popleft()
+            # Keep downloading the next ranges while this one is consumed
+            _schedule()
+            yield data
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _iter_pages(s3: botocore.client.BaseClient, operation: str, key: str, **params) -> AsyncIterator[dict]:
+    """Yield the `key` items of the pages of a listing operation, fetched in a thread as botocore is synchronous."""
+    pages = iter(s3.get_paginator(operation).paginate(**params))
+    while (page := await asyncio.to_thread(next, pages, None)) is not None:
+        for item in page.get(key, []):
+            yield item
+
+
+def s3_list_objects(s3: botocore.client.BaseClient, bucket: str, prefix: str = "") -> AsyncIterator[dict]:
+    """List the objects of a bucket (`Key`, `Size`, `LastModified`, ...)."""
+    return _iter_pages(s3, "list_objects_v2", "Contents", Bucket=bucket, Prefix=prefix)
+
+
+def s3_list_multipart_uploads(s3: botocore.client.BaseClient, bucket: str, prefix: str = "") -> AsyncIterator[dict]:
+    """List the multipart uploads of a bucket not completed nor aborted yet (`Key`, `UploadId`, `Initiated`)."""
+    return _iter_pages(s3, "list_multipart_uploads", "Uploads", Bucket=bucket, Prefix=prefix)
+
+
+async def s3_abort_multipart_upload(
+    s3: botocore.client.BaseClient, client: niquests.AsyncSession, bucket: str, key: str, upload_id: str
+) -> niquests.Response:
+    """Abort a multipart upload, deleting its uploaded parts."""
+    url = await s3_presign(s3, "abort_multipart_upload", Bucket=bucket, Key=key, UploadId=upload_id)
+    resp = await client.delete(url)
+    resp.raise_for_status()
+    return resp
@@ -1,5 +1,9 @@
+import codecs
 import hashlib
-from typing import AsyncIterator
+import json
+from collections import deque
+from pathlib import Path
+from typing import AsyncIterator, Any, Container, Callable
 from urllib.parse import urlparse
 
 from piou import Option, Password
@@ -41,30 +45,160 @@ def compute_md5():
     return _get_hash, _update_hash
 
 
+def _pop_part(pending: deque[memoryview], size: int) -> bytes:
+    """Remove the first `size` bytes of `pending` and return them as a single part."""
+    views = []
+    while size > 0:
+        view = pending.popleft()
+        if len(view) > size:
+            pending.appendleft(view[size:])
+            view = view[:size]
+        views.append(view)
+        size -= len(view)
+    return b"".join(views)
+
+
 async def get_stream_chunk(data_stream: AsyncIterator[bytes], min_part_size: int) -> AsyncIterator[bytes]:
-    """Yield chunks of at least min_part_size from an async byte stream."""
-    buffer: bytes = b""
-    buffer_size = 0
+    """
+    Yield chunks of at least min_part_size from an async byte stream.
+    All chunks are `min_part_size` long except the last one, which is smaller than twice that size
+    (or the whole stream if it is smaller than `min_part_size`).
+    Received chunks are kept as memoryviews until a part is complete, so each byte is copied once.
+    """
+    pending: deque[memoryview] = deque()
+    pending_size = 0
 
     async for chunk in data_stream:
         if not chunk:
             continue
-        buffer += chunk
-        buffer_size += len(chunk)
+        pending.append(memoryview(chunk))
+        pending_size += len(chunk)
 
         # Yield chunks of min_part_size while we have enough data for at least 2 chunks
-        while buffer_size >= min_part_size * 2:
-            yield buffer[:min_part_size]
-            buffer = buffer[min_part_size:]
-            buffer_size -= min_part_size
-
-    # Handle the final chunk(s)
-    if buffer_size >= min_part_size:
-        # If we have enough for exactly one chunk, yield it
-        if buffer_size < min_part_size * 2:
-            yield buffer
+        while pending_size >= min_part_size * 2:
+            yield _pop_part(pending, min_part_size)
+            pending_size -= min_part_size
+
+    # Final chunk
+    if pending_size:
+        yield b"".join(pending)
+
+
+async def iter_bytes(data: bytes, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """Yield `data` as an async byte stream of `chunk_size` chunks."""
+    for i in range(0, len(data), chunk_size):
+        yield data[i : i + chunk_size]
+
+
+async def iter_file(
+    path: Path, chunk_size: int = 64 * 1024, on_chunk_read: Callable[[bytes], None] | None = None
+) -> AsyncIterator[bytes]:
+    """Yield the content of the file at `path` as an async byte stream."""
+    with path.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            if on_chunk_read:
+                on_chunk_read(chunk)
+            yield chunk
+
+
+async def abatched[T](data: AsyncIterator[T], size: int) -> AsyncIterator[list[T]]:
+    """Async version of `itertools.batched`, yielding lists of at most `size` items."""
+    batch: list[T] = []
+    async for item in data:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_JSON_WHITESPACES = " \t\n\r"
+
+
+async def iter_json_object(
+    data_stream: AsyncIterator[bytes], stream_keys: Container[str] = (), *, encoding: str = "utf-8"
+) -> AsyncIterator[tuple[str, Any]]:
+    """
+    Incrementally parse a top-level JSON object from an async byte stream.
+    Yields a (key, value) pair for each key of the object, in order.
+    Values of the keys in `stream_keys` must be arrays: they are never loaded at once,
+    a (key, item) pair is yielded for each of their items instead.
+    Only the value being decoded is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    stream = aiter(data_stream)
+    buffer, pos, eof = "", 0, False
+
+    async def _fill():
+        """Read the next chunk of the stream, dropping the already consumed part of the buffer."""
+        nonlocal buffer, pos, eof
+        try:
+            chunk = await anext(stream)
+        except StopAsyncIteration:
+            eof = True
+            text = text_decoder.decode(b"", final=True)
+        else:
+            text = text_decoder.decode(chunk)
+        buffer = buffer[pos:] + text
+        pos = 0
+
+    async def _next_char() -> str:
+        """Skip whitespaces and return the next significant character (without consuming it)."""
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in _JSON_WHITESPACES:
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                raise ValueError("Unexpected end of JSON stream")
+            await _fill()
+
+    async def _expect(*chars: str) -> str:
+        nonlocal pos
+        char = await _next_char()
+        if char not in chars:
+            raise ValueError(f"Invalid JSON stream: expected one of {chars!r}, got {char!r} at position {pos}")
+        pos += 1
+        return char
+
+    async def _decode() -> Any:
+        nonlocal pos
+        await _next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                await _fill()
+                continue
+            # A value ending the buffer might be truncated (numbers for instance)
+            if end < len(buffer) or eof:
+                pos = end
+                return value
+            await _fill()
+
+    await _expect("{")
+    if await _next_char() == "}":
+        return
+    while True:
+        key = await _decode()
+        if not isinstance(key, str):
+            raise ValueError(f"Invalid JSON stream: expected a key, got {key!r}")
+        await _expect(":")
+        if key in stream_keys:
+            await _expect("[")
+            if await _next_char() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield key, await _decode()
+                    if await _expect(",", "]") == "]":
+                        break
         else:
-            # We have enough for more than one chunk, split evenly
-            mid_point = buffer_size // 2
-            yield buffer[:mid_point]
-            yield buffer[mid_point:]
+            yield key, await _decode()
+        if await _expect(",", "}") == "}":
+            break
@@ -1,5 +1,17 @@
 SET timezone TO 'UTC';
 SET schema 'public';
 CREATE EXTENSION IF NOT EXISTS vector;
+-- Iterative index scans (see `MistralGroupEmbeddings.set_search_params`) require pgvector 0.8
+DO
+$$
+    DECLARE
+        _version TEXT := (SELECT extversion FROM pg_extension WHERE extname = 'vector');
+    BEGIN
+        IF string_to_array(_version, '.')::INT[] < ARRAY [0, 8, 0] THEN
+            RAISE EXCEPTION 'pgvector >= 0.8.0 is required, found %', _version
+                USING HINT = 'Install a newer pgvector then run ALTER EXTENSION vector UPDATE';
+        END IF;
+    END
+$$;
 CREATE SCHEMA IF NOT EXISTS general;
 CREATE SCHEMA IF NOT EXISTS ai;
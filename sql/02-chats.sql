@@ -41,20 +41,85 @@ CREATE TABLE IF NOT EXISTS general.chat_messages
     chat_id       BIGINT      NOT NULL REFERENCES general.chats,
     sent_at       TIMESTAMPTZ NOT NULL,
     created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    reply_to_id   BIGINT REFERENCES general.chat_messages,
+    reply_to_id   BIGINT,
     message       TEXT        NOT NULL CHECK ( LENGTH(message) < 10000 ),
     internal_code TEXT        NOT NULL CHECK ( LENGTH(internal_code) < 100 ),
-    deleted_at    TIMESTAMPTZ
+    deleted_at    TIMESTAMPTZ,
+    -- First message of the reply thread (the message itself if it is not a reply) and depth in the thread,
+    -- computed at ingest (see `TelegramGroup.save_messages`)
+    thread_root_id BIGINT,
+    depth          INT
 );
 
+ALTER TABLE general.chat_messages
+    ADD COLUMN IF NOT EXISTS thread_root_id BIGINT,
+    ADD COLUMN IF NOT EXISTS depth INT;
+
+-- Unique constraints include the chat, so that the table can be partitioned by chat (see `db partition-messages`)
 BEGIN;
 ALTER TABLE general.chat_messages
     DROP CONSTRAINT IF EXISTS unique_message_idx,
-    ADD CONSTRAINT unique_message_idx UNIQUE (chat_user_id, internal_code),
-    DROP CONSTRAINT IF EXISTS unique_chat_group_idx,
-    ADD CONSTRAINT unique_chat_group_idx UNIQUE (id, chat_id);
+    ADD CONSTRAINT unique_message_idx UNIQUE (chat_id, chat_user_id, internal_code),
+    -- Replaced by chat_messages_reply_to_fkey
+    DROP CONSTRAINT IF EXISTS chat_messages_reply_to_id_fkey;
 COMMIT;
 
+-- Only added when missing: foreign keys depend on unique_chat_group_idx,
+-- and they are lost when the table is partitioned
+DO
+$$
+    DECLARE
+        _constraint RECORD;
+    BEGIN
+        FOR _constraint IN SELECT *
+                           FROM (VALUES ('unique_chat_group_idx', 'UNIQUE (id, chat_id)'),
+                                        ('chat_messages_chat_user_id_fkey',
+                                         'FOREIGN KEY (chat_user_id) REFERENCES general.chat_users'),
+                                        ('chat_messages_chat_id_fkey', 'FOREIGN KEY (chat_id) REFERENCES general.chats'),
+                                        ('chat_messages_reply_to_fkey',
+                                         'FOREIGN KEY (reply_to_id, chat_id) REFERENCES general.chat_messages (id, chat_id)'))
+                                    AS c(name, definition)
+            LOOP
+                IF NOT EXISTS (SELECT 1
+                               FROM pg_constraint
+                               WHERE conrelid = 'general.chat_messages'::regclass
+                                 AND conname = _constraint.name) THEN
+                    EXECUTE format('ALTER TABLE general.chat_messages ADD CONSTRAINT %I %s', _constraint.name,
+                                   _constraint.definition);
+                END IF;
+            END LOOP;
+    END
+$$;
+
+-- Messages of a chat by time range (e.g. per day)
+CREATE INDEX IF NOT EXISTS chat_messages_chat_sent_at_idx ON general.chat_messages (chat_id, sent_at);
+-- Replies of a message
+CREATE INDEX IF NOT EXISTS chat_messages_reply_to_idx ON general.chat_messages (reply_to_id) WHERE reply_to_id IS NOT NULL;
+-- Messages of a reply thread
+CREATE INDEX IF NOT EXISTS chat_messages_thread_root_idx ON general.chat_messages (thread_root_id);
+
+-- Threads of the messages saved before they were computed at ingest
+DO
+$$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM general.chat_messages WHERE thread_root_id IS NULL) THEN
+            WITH RECURSIVE chat_thread AS (SELECT id, id AS thread_root_id, 0 AS depth
+                                           FROM general.chat_messages
+                                           WHERE reply_to_id IS NULL
+                                           UNION ALL
+                                           SELECT cm.id, ct.thread_root_id, ct.depth + 1
+                                           FROM general.chat_messages cm
+                                                    JOIN chat_thread ct ON cm.reply_to_id = ct.id)
+            UPDATE general.chat_messages cm
+            SET thread_root_id = ct.thread_root_id,
+                depth          = ct.depth
+            FROM chat_thread ct
+            WHERE ct.id = cm.id
+              AND cm.thread_root_id IS NULL;
+        END IF;
+    END
+$$;
+
 
 
 CREATE TABLE IF NOT EXISTS general.chat_uploads
@@ -69,9 +134,18 @@ CREATE TABLE IF NOT EXISTS general.chat_uploads
     md5          TEXT        NOT NULL,
     processed_at TIMESTAMPTZ,
     created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    chat_type_id INT         NOT NULL REFERENCES general.chat_types
+    chat_type_id INT         NOT NULL REFERENCES general.chat_types,
+    meta         JSONB,
+    -- Compression of the stored object, NULL if stored as is
+    compression  TEXT
 );
 
+ALTER TABLE general.chat_uploads
+    ADD COLUMN IF NOT EXISTS meta JSONB;
+
+ALTER TABLE general.chat_uploads
+    ADD COLUMN IF NOT EXISTS compression TEXT;
+
 BEGIN;
 ALTER TABLE general.chat_uploads
     DROP CONSTRAINT IF EXISTS filename_valid,
@@ -82,6 +156,8 @@ ALTER TABLE general.chat_uploads
     ADD CONSTRAINT mime_type_valid CHECK (LENGTH(mime_type) < 100),
     DROP CONSTRAINT IF EXISTS md5_valid,
     ADD CONSTRAINT md5_valid CHECK (LENGTH(md5) = 32),
+    DROP CONSTRAINT IF EXISTS compression_valid,
+    ADD CONSTRAINT compression_valid CHECK (compression IN ('zstd', 'zip')),
     DROP CONSTRAINT IF EXISTS processed_at_valid,
     ADD CONSTRAINT processed_at_valid CHECK ((chat_id IS NULL) = (processed_at IS NULL)),
     DROP CONSTRAINT IF EXISTS unique_chat_uploads,
@@ -96,28 +172,13 @@ COMMIT;
 
 CREATE OR REPLACE VIEW general.message_replies_view AS
 (
-WITH RECURSIVE chat_thread AS (
-    -- Base case: select initial messages from the specific date
-    SELECT cm.id,
-           cm.reply_to_id,
-           0 AS depth
-    FROM general.chat_messages cm
-    WHERE cm.reply_to_id IS NULL -- Only select top-level messages (not replies)
-    UNION ALL
-
-    -- Recursive case: select replies to messages in the thread
-    SELECT cm.id,
-           cm.reply_to_id,
-           ct.depth + 1 AS depth
-    FROM general.chat_messages cm
-             JOIN chat_thread ct ON cm.reply_to_id = ct.id)
-
--- Select all messages in the threads
+-- Threads are computed at ingest (see `general.chat_messages.thread_root_id`), no need to walk the replies
 SELECT id,
        reply_to_id,
        depth
-FROM chat_thread
-ORDER BY COALESCE(reply_to_id, id), depth
+FROM general.chat_messages
+WHERE thread_root_id IS NOT NULL
+ORDER BY thread_root_id, depth
     );
 
 COMMENT ON VIEW general.message_replies_view IS 'View to get all messages in the threads, with depth.';
@@ -28,9 +28,20 @@ CREATE TABLE IF NOT EXISTS ai.message_groups
     title           TEXT,
     meta            JSONB,
     run_id          UUID,
-    chat_id         BIGINT      NOT NULL REFERENCES general.chats
+    chat_id         BIGINT      NOT NULL REFERENCES general.chats,
+    -- Day of the messages of the group
+    day             DATE
 );
 
+ALTER TABLE ai.message_groups
+    ADD COLUMN IF NOT EXISTS day DATE;
+
+-- The day used to be stored in the meta
+UPDATE ai.message_groups
+SET day = (meta ->> 'day')::date
+WHERE day IS NULL
+  AND meta ? 'day';
+
 BEGIN;
 ALTER TABLE ai.message_groups
     DROP CONSTRAINT IF EXISTS internal_code_valid,
@@ -43,12 +54,15 @@ ALTER TABLE ai.message_groups
     ADD CONSTRAINT unique_message_group_idx UNIQUE (group_method_id, internal_code);
 COMMIT;
 
+DROP INDEX IF EXISTS ai.message_groups_chat_idx;
+CREATE INDEX IF NOT EXISTS message_groups_chat_day_idx ON ai.message_groups (chat_id, day);
+
 
 CREATE TABLE IF NOT EXISTS ai.message_group_chats
 (
     id         BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
     group_id   BIGINT      NOT NULL REFERENCES ai.message_groups,
-    msg_id     BIGINT      NOT NULL REFERENCES general.chat_messages,
+    msg_id     BIGINT      NOT NULL,
     chat_id    BIGINT      NOT NULL REFERENCES general.chats,
     created_at timestamptz NOT NULL DEFAULT now()
 );
@@ -56,7 +70,11 @@ CREATE TABLE IF NOT EXISTS ai.message_group_chats
 BEGIN;
 ALTER TABLE ai.message_group_chats
     DROP CONSTRAINT IF EXISTS unique_message_group_chat_idx,
-    ADD CONSTRAINT unique_message_group_chat_idx UNIQUE (group_id, msg_id);
+    ADD CONSTRAINT unique_message_group_chat_idx UNIQUE (group_id, msg_id),
+    -- Including the chat, as messages may be partitioned by chat
+    DROP CONSTRAINT IF EXISTS message_group_chats_msg_id_fkey,
+    DROP CONSTRAINT IF EXISTS message_group_chats_msg_fkey,
+    ADD CONSTRAINT message_group_chats_msg_fkey FOREIGN KEY (msg_id, chat_id) REFERENCES general.chat_messages (id, chat_id);
 COMMIT;
 
 
@@ -64,17 +82,52 @@ CREATE TABLE IF NOT EXISTS ai.mistral_group_embeddings
 (
     id                BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
     group_id          BIGINT       NOT NULL REFERENCES ai.message_groups,
+    -- Chat of the group, to filter the searches without joining the groups
+    chat_id           BIGINT       NOT NULL REFERENCES general.chats,
     embedding         vector(1024) NOT NULL,
     created_at        timestamptz  NOT NULL DEFAULT now(),
     last_processed_at timestamptz
 );
 
+ALTER TABLE ai.mistral_group_embeddings
+    ADD COLUMN IF NOT EXISTS chat_id BIGINT REFERENCES general.chats;
+
+BEGIN;
+UPDATE ai.mistral_group_embeddings e
+SET chat_id = g.chat_id
+FROM ai.message_groups g
+WHERE g.id = e.group_id
+  AND e.chat_id IS NULL;
+ALTER TABLE ai.mistral_group_embeddings
+    ALTER COLUMN chat_id SET NOT NULL;
+COMMIT;
+
 CREATE UNIQUE INDEX IF NOT EXISTS unique_mistral_summary_idx ON ai.mistral_group_embeddings (group_id);
+CREATE INDEX IF NOT EXISTS mistral_group_embeddings_chat_idx ON ai.mistral_group_embeddings (chat_id, group_id);
+
+-- Approximate nearest neighbour search on the cosine distance, use `db vector-index` to rebuild it (or switch to IVFFlat).
+-- Only created if there is no ANN index yet, to keep the one built by `db vector-index`
+DO
+$$
+    BEGIN
+        IF NOT EXISTS (SELECT 1
+                       FROM pg_indexes
+                       WHERE schemaname = 'ai'
+                         AND tablename = 'mistral_group_embeddings'
+                         AND indexname NOT LIKE '%\_tmp'
+                         AND indexdef ~ 'USING (hnsw|ivfflat)') THEN
+            CREATE INDEX mistral_group_embeddings_hnsw_idx ON ai.mistral_group_embeddings
+                USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+        END IF;
+    END
+$$;
 
 
+-- Partitioned by month, `db requests-retention` creates the upcoming partitions and drops the expired ones
+-- (use `db partition-requests` to migrate a table created before)
 CREATE TABLE IF NOT EXISTS ai.requests
 (
-    id            BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    id            BIGINT GENERATED BY DEFAULT AS IDENTITY,
     request_type  TEXT        NOT NULL,
     total_tokens  INT         NOT NULL,
     input_tokens  INT         NOT NULL,
@@ -82,8 +135,42 @@ CREATE TABLE IF NOT EXISTS ai.requests
     cached_tokens INT         NOT NULL DEFAULT 0,
     created_at    timestamptz NOT NULL DEFAULT now(),
     meta          JSONB,
+    -- The full prompt, e.g. all the messages of a day for the segmentation, for the requests saved before payload_zstd
     payload       JSONB,
     -- The run_id is a UUID that is used to track the request and its associated data.
     run_id        UUID,
-    user_id       BIGINT      NOT NULL REFERENCES general.users
-);
+    user_id       BIGINT      NOT NULL,
+    -- The payload as JSON compressed with zstd by the application (see `Requests.get_payload`)
+    payload_zstd  BYTEA,
+    -- Partitioned tables keys must include the partition key
+    CONSTRAINT requests_pkey PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+DO
+$$
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = 'ai.requests'::regclass) = 'p' THEN
+            -- Rows of the months without partition, moved to their partition when it is created
+            CREATE TABLE IF NOT EXISTS ai.requests_default PARTITION OF ai.requests DEFAULT;
+        END IF;
+        IF NOT EXISTS (SELECT 1
+                       FROM pg_constraint
+                       WHERE conrelid = 'ai.requests'::regclass
+                         AND conname = 'requests_user_id_fkey') THEN
+            ALTER TABLE ai.requests
+                ADD CONSTRAINT requests_user_id_fkey FOREIGN KEY (user_id) REFERENCES general.users;
+        END IF;
+    END
+$$;
+
+ALTER TABLE ai.requests
+    ADD COLUMN IF NOT EXISTS payload_zstd BYTEA;
+-- lz4 is faster than the default pglz to (de)compress the meta. The payloads are already compressed by the
+-- application: TOAST only moves them out of line, without trying to compress them again
+ALTER TABLE ai.requests
+    ALTER COLUMN meta SET COMPRESSION lz4,
+    ALTER COLUMN payload_zstd SET STORAGE EXTERNAL;
+
+-- Token accounting per user over a period, without reading the (toasted) payloads
+CREATE INDEX IF NOT EXISTS requests_user_created_at_idx ON ai.requests (user_id, created_at)
+    INCLUDE (request_type, total_tokens, input_tokens, output_tokens, cached_tokens);
@@ -1,3 +1,4 @@
+import hashlib
 import json
 from http import HTTPStatus
 
@@ -43,6 +44,16 @@ class TestUpload:
                 FILE_1MB,
                 id="small-file",
             ),
+            pytest.param(
+                {
+                    "user_id": USERS[0]["id"],
+                    "filename": "toto.zip",
+                    "mime_type": "application/zip",
+                    "chat_type": "telegram",
+                },
+                FILE_1MB,
+                id="zip-file",
+            ),
         ],
     )
     def test_upload(self, client, params, content, minio_client, engine):
@@ -59,7 +70,53 @@ class TestUpload:
         resp_data = json.loads(payload_resp)
         s3_files = minio_client.list_objects(bucket_name=env.CHAT_UPLOADS_S3_BUCKET, prefix=resp_data["file_path"])
         assert len(list(s3_files)) == 1
-        assert fetch_one(engine, "SELECT * from general.chat_uploads WHERE id = %s", resp_data["file_id"])
+        upload = fetch_one(engine, "SELECT * from general.chat_uploads WHERE id = %s", resp_data["file_id"])
+        assert upload
+        # JSON files are stored compressed, zip files as is
+        assert upload["compression"] == ("zip" if params["mime_type"] == "application/zip" else "zstd")
+        assert upload["file_size"] == len(content)
+
+    def test_upload_duplicate(self, client, minio_client):
+        from polarsen import env
+
+        user_id = USERS[0]["id"]
+        md5 = hashlib.md5(FILE_1MB).hexdigest()
+
+        def _upload(filename: str, content_md5: str):
+            params = {
+                "user_id": user_id,
+                "filename": filename,
+                "mime_type": "application/json",
+                "chat_type": "telegram",
+            }
+            headers = {"X-Content-Length": str(len(FILE_1MB)), "X-Content-MD5": content_md5}
+            return client.post("/chats/upload", headers=headers, params=params, content=FILE_1MB)
+
+        def _nb_objects(filename: str) -> int:
+            prefix = f"{user_id}/{filename}"
+            return len(list(minio_client.list_objects(bucket_name=env.CHAT_UPLOADS_S3_BUCKET, prefix=prefix)))
+
+        resp = client.get("/chats/uploads/check", params={"user_id": user_id, "md5": md5})
+        assert resp.json() == {"exists": False, "file_id": None}
+        # The MD5 of the received file must match the one announced
+        resp = _upload("chat.json", content_md5="0" * 32)
+        assert resp.status_code == HTTPStatus.BAD_REQUEST, resp.text
+        assert _nb_objects("chat.json") == 0
+
+        resp = _upload("chat.json", content_md5=md5)
+        assert resp.status_code == HTTPStatus.OK, resp.text
+        file_id = resp.json()["file_id"]
+        resp = client.get("/chats/uploads/check", params={"user_id": user_id, "md5": md5})
+        assert resp.json() == {"exists": True, "file_id": file_id}
+        # Duplicates are rejected before being uploaded to S3
+        resp = _upload("chat-copy.json", content_md5=md5.upper())
+        assert resp.status_code == HTTPStatus.CONFLICT, resp.text
+        assert _nb_objects("chat-copy.json") == 0
+
+    def test_upload_unsupported_type(self, client):
+        params = {"user_id": USERS[0]["id"], "filename": "toto.txt", "mime_type": "text/plain", "chat_type": "telegram"}
+        resp = client.post("/chats/upload", headers={"X-Content-Length": "4"}, params=params, content=b"toto")
+        assert resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
 
 
 class TestUsers:
@@ -166,6 +223,54 @@ class TestUsers:
                     "filename": telegram_uploads[0]["filename"],
                     "file_path": telegram_uploads[0]["file_path"],
                     "processed_at": None,
+                    "status": None,
+                    "metrics": None,
                 }
             ],
         }
+
+
+class TestUploadsMetrics:
+    @pytest.fixture(scope="function")
+    def uploads(self, engine):
+        import datetime as dt
+
+        chat_types = load_chat_types(engine, as_dict=True)
+        processed_at = dt.datetime(2024, 1, 2, tzinfo=dt.timezone.utc)
+        _uploads = [
+            gen_chat_upload(
+                user_id=USERS[0]["id"],
+                chat_type_id=chat_types["telegram"]["id"],
+                processed_at=processed_at + dt.timedelta(days=i),
+                meta={"status": "done", "metrics": {"rows_inserted": i, "process_peak_rss_kb": 1024}},
+            )
+            for i in range(2)
+        ]
+        # Not processed yet
+        pending = gen_chat_upload(user_id=USERS[0]["id"], chat_type_id=chat_types["telegram"]["id"])
+        with engine.cursor() as cur:
+            insert_many(cur, "general.users", USERS)
+            insert_many(cur, "general.chat_uploads", [*_uploads, pending])
+        engine.commit()
+        return _uploads
+
+    @pytest.mark.parametrize(
+        "params,expected",
+        [
+            pytest.param({}, [1, 0], id="all"),
+            pytest.param({"from_date": "2024-01-03T00:00:00Z"}, [1], id="from-date"),
+            pytest.param({"limit": 1}, [1], id="limit"),
+        ],
+    )
+    def test_get_uploads_metrics(self, client, uploads, params, expected):
+        resp = client.get("/chats/uploads/metrics", params=params)
+        assert resp.status_code == HTTPStatus.OK, resp.text
+
+        resp_data = resp.json()
+        # Most recently processed first
+        assert [x["file_id"] for x in resp_data] == [uploads[i]["id"] for i in expected]
+        for _upload, i in zip(resp_data, expected):
+            assert _upload["status"] == "done"
+            assert _upload["metrics"]["rows_inserted"] == i
+            assert _upload["metrics"]["process_peak_rss_kb"] == 1024
+            assert _upload["metrics"]["download_ms"] is None
@@ -0,0 +1,165 @@
+import datetime as dt
+import json
+import os
+
+import asyncpg
+import psycopg
+import pytest
+
+from ..data.db import gen_telegram_group, gen_user
+
+# Migrations replace tables, they are tested on their own database
+MIGRATIONS_DATABASE = "polarsen_test_migrations"
+
+
+def _pg_params() -> dict:
+    return {
+        "user": os.environ["PG_USER"],
+        "password": os.environ["PG_PASSWORD"],
+        "host": os.environ["PG_HOST"],
+        "port": 5432,
+    }
+
+
+@pytest.fixture
+def migration_conn(loop):
+    from tracktolib.pg import insert_many
+    from polarsen.cli.db import CHAT_TYPES, run_sql_files
+    from polarsen.pg import init_connection
+
+    with psycopg.connect(dbname=os.environ["PG_DATABASE"], autocommit=True, **_pg_params()) as admin:
+        admin.execute(f"DROP DATABASE IF EXISTS {MIGRATIONS_DATABASE} WITH (FORCE)")
+        admin.execute(f"CREATE DATABASE {MIGRATIONS_DATABASE}")
+    conn = loop.run_until_complete(asyncpg.connect(database=MIGRATIONS_DATABASE, **_pg_params()))
+    loop.run_until_complete(run_sql_files(conn))
+    loop.run_until_complete(insert_many(conn, "general.chat_types", CHAT_TYPES))
+    # The vector type is only created by the setup
+    loop.run_until_complete(init_connection(conn))
+    try:
+        yield conn
+    finally:
+        loop.run_until_complete(conn.close())
+        with psycopg.connect(dbname=os.environ["PG_DATABASE"], autocommit=True, **_pg_params()) as admin:
+            admin.execute(f"DROP DATABASE IF EXISTS {MIGRATIONS_DATABASE} WITH (FORCE)")
+
+
+def _add_user(loop, conn: asyncpg.Connection) -> int:
+    from tracktolib.pg import insert_one
+
+    user = gen_user()
+    loop.run_until_complete(insert_one(conn, "general.users", user))
+    return user["id"]
+
+
+async def _get_constraints(conn: asyncpg.Connection, table: str) -> set[str]:
+    rows = await conn.fetch("SELECT conname FROM pg_constraint WHERE conrelid = $1::regclass", table)
+    return {x["conname"] for x in rows}
+
+
+def test_partition_messages(loop, migration_conn):
+    from polarsen.cli.db import partition_messages
+    from polarsen.db.chat import TelegramGroup
+    from polarsen.utils import iter_bytes
+
+    conn = migration_conn
+    user_id = _add_user(loop, conn)
+    exports = [json.dumps(gen_telegram_group()).encode() for _ in range(3)]
+
+    async def _save(delta: bool = True):
+        for export in exports:
+            await TelegramGroup.save_stream(conn, iter_bytes(export), created_by=user_id, delta=delta)
+
+    async def _get_messages() -> list[tuple]:
+        rows = await conn.fetch(
+            "SELECT id, chat_id, internal_code, reply_to_id, thread_root_id FROM general.chat_messages ORDER BY id"
+        )
+        return [tuple(x) for x in rows]
+
+    async def _get_sequence():
+        return tuple(await conn.fetchrow("SELECT last_value, is_called FROM general.chat_messages_id_seq"))
+
+    loop.run_until_complete(_save())
+    messages, sequence = loop.run_until_complete(_get_messages()), loop.run_until_complete(_get_sequence())
+    assert len(messages) == 9
+
+    assert loop.run_until_complete(partition_messages(conn, nb_partitions=4))
+    assert not loop.run_until_complete(partition_messages(conn, nb_partitions=4))
+
+    relkind = loop.run_until_complete(
+        conn.fetchval("SELECT relkind FROM pg_class WHERE oid = 'general.chat_messages'::regclass")
+    )
+    assert relkind == "p"
+    assert loop.run_until_complete(_get_messages()) == messages
+    assert loop.run_until_complete(_get_sequence()) == sequence
+    assert {
+        "unique_chat_group_idx",
+        "chat_messages_chat_id_fkey",
+        "chat_messages_chat_user_id_fkey",
+        "chat_messages_reply_to_fkey",
+    } <= loop.run_until_complete(_get_constraints(conn, "general.chat_messages"))
+    assert "message_group_chats_msg_fkey" in loop.run_until_complete(_get_constraints(conn, "ai.message_group_chats"))
+    for relation in ("general.unique_message_idx", "general.message_replies_view"):
+        assert loop.run_until_complete(conn.fetchval("SELECT to_regclass($1)", relation)) is not None
+
+    # Saving the exports again goes through the conflict path of the new table, keeping the IDs
+    loop.run_until_complete(_save(delta=False))
+    assert loop.run_until_complete(_get_messages()) == messages
+
+
+def test_partition_requests(loop, migration_conn):
+    from polarsen.cli.db import partition_requests
+    from polarsen.db.ai import Requests
+
+    conn = migration_conn
+    user_id = _add_user(loop, conn)
+    # Table created before the requests were partitioned
+    loop.run_until_complete(
+        conn.execute(
+            """
+            DROP TABLE ai.requests;
+            CREATE TABLE ai.requests
+            (
+                id            BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                request_type  TEXT        NOT NULL,
+                total_tokens  INT         NOT NULL,
+                input_tokens  INT         NOT NULL,
+                output_tokens INT         NOT NULL,
+                cached_tokens INT         NOT NULL DEFAULT 0,
+                created_at    timestamptz NOT NULL DEFAULT now(),
+                meta          JSONB,
+                payload       JSONB,
+                run_id        UUID,
+                user_id       BIGINT      NOT NULL REFERENCES general.users
+            );
+            """
+        )
+    )
+    months = [dt.datetime.now(dt.timezone.utc).date().replace(day=1)]
+    for _ in range(2):
+        months.append((months[-1] - dt.timedelta(days=1)).replace(day=1))
+    loop.run_until_complete(
+        conn.executemany(
+            """
+            INSERT INTO ai.requests (request_type, total_tokens, input_tokens, output_tokens, created_at, user_id)
+            VALUES ('completion', 3, 2, 1, $1, $2)
+            """,
+            [(dt.datetime(x.year, x.month, 2, tzinfo=dt.timezone.utc), user_id) for x in months],
+        )
+    )
+
+    assert loop.run_until_complete(partition_requests(conn))
+    assert not loop.run_until_complete(partition_requests(conn))
+
+    assert loop.run_until_complete(Requests.is_partitioned(conn))
+    assert loop.run_until_complete(conn.fetchval("SELECT count(*) FROM ai.requests")) == 3
+    assert loop.run_until_complete(conn.fetchval("SELECT count(*) FROM ai.requests_default")) == 0
+    for month in months:
+        assert loop.run_until_complete(conn.fetchval(f"SELECT count(*) FROM ai.requests_{month:%Y%m}")) == 1
+    assert {"requests_pkey", "requests_user_id_fkey"} <= loop.run_until_complete(_get_constraints(conn, "ai.requests"))
+    assert loop.run_until_complete(conn.fetchval("SELECT to_regclass('ai.requests_user_created_at_idx')")) is not None
+
+    # The identity continues after the copied requests
+    request_id = loop.run_until_complete(
+        Requests.load("completion", {"total": 3, "input": 2, "output": 1}, user_id=user_id).save(conn)
+    )
+    assert request_id == 4
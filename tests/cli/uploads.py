@@ -0,0 +1,250 @@
+import io
+import json
+import os
+import zipfile
+
+import pytest
+import zstandard
+from tracktolib.pg_sync import insert_many, fetch_all
+
+from ..data.db import gen_user, gen_chat_upload, gen_telegram_group, load_chat_types
+
+os.environ["CHAT_UPLOADS_S3_BUCKET"] = os.getenv("CHAT_UPLOADS_S3_BUCKET", "test-bucket")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def setup_bucket(minio_client):
+    bucket = os.environ["CHAT_UPLOADS_S3_BUCKET"]
+    if not minio_client.bucket_exists(bucket):
+        minio_client.make_bucket(bucket)
+
+
+def _add_upload(
+    engine,
+    minio_client,
+    user_id: int,
+    chat_type_id: int,
+    content: bytes,
+    compression: str | None = None,
+    meta: dict | None = None,
+) -> int:
+    _upload = gen_chat_upload(
+        user_id=user_id, chat_type_id=chat_type_id, mime_type="application/json", compression=compression, meta=meta
+    )
+    minio_client.put_object(
+        os.environ["CHAT_UPLOADS_S3_BUCKET"], _upload["file_path"], io.BytesIO(content), length=len(content)
+    )
+    with engine.cursor() as cur:
+        insert_many(cur, "general.chat_uploads", [_upload])
+    engine.commit()
+    return _upload["id"]
+
+
+@pytest.mark.parametrize("parse_workers", [pytest.param(0, id="in-loop"), pytest.param(2, id="process-pool")])
+def test_process_uploads(loop, aengine, engine, minio_client, parse_workers):
+    import niquests
+    from polarsen.cli.ingest import process_uploads, get_parse_executor
+    from polarsen.s3_utils import get_s3_client
+
+    user = gen_user()
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+    engine.commit()
+    chat_type_id = load_chat_types(engine, as_dict=True)["telegram"]["id"]
+    _zip = io.BytesIO()
+    with zipfile.ZipFile(_zip, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("ChatExport/result.json", json.dumps(gen_telegram_group()))
+    valid_ids = [
+        _add_upload(engine, minio_client, user["id"], chat_type_id, json.dumps(gen_telegram_group()).encode()),
+        _add_upload(
+            engine,
+            minio_client,
+            user["id"],
+            chat_type_id,
+            zstandard.ZstdCompressor().compress(json.dumps(gen_telegram_group()).encode()),
+            compression="zstd",
+        ),
+        _add_upload(engine, minio_client, user["id"], chat_type_id, _zip.getvalue(), compression="zip"),
+    ]
+    invalid_id = _add_upload(engine, minio_client, user["id"], chat_type_id, b'{"name": "Invalid", "messages": [')
+
+    async def _test():
+        async with niquests.AsyncSession() as session:
+            with get_s3_client() as s3_client, get_parse_executor(parse_workers) as parse_executor:
+                return await process_uploads(
+                    client=session, conn=aengine, s3_client=s3_client, parse_executor=parse_executor
+                )
+
+    chat_ids = loop.run_until_complete(_test())
+
+    assert len(chat_ids) == 3
+    uploads = {x["id"]: x for x in fetch_all(engine, "SELECT * FROM general.chat_uploads")}
+    for _id in valid_ids:
+        assert uploads[_id]["processed_at"] is not None
+        assert uploads[_id]["meta"]["status"] == "done"
+        metrics = uploads[_id]["meta"]["metrics"]
+        assert metrics["bytes_downloaded"] > 0
+        assert metrics["messages_parsed"] == metrics["rows_inserted"] == 3
+        assert metrics["messages_already_saved"] == 0
+        assert metrics["process_peak_rss_kb"] > 0
+    # The invalid upload is rolled back without affecting the others
+    assert uploads[invalid_id]["processed_at"] is None
+    assert uploads[invalid_id]["meta"]["status"] == "error"
+    assert len(fetch_all(engine, "SELECT * FROM general.chats")) == 3
+    assert len(fetch_all(engine, "SELECT * FROM general.chat_messages")) == 9
+    # Uploads in error are not picked up again
+    assert loop.run_until_complete(_test()) == []
+
+
+def test_process_uploads_write_error(loop, aengine, engine, minio_client, monkeypatch, tmp_path):
+    import asyncio
+    import niquests
+    from polarsen.cli.bench import _write_export
+    from polarsen.cli.ingest import process_uploads, get_parse_executor
+    from polarsen.db.chat import TelegramGroup
+    from polarsen.s3_utils import get_s3_client
+
+    user = gen_user()
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+    engine.commit()
+    chat_type_id = load_chat_types(engine, as_dict=True)["telegram"]["id"]
+    # Large enough to fill the queues between the stages once the write stage stops reading
+    _write_export(tmp_path / "result.json", 60_000)
+    failed_id = _add_upload(engine, minio_client, user["id"], chat_type_id, (tmp_path / "result.json").read_bytes())
+    valid_id = _add_upload(engine, minio_client, user["id"], chat_type_id, json.dumps(gen_telegram_group()).encode())
+
+    save_messages, nb_batches = TelegramGroup.save_messages, 0
+
+    async def _save_messages(self, conn, chat_id, messages, **kwargs):
+        nonlocal nb_batches
+        nb_batches += 1
+        if len(messages) > 3 and nb_batches > 2:
+            raise ValueError("Failed to save the messages")
+        return await save_messages(self, conn, chat_id=chat_id, messages=messages, **kwargs)
+
+    monkeypatch.setattr(TelegramGroup, "save_messages", _save_messages)
+
+    async def _test():
+        async with niquests.AsyncSession() as session:
+            with get_s3_client() as s3_client, get_parse_executor(1) as parse_executor:
+                return await asyncio.wait_for(
+                    process_uploads(client=session, conn=aengine, s3_client=s3_client, parse_executor=parse_executor),
+                    timeout=60,
+                )
+
+    assert len(loop.run_until_complete(_test())) == 1
+    uploads = {x["id"]: x for x in fetch_all(engine, "SELECT * FROM general.chat_uploads")}
+    assert uploads[failed_id]["meta"]["status"] == "error"
+    # The next upload is still processed
+    assert uploads[valid_id]["meta"]["status"] == "done"
+    assert len(fetch_all(engine, "SELECT * FROM general.chat_messages")) == 3
+
+
+def test_process_uploads_stale_claim(loop, aengine, engine, minio_client):
+    import datetime as dt
+    import niquests
+    from polarsen.cli.ingest import process_uploads
+    from polarsen.s3_utils import get_s3_client
+
+    user = gen_user()
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+    engine.commit()
+    chat_type_id = load_chat_types(engine, as_dict=True)["telegram"]["id"]
+    now = dt.datetime.now(dt.timezone.utc)
+
+    def _add_claimed(claimed_at: dt.datetime) -> int:
+        return _add_upload(
+            engine,
+            minio_client,
+            user["id"],
+            chat_type_id,
+            json.dumps(gen_telegram_group()).encode(),
+            meta={"status": "processing", "processing_started_at": claimed_at.isoformat()},
+        )
+
+    # Left by a worker killed while processing it
+    stale_id = _add_claimed(now - dt.timedelta(hours=2))
+    # Still being processed by another worker
+    claimed_id = _add_claimed(now - dt.timedelta(minutes=5))
+
+    async def _test():
+        async with niquests.AsyncSession() as session:
+            with get_s3_client() as s3_client:
+                return await process_uploads(
+                    client=session, conn=aengine, s3_client=s3_client, claim_timeout=dt.timedelta(hours=1)
+                )
+
+    assert len(loop.run_until_complete(_test())) == 1
+    uploads = {x["id"]: x for x in fetch_all(engine, "SELECT * FROM general.chat_uploads")}
+    assert uploads[stale_id]["processed_at"] is not None
+    assert uploads[stale_id]["meta"]["status"] == "done"
+    assert uploads[claimed_id]["processed_at"] is None
+    assert uploads[claimed_id]["meta"]["status"] == "processing"
+
+
+def test_process_uploads_fetch_error(loop, aengine, engine, minio_client):
+    import niquests
+    from polarsen.cli.ingest import process_uploads
+    from polarsen.s3_utils import get_s3_client
+
+    user = gen_user()
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+    engine.commit()
+    chat_type_id = load_chat_types(engine, as_dict=True)["telegram"]["id"]
+    # Never sent to S3
+    missing = gen_chat_upload(user_id=user["id"], chat_type_id=chat_type_id, mime_type="application/json")
+    with engine.cursor() as cur:
+        insert_many(cur, "general.chat_uploads", [missing])
+    engine.commit()
+    valid_id = _add_upload(engine, minio_client, user["id"], chat_type_id, json.dumps(gen_telegram_group()).encode())
+
+    async def _test():
+        async with niquests.AsyncSession() as session:
+            with get_s3_client() as s3_client:
+                return await process_uploads(client=session, conn=aengine, s3_client=s3_client)
+
+    assert len(loop.run_until_complete(_test())) == 1
+    uploads = {x["id"]: x for x in fetch_all(engine, "SELECT * FROM general.chat_uploads")}
+    assert uploads[valid_id]["meta"]["status"] == "done"
+    # Released by the write stage, to be retried later
+    assert uploads[missing["id"]]["processed_at"] is None
+    assert "status" not in uploads[missing["id"]]["meta"]
+
+
+def test_clean_orphan_uploads(loop, aengine, engine, minio_client):
+    import datetime as dt
+    import niquests
+    from polarsen.cli.ingest import clean_orphan_uploads
+    from polarsen.s3_utils import get_s3_client
+
+    bucket = os.environ["CHAT_UPLOADS_S3_BUCKET"]
+    user = gen_user()
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+    engine.commit()
+    chat_type_id = load_chat_types(engine, as_dict=True)["telegram"]["id"]
+    upload_id = _add_upload(engine, minio_client, user["id"], chat_type_id, b"{}")
+    (saved_key,) = [x["file_path"] for x in fetch_all(engine, "SELECT file_path FROM general.chat_uploads")]
+    # Sent to S3 but never saved
+    orphan_key = f"{user['id']}/orphan-{upload_id}.json.zst"
+    minio_client.put_object(bucket, orphan_key, io.BytesIO(b"{}"), length=2)
+
+    def _clean(older_than: dt.timedelta) -> list[str]:
+        async def _test():
+            async with niquests.AsyncSession() as session:
+                with get_s3_client() as s3_client:
+                    return await clean_orphan_uploads(session, aengine, s3_client, older_than=older_than)
+
+        return loop.run_until_complete(_test())
+
+    # Recent objects may still be saved
+    assert orphan_key not in _clean(dt.timedelta(hours=1))
+    orphans = _clean(dt.timedelta(0))
+    assert orphan_key in orphans
+    assert saved_key not in orphans
+    keys = {x.object_name for x in minio_client.list_objects(bucket, recursive=True)}
+    assert orphan_key not in keys
+    assert saved_key in keys
@@ -52,6 +52,8 @@ def loop():
 
 @pytest.fixture(scope="session")
 def aengine(loop):
+    from polarsen.pg import init_connection
+
     conn = loop.run_until_complete(
         asyncpg.connect(
             database=os.environ["PG_DATABASE"],
@@ -61,6 +63,8 @@ def aengine(loop):
             port=5432,
         )
     )
+    # Same codecs as the application connections
+    loop.run_until_complete(init_connection(conn))
     try:
         yield conn
     finally:
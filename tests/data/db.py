@@ -199,6 +199,8 @@ class ChatUpload(TypedDict):
     processed_at: dt.datetime | None
     created_at: NotRequired[dt.datetime]
     chat_type_id: int | None
+    compression: str | None
+    meta: NotRequired[dict | None]
 
 
 def gen_chat_upload(
@@ -208,6 +210,8 @@ def gen_chat_upload(
     mime_type: str = "text/plain",
     processed_at: dt.datetime | None = None,
     chat_type_id: int = 0,
+    compression: str | None = None,
+    meta: dict | None = None,
 ) -> ChatUpload:
     _id = Fake.id()
     return {
@@ -221,6 +225,8 @@ def gen_chat_upload(
         "md5": Fake.md5(),
         "processed_at": processed_at,
         "chat_type_id": chat_type_id,
+        "compression": compression,
+        "meta": meta,
     }
 
 
@@ -231,6 +237,8 @@ class ChatMessage(TypedDict):
     message: str
     internal_code: str
     sent_at: dt.datetime
+    thread_root_id: int
+    depth: int
 
 
 def gen_chat_message(
@@ -244,6 +252,8 @@ def gen_chat_message(
         "message": message if message is not None else Fake.sentence(),
         "internal_code": f"msg_{_id}",
         "sent_at": sent_at,
+        "thread_root_id": _id,
+        "depth": 0,
     }
 
 
@@ -272,6 +282,7 @@ class MessageGroup(TypedDict):
     internal_code: str
     summary: str | None
     title: str | None
+    day: dt.date | None
     meta: NotRequired[dict | None]
 
 
@@ -281,6 +292,7 @@ def gen_message_group(
     summary: str | None = None,
     title: str | None = None,
     meta: dict | None | NotSet = NOT_SET,
+    day: dt.date | None = DEFAULT_DATETIME.date(),
 ) -> MessageGroup:
     _id = Fake.id()
     _data: MessageGroup = {
@@ -290,6 +302,7 @@ def gen_message_group(
         "internal_code": f"group_{_id}",
         "summary": summary if summary is not None else Fake.sentence(),
         "title": title if title is not None else Fake.sentence(),
+        "day": day,
     }
     if not is_not_set(meta):
         _data["meta"] = meta
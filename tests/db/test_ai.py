@@ -0,0 +1,224 @@
+import pytest
+from tracktolib.pg_sync import insert_many
+
+from tests.data import gen_user, gen_chat, gen_message_group_method, gen_message_group
+
+
+def _embedding(*values: float) -> list[float]:
+    from polarsen.db.ai import MISTRAL_EMBED_VECTOR_SIZE
+
+    return [float(x) for x in values] + [0.0] * (MISTRAL_EMBED_VECTOR_SIZE - len(values))
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        pytest.param(None, id="default"),
+        pytest.param({"ef_search": 10}, id="ef-search"),
+        pytest.param({"probes": 5}, id="probes"),
+    ],
+)
+def test_search_nearest(loop, aengine, engine, params):
+    from polarsen.db.ai import MistralGroupEmbeddings
+
+    user = gen_user()
+    chats = [gen_chat(created_by=user["id"]), gen_chat(created_by=user["id"])]
+    method = gen_message_group_method()
+    groups = [gen_message_group(chat_id=chats[0]["id"], group_method_id=method["id"]) for _ in range(3)]
+    # Closest to the question, but in another chat
+    other_group = gen_message_group(chat_id=chats[1]["id"], group_method_id=method["id"])
+    embeddings = [
+        {"group_id": groups[0]["id"], "chat_id": chats[0]["id"], "embedding": _embedding(1)},
+        {"group_id": groups[1]["id"], "chat_id": chats[0]["id"], "embedding": _embedding(0, 0, 1)},
+        {"group_id": groups[2]["id"], "chat_id": chats[0]["id"], "embedding": _embedding(0.9, 0.1)},
+        {"group_id": other_group["id"], "chat_id": chats[1]["id"], "embedding": _embedding(1)},
+    ]
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+        insert_many(cur, "general.chats", chats)
+        insert_many(cur, "ai.message_group_methods", [method])
+        insert_many(cur, "ai.message_groups", [*groups, other_group])
+        insert_many(cur, "ai.mistral_group_embeddings", embeddings)
+    engine.commit()
+
+    results = loop.run_until_complete(
+        MistralGroupEmbeddings.search_nearest(
+            aengine,
+            _embedding(1),
+            chat_id=chats[0]["id"],
+            limit=2,
+            params=params,
+        )
+    )
+    assert [x["group_id"] for x in results] == [groups[0]["id"], groups[2]["id"]]
+    assert results[0]["distance"] == pytest.approx(0)
+
+
+def test_delete_days(loop, aengine, engine):
+    import datetime as dt
+    from tracktolib.pg_sync import fetch_all
+    from polarsen.db.ai import MessageGroup
+
+    user = gen_user()
+    chat = gen_chat(created_by=user["id"])
+    method = gen_message_group_method()
+    day = dt.date(2024, 1, 1)
+    groups = [
+        gen_message_group(chat_id=chat["id"], group_method_id=method["id"], day=day),
+        gen_message_group(chat_id=chat["id"], group_method_id=method["id"], day=day + dt.timedelta(days=1)),
+    ]
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+        insert_many(cur, "general.chats", [chat])
+        insert_many(cur, "ai.message_group_methods", [method])
+        insert_many(cur, "ai.message_groups", groups)
+        insert_many(
+            cur,
+            "ai.mistral_group_embeddings",
+            [{"group_id": x["id"], "chat_id": chat["id"], "embedding": _embedding(1)} for x in groups],
+        )
+    engine.commit()
+
+    loop.run_until_complete(MessageGroup.delete_days(aengine, chat_id=chat["id"], days=[day]))
+
+    assert [x["id"] for x in fetch_all(engine, "SELECT id FROM ai.message_groups")] == [groups[1]["id"]]
+    assert [x["group_id"] for x in fetch_all(engine, "SELECT group_id FROM ai.mistral_group_embeddings")] == [
+        groups[1]["id"]
+    ]
+
+
+def test_requests_update_meta(loop, aengine, engine):
+    import uuid
+    from tracktolib.pg_sync import fetch_all
+    from polarsen.db.ai import Requests
+
+    user = gen_user()
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+    engine.commit()
+    run_id = uuid.uuid4()
+    token = {"total": 3, "input": 2, "output": 1}
+
+    async def _test():
+        _requests = [
+            Requests.load("completion", token, user_id=user["id"], run_id=run_id, meta={"day": day})
+            for day in ("2024-01-01", "2024-01-02")
+        ]
+        _ids = [await x.save(aengine) for x in _requests]
+        return _ids, await Requests.update_meta(aengine, _ids[1], _requests[1].created_at, {"missing_ids": [1]})
+
+    request_ids, nb_updated = loop.run_until_complete(_test())
+
+    # Only the row of the request is updated, not every row of the run
+    assert nb_updated == 1
+    metas = {x["id"]: x["meta"] for x in fetch_all(engine, "SELECT id, meta FROM ai.requests")}
+    assert metas == {
+        request_ids[0]: {"day": "2024-01-01"},
+        request_ids[1]: {"day": "2024-01-02", "missing_ids": [1]},
+    }
+
+
+def test_requests_payload(loop, aengine, engine):
+    from tracktolib.pg_sync import fetch_one
+    from polarsen.db.ai import Requests
+
+    user = gen_user()
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+    engine.commit()
+    payload = {"contents": [{"role": "user", "parts": [{"text": "Hello " * 1000}]}]}
+    request = Requests.load("completion", {"total": 3, "input": 2, "output": 1}, user_id=user["id"], payload=payload)
+
+    request_id = loop.run_until_complete(request.save(aengine))
+
+    row = fetch_one(engine, "SELECT payload, payload_zstd FROM ai.requests WHERE id = %s", request_id)
+    assert row is not None
+    # Stored compressed, not as JSONB
+    assert row["payload"] is None
+    assert 0 < len(row["payload_zstd"]) < len("Hello " * 1000)
+    assert loop.run_until_complete(Requests.get_payload(aengine, request_id, request.created_at)) == payload
+
+
+def test_requests_partitions(loop, aengine, engine):
+    import datetime as dt
+    from tracktolib.pg_sync import fetch_all
+    from polarsen.db.ai import Requests
+
+    user = gen_user()
+    today = dt.datetime.now(dt.timezone.utc).date()
+    # Partitions are created ahead of time from the setup, not for the past months
+    month = (today.replace(day=1) - dt.timedelta(days=32)).replace(day=1)
+    partition = f"requests_{month:%Y%m}"
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+        insert_many(
+            cur,
+            "ai.requests",
+            [
+                {
+                    "request_type": "completion",
+                    "total_tokens": 3,
+                    "input_tokens": 2,
+                    "output_tokens": 1,
+                    "user_id": user["id"],
+                    "created_at": dt.datetime(month.year, month.month, 15, tzinfo=dt.timezone.utc),
+                }
+            ],
+        )
+    engine.commit()
+    assert len(fetch_all(engine, "SELECT * FROM ai.requests_default")) == 1
+
+    created = loop.run_until_complete(Requests.create_partitions(aengine, from_month=month, months_ahead=0))
+    assert partition in created
+    # The request is moved from the default partition to its month
+    assert len(fetch_all(engine, "SELECT * FROM ai.requests_default")) == 0
+    assert len(fetch_all(engine, f"SELECT * FROM ai.{partition}")) == 1
+
+    # Expired request saved to the default partition, its month never got a partition
+    expired_month = (month - dt.timedelta(days=1)).replace(day=1)
+    with engine.cursor() as cur:
+        insert_many(
+            cur,
+            "ai.requests",
+            [
+                {
+                    "request_type": "completion",
+                    "total_tokens": 3,
+                    "input_tokens": 2,
+                    "output_tokens": 1,
+                    "user_id": user["id"],
+                    "created_at": dt.datetime(expired_month.year, expired_month.month, 15, tzinfo=dt.timezone.utc),
+                }
+            ],
+        )
+    engine.commit()
+
+    assert loop.run_until_complete(Requests.drop_partitions(aengine, keep_months=2)) == [partition]
+    assert fetch_all(engine, "SELECT * FROM ai.requests") == []
+
+
+def test_create_index(loop, aengine):
+    from polarsen.cli.db import run_sql_files
+    from polarsen.db.ai import MistralGroupEmbeddings
+
+    async def _get_indexes() -> set[str]:
+        rows = await aengine.fetch(
+            """
+            SELECT indexname
+            FROM pg_indexes
+            WHERE schemaname = 'ai'
+              AND tablename = 'mistral_group_embeddings'
+              AND indexdef ~ 'USING (hnsw|ivfflat)'
+            """
+        )
+        return {x["indexname"] for x in rows}
+
+    assert loop.run_until_complete(_get_indexes()) == {"mistral_group_embeddings_hnsw_idx"}
+    loop.run_until_complete(MistralGroupEmbeddings.create_index(aengine, "ivfflat", concurrently=True))
+    # The new index replaced the previous one, under its final name
+    assert loop.run_until_complete(_get_indexes()) == {"mistral_group_embeddings_ivfflat_idx"}
+    # The setup keeps the index built by `db vector-index`
+    loop.run_until_complete(run_sql_files(aengine))
+    assert loop.run_until_complete(_get_indexes()) == {"mistral_group_embeddings_ivfflat_idx"}
+    loop.run_until_complete(MistralGroupEmbeddings.create_index(aengine, "hnsw", concurrently=True))
+    assert loop.run_until_complete(_get_indexes()) == {"mistral_group_embeddings_hnsw_idx"}
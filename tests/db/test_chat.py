@@ -1,10 +1,15 @@
+import json
+
 import pytest
 from tracktolib.pg_sync import fetch_all, insert_one
 
-from tests.data import gen_telegram_group, gen_user
+from tests.data import Fake, gen_telegram_group, gen_user
 
 USER = gen_user()
 SIMPLE_TELEGRAM_GROUP = gen_telegram_group()
+SIMPLE_TELEGRAM_GROUP_MESSAGES = list(SIMPLE_TELEGRAM_GROUP["messages"])
+# `TelegramGroup.load` pops the messages of the group it is given
+STREAM_TELEGRAM_GROUP = gen_telegram_group()
 
 EXPECTED_SIMPLE_TELEGRAM_GROUP = {
     "chat_users": 2,
@@ -33,3 +38,173 @@ def test_load_save_telegram_group(data, expected, loop, aengine, engine):
     assert len(chats_db) == expected["chats"]
     messages_db = fetch_all(engine, "SELECT * FROM general.chat_messages")
     assert len(messages_db) == expected["messages"]
+
+
+@pytest.mark.parametrize(
+    "data,expected", [pytest.param(STREAM_TELEGRAM_GROUP, EXPECTED_SIMPLE_TELEGRAM_GROUP, id="simple")]
+)
+@pytest.mark.parametrize("batch_size", [pytest.param(1, id="batch-1"), pytest.param(1_000, id="batch-1000")])
+@pytest.mark.parametrize("mode", ["insert", "copy"])
+def test_save_stream_telegram_group(data, expected, batch_size, mode, loop, aengine, engine):
+    from polarsen.db.chat import TelegramGroup
+    from polarsen.utils import iter_bytes
+
+    _data = json.dumps(data).encode()
+    loop.run_until_complete(
+        TelegramGroup.save_stream(
+            aengine, iter_bytes(_data, chunk_size=16), created_by=USER["id"], batch_size=batch_size, mode=mode
+        )
+    )
+    chat_users_db = fetch_all(engine, "SELECT * FROM general.chat_users")
+    assert len(chat_users_db) == expected["chat_users"]
+    chats_db = fetch_all(engine, "SELECT * FROM general.chats")
+    assert len(chats_db) == expected["chats"]
+    messages_db = fetch_all(engine, "SELECT * FROM general.chat_messages")
+    assert len(messages_db) == expected["messages"]
+    assert len([x for x in messages_db if x["reply_to_id"] is not None]) == 1
+
+
+def _gen_reply_chain_group():
+    _group = gen_telegram_group()
+    _msg1, _, _msg3 = _group["messages"]
+    _group["messages"].append(
+        {
+            **_msg1,
+            "id": Fake.id(),
+            "date": "2022-01-30T09:12:45",
+            "date_unixtime": "1643533965",
+            "reply_to_message_id": _msg3["id"],
+        }
+    )
+    return _group
+
+
+REPLY_CHAIN_TELEGRAM_GROUP = _gen_reply_chain_group()
+
+
+@pytest.mark.parametrize("batch_size", [pytest.param(1, id="batch-1"), pytest.param(1_000, id="batch-1000")])
+@pytest.mark.parametrize("mode", ["insert", "copy"])
+@pytest.mark.parametrize("delta", [pytest.param(True, id="delta"), pytest.param(False, id="full")])
+def test_save_stream_reply_chain(batch_size, mode, delta, loop, aengine, engine):
+    from polarsen.db.chat import TelegramGroup
+    from polarsen.utils import iter_bytes
+
+    _data = json.dumps(REPLY_CHAIN_TELEGRAM_GROUP).encode()
+
+    def _save(_delta: bool):
+        loop.run_until_complete(
+            TelegramGroup.save_stream(
+                aengine, iter_bytes(_data), created_by=USER["id"], batch_size=batch_size, mode=mode, delta=_delta
+            )
+        )
+
+    def _get_messages() -> dict[str, dict]:
+        _messages = fetch_all(
+            engine, "SELECT id, internal_code, reply_to_id, thread_root_id, depth FROM general.chat_messages"
+        )
+        return {x["internal_code"]: x for x in _messages}
+
+    _save(delta)
+    messages_first = _get_messages()
+    # Saving again in full mode upserts all the messages and must keep the IDs of the ones already saved
+    _save(False)
+    messages_db = _get_messages()
+    assert messages_db == messages_first
+    assert len(messages_db) == 4
+    msg1, _, msg3, msg4 = REPLY_CHAIN_TELEGRAM_GROUP["messages"]
+    assert messages_db[str(msg3["id"])]["reply_to_id"] == messages_db[str(msg1["id"])]["id"]
+    assert messages_db[str(msg4["id"])]["reply_to_id"] == messages_db[str(msg3["id"])]["id"]
+    root_id = messages_db[str(msg1["id"])]["id"]
+    threads = [
+        (messages_db[str(m["id"])]["thread_root_id"], messages_db[str(m["id"])]["depth"]) for m in (msg1, msg3, msg4)
+    ]
+    assert threads == [(root_id, 0), (root_id, 1), (root_id, 2)]
+
+
+DELTA_TELEGRAM_GROUP = gen_telegram_group()
+
+
+@pytest.mark.parametrize("mode", ["insert", "copy"])
+def test_save_stream_delta(mode, loop, aengine, engine):
+    from polarsen.db.chat import TelegramGroup
+    from polarsen.utils import iter_bytes
+
+    def _save(data: dict):
+        return loop.run_until_complete(
+            TelegramGroup.save_stream(aengine, iter_bytes(json.dumps(data).encode()), created_by=USER["id"], mode=mode)
+        )
+
+    chat_id = _save(DELTA_TELEGRAM_GROUP)
+    assert fetch_all(engine, "SELECT meta FROM general.chats WHERE id = %s", chat_id)[0]["meta"] is None
+
+    # Re-export of the group with a new reply to an already saved message
+    msg1 = DELTA_TELEGRAM_GROUP["messages"][0]
+    new_msg = {
+        **msg1,
+        "id": Fake.id(),
+        "date": "2022-02-03T10:00:00",
+        "date_unixtime": "1643882400",
+        "reply_to_message_id": msg1["id"],
+    }
+    assert _save({**DELTA_TELEGRAM_GROUP, "messages": [*DELTA_TELEGRAM_GROUP["messages"], new_msg]}) == chat_id
+
+    messages_db = {x["internal_code"]: x for x in fetch_all(engine, "SELECT * FROM general.chat_messages")}
+    assert len(messages_db) == 4
+    assert messages_db[str(new_msg["id"])]["reply_to_id"] == messages_db[str(msg1["id"])]["id"]
+    assert messages_db[str(new_msg["id"])]["thread_root_id"] == messages_db[str(msg1["id"])]["thread_root_id"]
+    assert messages_db[str(new_msg["id"])]["depth"] == messages_db[str(msg1["id"])]["depth"] + 1
+    chat_meta = fetch_all(engine, "SELECT meta FROM general.chats WHERE id = %s", chat_id)[0]["meta"]
+    assert chat_meta["pending_days"] == ["2022-02-03"]
+
+
+def test_save_chat_lock(loop, aengine, engine):
+    import asyncio
+    import os
+    import asyncpg
+    from polarsen.db.chat import TelegramGroup
+
+    group = TelegramGroup.load(gen_telegram_group())
+
+    async def _test():
+        other_conn = await asyncpg.connect(
+            database=os.environ["PG_DATABASE"],
+            user=os.environ["PG_USER"],
+            password=os.environ["PG_PASSWORD"],
+            host=os.environ["PG_HOST"],
+            port=5432,
+        )
+        try:
+            async with aengine.transaction():
+                chat_id = await group.save_chat(aengine, created_by=USER["id"])
+                other_save = asyncio.create_task(group.save(other_conn, created_by=USER["id"]))
+                # Waits for the chat to be released
+                done, _ = await asyncio.wait([other_save], timeout=0.5)
+                assert not done
+            assert await asyncio.wait_for(other_save, timeout=5) == chat_id
+        finally:
+            await other_conn.close()
+
+    loop.run_until_complete(_test())
+    assert len(fetch_all(engine, "SELECT * FROM general.chat_messages")) == 3
+
+
+def test_telegram_message_rows():
+    from polarsen.db.chat import TelegramMessage
+
+    msg = SIMPLE_TELEGRAM_GROUP_MESSAGES[2]
+    message = TelegramMessage.load(chat_id=msg["id"], msg=msg)
+    assert message.text_entities == ()
+    assert len(TelegramMessage.load(chat_id=msg["id"], msg=msg, with_entities=True).text_entities) == 1
+    assert TelegramMessage.from_row(message.to_row()) == message
+    assert message.to_db_row(chat_id=1, chat_user_id=2, reply_to_chat_id=3, db_id=4) == (
+        4,
+        1,
+        2,
+        message.message_date,
+        str(msg["id"]),
+        msg["text"],
+        3,
+        4,
+        0,
+    )
+    assert message.to_db_row(chat_id=1, chat_user_id=2, reply_to_chat_id=3, db_id=4, thread=(1, 2))[-2:] == (1, 2)
@@ -0,0 +1,69 @@
+import datetime as dt
+
+import pytest
+from tracktolib.pg_sync import insert_many
+
+from tests.data import gen_user, gen_chat, gen_chat_user, gen_chat_message, load_chat_types
+
+DAY = dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+
+
+@pytest.fixture(scope="function")
+def messages(engine) -> dict[str, list[dict]]:
+    user = gen_user()
+    chats = [gen_chat(created_by=user["id"]), gen_chat(created_by=user["id"])]
+    chat_source_id = load_chat_types(engine, as_dict=True)["telegram"]["id"]
+    chat_users = [gen_chat_user(chat_id=x["id"], chat_source_id=chat_source_id) for x in chats]
+    _messages = {
+        "chat": [
+            gen_chat_message(chat_user_id=chat_users[0]["id"], chat_id=chats[0]["id"], sent_at=x)
+            for x in (
+                DAY + dt.timedelta(hours=12),
+                # Bounds of the second day
+                DAY + dt.timedelta(days=1),
+                DAY + dt.timedelta(days=2, microseconds=-1),
+                DAY + dt.timedelta(days=2),
+            )
+        ],
+        "other_chat": [
+            gen_chat_message(chat_user_id=chat_users[1]["id"], chat_id=chats[1]["id"], sent_at=x)
+            for x in (DAY + dt.timedelta(days=1, hours=12), DAY + dt.timedelta(days=4))
+        ],
+    }
+    with engine.cursor() as cur:
+        insert_many(cur, "general.users", [user])
+        insert_many(cur, "general.chats", chats)
+        insert_many(cur, "general.chat_users", chat_users)
+        insert_many(cur, "general.chat_messages", [*_messages["chat"], *_messages["other_chat"]])
+    engine.commit()
+    return _messages
+
+
+@pytest.mark.parametrize(
+    "chat,from_date,expected",
+    [
+        pytest.param("chat", None, [0, 1, 2], id="all"),
+        pytest.param("chat", dt.date(2024, 1, 2), [1, 2], id="from-date"),
+        # Only the days of the chat are listed when a from date is set
+        pytest.param("other_chat", dt.date(2024, 1, 3), [4], id="from-date-other-chat"),
+    ],
+)
+def test_get_days(loop, aengine, messages, chat, from_date, expected):
+    from polarsen.ai.conversations.v2 import _get_days
+
+    chat_id = messages[chat][0]["chat_id"]
+    days = loop.run_until_complete(_get_days(aengine, chat_id, from_date=from_date))
+    assert days == [DAY.date() + dt.timedelta(days=x) for x in expected]
+
+
+def test_get_messages_by_dates(loop, aengine, messages):
+    from polarsen.ai.conversations.v2 import get_messages_by_dates
+
+    chat_messages = messages["chat"]
+    _messages, nb_messages = loop.run_until_complete(
+        get_messages_by_dates(aengine, chat_id=chat_messages[0]["chat_id"], dates=[dt.date(2024, 1, 2)] * 2)
+    )
+    # Days are half-open ranges: the first instant of the next day is excluded,
+    # and the messages of the other chat sent the same day too
+    assert [x["id"] for x in _messages] == [chat_messages[1]["id"], chat_messages[2]["id"]]
+    assert nb_messages == 2
@@ -0,0 +1,26 @@
+from tracktolib.pg_sync import fetch_all, insert_one
+
+from tests.data import gen_user
+
+
+def test_copy_upsert_duplicate_keys(loop, aengine, engine):
+    from polarsen.db.utils import copy_upsert
+
+    user = gen_user()
+    insert_one(engine, "general.users", user)
+    records = [("chat-a", "First", user["id"]), ("chat-b", "Other", user["id"]), ("chat-a", "Last", user["id"])]
+
+    for _ in range(2):
+        loop.run_until_complete(
+            copy_upsert(
+                aengine,
+                "general.chats",
+                columns=("internal_code", "name", "created_by"),
+                records=records,
+                conflict_keys=("internal_code",),
+            )
+        )
+
+    chats = fetch_all(engine, "SELECT internal_code, name FROM general.chats ORDER BY internal_code")
+    # The last occurrence of the key in the records wins
+    assert [(x["internal_code"], x["name"]) for x in chats] == [("chat-a", "Last"), ("chat-b", "Other")]
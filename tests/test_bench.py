@@ -0,0 +1,24 @@
+import json
+
+
+def test_write_export(tmp_path):
+    from polarsen.cli.bench import _write_export, _iter_export_messages
+    from polarsen.db.chat import TelegramGroup, fmt_text
+
+    params = {"entity_ratio": 0.3, "action_ratio": 0.05}
+    path = tmp_path / "result.json"
+    _write_export(path, 1_000, **params)
+
+    raw_messages = [x for x in _iter_export_messages(1_000, **params) if x["type"] == "message"]
+    group = TelegramGroup.load(json.loads(path.read_text(encoding="utf-8")))
+
+    assert group.name == "Benchmark 1000"
+    # Service messages are skipped
+    assert group.nb_skipped == 1_000 - len(raw_messages)
+    assert [(m.message_id, m.from_user_id, m.text, m.reply_to_message_id) for m in group.messages] == [
+        (x["id"], x["from_id"], fmt_text(x["text"]), x.get("reply_to_message_id")) for x in raw_messages
+    ]
+    # Replies, including chains, and formatted texts are generated
+    replies = {m.message_id: m.reply_to_message_id for m in group.messages if m.reply_to_message_id is not None}
+    assert replies and any(x in replies for x in replies.values())
+    assert any(isinstance(x["text"], list) for x in raw_messages)
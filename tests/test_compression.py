@@ -0,0 +1,94 @@
+import io
+import json
+import random
+import zipfile
+
+import pytest
+
+
+def _zip(files: dict[str, bytes]) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+
+_random = random.Random(0)
+# Random texts keep a realistic compression ratio
+EXPORT = json.dumps(
+    {"name": "Test Group", "messages": [{"id": i, "text": _random.randbytes(16).hex()} for i in range(10_000)]}
+).encode()
+
+
+@pytest.mark.parametrize(
+    "compression, content",
+    [
+        pytest.param(None, EXPORT, id="raw"),
+        pytest.param("zstd", None, id="zstd"),
+        pytest.param("zip", _zip({"ChatExport/result.json": EXPORT, "ChatExport/photos/a.json": b"{}"}), id="zip"),
+        pytest.param("zip", _zip({"export.json": EXPORT, "photo.jpg": b"jpg"}), id="zip-single-json"),
+    ],
+)
+def test_iter_compressed_file(loop, tmp_path, compression, content):
+    from polarsen.compression import zstd_compress_stream, iter_compressed_file
+    from polarsen.utils import iter_bytes
+
+    async def _test():
+        _content = content
+        if compression == "zstd":
+            _content = b"".join([x async for x in zstd_compress_stream(iter_bytes(EXPORT))])
+        path = tmp_path / "export"
+        path.write_bytes(_content)
+        nb_read = 0
+
+        def _on_read(size: int):
+            nonlocal nb_read
+            nb_read += size
+
+        data = b"".join([x async for x in iter_compressed_file(path, compression, chunk_size=1024, on_read=_on_read)])
+        return data, nb_read, len(_content)
+
+    data, nb_read, size = loop.run_until_complete(_test())
+    assert data == EXPORT
+    assert 0 < nb_read <= size
+
+
+def test_iter_compressed_file_invalid_zip(loop, tmp_path):
+    from polarsen.compression import iter_compressed_file
+
+    path = tmp_path / "export.zip"
+    path.write_bytes(_zip({"a.json": b"{}", "b.json": b"{}"}))
+
+    async def _test():
+        return [x async for x in iter_compressed_file(path, "zip")]
+
+    with pytest.raises(ValueError, match="single JSON export"):
+        loop.run_until_complete(_test())
+
+
+@pytest.mark.parametrize(
+    "compression, content, max_size, match",
+    [
+        pytest.param("zstd", None, 1024, "maximum size", id="zstd-size"),
+        pytest.param("zip", _zip({"result.json": EXPORT}), 1024, "maximum size", id="zip-size"),
+        pytest.param("zip", _zip({"result.json": b" " * 1_000_000}), None, "Compression ratio", id="zip-ratio"),
+        pytest.param(
+            "zip", _zip({f"photos/{i}.jpg": b"" for i in range(10_001)}), None, "Too many files", id="zip-members"
+        ),
+    ],
+)
+def test_iter_compressed_file_limits(loop, tmp_path, compression, content, max_size, match):
+    from polarsen.compression import MAX_DECOMPRESSED_SIZE, iter_compressed_file, zstd_compress_stream
+    from polarsen.utils import iter_bytes
+
+    async def _test():
+        _content = content
+        if compression == "zstd":
+            _content = b"".join([x async for x in zstd_compress_stream(iter_bytes(EXPORT))])
+        path = tmp_path / "export"
+        path.write_bytes(_content)
+        return [x async for x in iter_compressed_file(path, compression, max_size=max_size or MAX_DECOMPRESSED_SIZE)]
+
+    with pytest.raises(ValueError, match=match):
+        loop.run_until_complete(_test())
@@ -0,0 +1,43 @@
+import datetime as dt
+
+import pytest
+
+
+def test_vector_codec():
+    import numpy as np
+    from polarsen.pg import encode_vector, decode_vector
+
+    values = [0.5, -1.25, 3.0]
+    data = encode_vector(values)
+    # pgvector binary format: dimensions, unused, then big-endian float4 values
+    assert data[:4] == b"\x00\x03\x00\x00"
+    assert len(data) == 4 + 4 * len(values)
+    decoded = decode_vector(data)
+    assert decoded.dtype == np.float32
+    assert decoded.tolist() == values
+    assert encode_vector(decoded) == data
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        pytest.param({"status": "done", "ids": [1, 2], "nested": {"a": None}}, id="dict"),
+        pytest.param([1, "a", 1.5, True], id="list"),
+        pytest.param("é", id="str"),
+    ],
+)
+def test_jsonb_codec(value):
+    from polarsen.pg import encode_jsonb, decode_jsonb
+
+    data = encode_jsonb(value)
+    assert data[:1] == b"\x01"
+    assert decode_jsonb(data) == value
+
+
+def test_jsonb_codec_types():
+    from polarsen.pg import encode_jsonb, decode_jsonb
+
+    value = {1: dt.date(2024, 1, 2)}
+    assert decode_jsonb(encode_jsonb(value)) == {"1": "2024-01-02"}
+    with pytest.raises(ValueError, match="version"):
+        decode_jsonb(b"\x02{}")
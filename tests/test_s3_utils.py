@@ -0,0 +1,181 @@
+import asyncio
+import io
+import os
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+
+import niquests
+import pytest
+
+BUCKET = "test-s3-utils"
+# Minimum size of the parts (but the last one) accepted by S3 and MinIO
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+@pytest.fixture(scope="module", autouse=True)
+def setup_bucket(minio_client):
+    if not minio_client.bucket_exists(BUCKET):
+        minio_client.make_bucket(BUCKET)
+
+
+class _PartSession(niquests.AsyncSession):
+    """Session failing the first `failures[n]` attempts to upload the part `n`, and delaying the parts of `delays`."""
+
+    def __init__(self, failures: dict[int, int] | None = None, delays: dict[int, float] | None = None):
+        super().__init__()
+        self.failures = failures or {}
+        self.delays = delays or {}
+        self.attempts: Counter[int] = Counter()
+
+    async def put(self, url: str, *args, **kwargs):
+        if part_number := parse_qs(urlparse(url).query).get("partNumber"):
+            _part = int(part_number[0])
+            self.attempts[_part] += 1
+            await asyncio.sleep(self.delays.get(_part, 0))
+            if self.attempts[_part] <= self.failures.get(_part, 0):
+                raise niquests.ConnectionError(f"Failed to upload part {_part}")
+        return await super().put(url, *args, **kwargs)
+
+
+def _upload(loop, session: niquests.AsyncSession, key: str, data: bytes, max_concurrency: int = 4):
+    from polarsen.s3_utils import s3_file_upload, get_s3_client
+    from polarsen.utils import iter_bytes
+
+    async def _test():
+        async with session:
+            with get_s3_client() as s3_client:
+                await s3_file_upload(
+                    s3_client,
+                    session,
+                    bucket=BUCKET,
+                    key=key,
+                    data=iter_bytes(data, chunk_size=1024 * 1024),
+                    min_part_size=MIN_PART_SIZE,
+                    max_concurrency=max_concurrency,
+                )
+
+    loop.run_until_complete(_test())
+
+
+@pytest.mark.parametrize("max_concurrency", [pytest.param(1, id="sequential"), pytest.param(4, id="concurrent")])
+def test_s3_file_upload(loop, minio_client, max_concurrency):
+    # Incompressible, so the upload is split in parts of 5, 5 and 6 MiB
+    data = os.urandom(3 * MIN_PART_SIZE + 1024 * 1024)
+    key = f"multipart-{max_concurrency}"
+    # The first part completes last
+    session = _PartSession(delays={1: 0.5})
+
+    _upload(loop, session, key, data, max_concurrency=max_concurrency)
+
+    assert minio_client.get_object(BUCKET, key).read() == data
+    # Multipart ETags end with the number of parts
+    assert minio_client.stat_object(BUCKET, key).etag.endswith("-3")
+    assert session.attempts == {1: 1, 2: 1, 3: 1}
+
+
+def test_s3_file_upload_part_retry(loop, minio_client):
+    data = os.urandom(2 * MIN_PART_SIZE)
+    session = _PartSession(failures={2: 1})
+
+    _upload(loop, session, "multipart-retry", data)
+
+    assert minio_client.get_object(BUCKET, "multipart-retry").read() == data
+    assert session.attempts == {1: 1, 2: 2}
+
+
+def test_s3_file_upload_part_error(loop, minio_client):
+    from minio.error import S3Error
+
+    data = os.urandom(2 * MIN_PART_SIZE)
+    session = _PartSession(failures={2: 3})
+
+    with pytest.raises(niquests.ConnectionError, match="part 2"):
+        _upload(loop, session, "multipart-error", data)
+
+    assert session.attempts[2] == 3
+    # The multipart upload is aborted, nothing is left in the bucket
+    with pytest.raises(S3Error):
+        minio_client.stat_object(BUCKET, "multipart-error")
+    assert loop.run_until_complete(_list_multipart_uploads("multipart-error")) == []
+
+
+async def _list_multipart_uploads(prefix: str) -> list[dict]:
+    from polarsen.s3_utils import s3_list_multipart_uploads, get_s3_client
+
+    with get_s3_client() as s3_client:
+        return [x async for x in s3_list_multipart_uploads(s3_client, BUCKET, prefix=prefix)]
+
+
+class _RangeSession(niquests.AsyncSession):
+    """Session keeping the Range header of the GET requests, and calling `on_range` before each."""
+
+    def __init__(self, on_range=None):
+        super().__init__()
+        self.ranges: list[str] = []
+        self.on_range = on_range
+
+    async def get(self, url: str, *args, headers: dict | None = None, **kwargs):
+        if headers and "Range" in headers:
+            if self.on_range is not None:
+                self.on_range(len(self.ranges))
+            self.ranges.append(headers["Range"])
+        return await super().get(url, *args, headers=headers, **kwargs)
+
+
+def _stream_ranges(loop, session: niquests.AsyncSession, key: str, range_size: int) -> bytes:
+    from polarsen.s3_utils import s3_stream_object_ranges, get_s3_client
+
+    async def _test():
+        async with session:
+            with get_s3_client() as s3_client:
+                chunks = s3_stream_object_ranges(
+                    s3_client,
+                    session,
+                    bucket=BUCKET,
+                    key=key,
+                    range_size=range_size,
+                    max_concurrency=2,
+                    max_attempts=1,
+                )
+                return b"".join([x async for x in chunks])
+
+    return loop.run_until_complete(_test())
+
+
+@pytest.mark.parametrize(
+    "size",
+    [
+        pytest.param(1_050_000, id="last-range-smaller"),
+        pytest.param(1_000_000, id="exact-ranges"),
+        pytest.param(50_000, id="single-request"),
+    ],
+)
+def test_s3_stream_object_ranges(loop, minio_client, size):
+    data = os.urandom(size)
+    minio_client.put_object(BUCKET, f"ranges-{size}", io.BytesIO(data), length=size)
+    session = _RangeSession()
+
+    assert _stream_ranges(loop, session, f"ranges-{size}", range_size=100_000) == data
+    if size <= 100_000:
+        assert session.ranges == []
+    else:
+        assert session.ranges == [f"bytes={x}-{min(x + 100_000, size) - 1}" for x in range(0, size, 100_000)]
+
+
+def test_s3_stream_object_ranges_modified(loop, minio_client):
+    size = 1_000_000
+
+    def _put(_data: bytes):
+        minio_client.put_object(BUCKET, "ranges-modified", io.BytesIO(_data), length=size)
+
+    _put(os.urandom(size))
+
+    def _on_range(nb_ranges: int):
+        # The object is replaced while being downloaded
+        if nb_ranges == 4:
+            _put(os.urandom(size))
+
+    with pytest.raises(niquests.HTTPError) as e:
+        _stream_ranges(loop, _RangeSession(on_range=_on_range), "ranges-modified", range_size=100_000)
+    # The ranges are only fetched if the ETag still matches
+    assert e.value.response.status_code == 412
@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.mark.parametrize(
+    "size, chunk_size, expected",
+    [
+        pytest.param(0, 3, [], id="empty"),
+        pytest.param(7, 3, [7], id="smaller-than-part"),
+        pytest.param(10, 3, [10], id="one-part"),
+        pytest.param(19, 3, [19], id="one-bigger-part"),
+        pytest.param(35, 4, [10, 10, 15], id="last-part-bigger"),
+        pytest.param(40, 20, [10, 10, 10, 10], id="chunks-bigger-than-part"),
+    ],
+)
+def test_get_stream_chunk(loop, size, chunk_size, expected):
+    from polarsen.utils import get_stream_chunk, iter_bytes
+
+    data = bytes(i % 256 for i in range(size))
+
+    async def _test():
+        return [chunk async for chunk in get_stream_chunk(iter_bytes(data, chunk_size=chunk_size), min_part_size=10)]
+
+    chunks = loop.run_until_complete(_test())
+    assert [len(x) for x in chunks] == expected
+    assert b"".join(chunks) == data